@@ -116,9 +116,12 @@ class APIResponder(Resource):
     """Deal with a mode request, either:
 
     - ``status``: get status and statistics about the search index.
-    - ``check_new_updates``: run fast refresh of the search index if not run in last hour.
-    - ``check_all_updates``: forces slower refresh of the search index.
-    - ``refresh``: forces full refresh of the search index. (could take days)
+    - ``check_new_updates``: start fast refresh of the search index if not run in last hour.
+    - ``check_all_updates``: start slower refresh of the search index.
+    - ``refresh``: start full refresh of the search index. (could take days)
+    - ``refresh_status``: get progress of the current or last refresh.
+
+    Refreshes run in the background, the index keeps being searched meanwhile.
 
     :param mode: mode request
     :type mode: str
@@ -134,6 +137,8 @@ class APIResponder(Resource):
       return self.check_all_updates()
     elif mode == "check_new_updates":
       return self.check_new_updates()
+    elif mode == "refresh_status":
+      return self.get_refresh_status()
     else:
       return {'error': 'unknown_mode: '+str(mode)+'. Did you forget to give \'data\' parameter?'}
 
@@ -297,7 +302,7 @@ class APIResponder(Resource):
     return outp_we
 
   def refresh(self):
-    """Forces a refresh of the search index.
+    """Starts a full refresh of the search index in the background.
 
     :return: response (JSON)
     :rtype: dict
@@ -305,10 +310,26 @@ class APIResponder(Resource):
     # Force check if new images are available in HBase
     # Could be called if data needs to be as up-to-date as it can be but may take a while
     print("[api.{}.refresh: log] received refresh call".format(os.getpid()))
-    if self.searcher:
-      self.searcher.load_codes(full_refresh=True)
-    # Likely to timeout before this message is sent
-    return {'refresh': 'just run a full refresh'}
+    if not self.searcher:
+      return {'error': 'searcher is not initialized'}
+    if self.searcher.start_refresh(full_refresh=True):
+      status_dict = {'refresh': 'started a full refresh'}
+    else:
+      status_dict = {'refresh': 'a refresh is already running'}
+    status_dict['refresh_status'] = self.searcher.get_refresh_status()
+    return status_dict
+
+  def get_refresh_status(self):
+    """Get the progress of the current or last refresh of the search index.
+
+    :return: response (JSON)
+    :rtype: dict
+    """
+    print("[api.{}.get_refresh_status: log] received refresh_status call".format(os.getpid()))
+    status_dict = {'status': 'OK'}
+    status_dict['refresh_status'] = self.searcher.get_refresh_status()
+    status_dict['nb_indexed'] = str(self.searcher.searcher.get_nb_indexed())
+    return status_dict
 
   def status(self):
     """Get the status of the search index. Will run a fast refresh if index has not been refreshed
@@ -325,12 +346,12 @@ class APIResponder(Resource):
     status_dict['API_uptime'] = str(datetime.now()-self.start_time)
 
 
-    status_dict['last_refresh_time'] = self.searcher.last_refresh.isoformat(' ')
+    status_dict['last_refresh_time'] = self.searcher.get_last_refresh().isoformat(' ')
     status_dict['nb_indexed'] = str(self.searcher.searcher.get_nb_indexed())
     return status_dict
 
   def check_new_updates(self):
-    """Check for any unindexed update since last update indexed time.
+    """Check for any unindexed update since last update indexed time, in the background.
 
     :return: response (JSON)
     :rtype: dict
@@ -342,23 +363,23 @@ class APIResponder(Resource):
     status_dict['API_uptime'] = str(datetime.now() - self.start_time)
 
     # Try to refresh on check_new_updates call but at most every hour
-    # The last refresh time should be shared across workers when using gunicorn...
-    if self.searcher.last_refresh:
-      last_refresh_time = self.searcher.last_refresh
+    # The last refresh time is shared across gunicorn workers when the index is shared
+    if self.searcher.get_last_refresh():
+      last_refresh_time = self.searcher.get_last_refresh()
     else:
       last_refresh_time = self.searcher.indexer.last_refresh
 
     diff_time = datetime.now()-last_refresh_time
     if self.searcher and diff_time.total_seconds() > REFRESH_DELAY:
-      self.searcher.load_codes()
-      last_refresh_time = self.searcher.last_refresh
+      self.searcher.start_refresh()
 
     status_dict['last_refresh_time'] = last_refresh_time.isoformat(' ')
+    status_dict['refresh_status'] = self.searcher.get_refresh_status()
     status_dict['nb_indexed'] = str(self.searcher.searcher.get_nb_indexed())
     return status_dict
 
   def check_all_updates(self):
-    """Check for any unindexed update disregarding last update indexed time.
+    """Check for any unindexed update disregarding last update indexed time, in the background.
 
     :return: response (JSON)
     :rtype: dict
@@ -369,9 +390,10 @@ class APIResponder(Resource):
 
     status_dict['API_start_time'] = self.start_time.isoformat(' ')
     status_dict['API_uptime'] = str(datetime.now() - self.start_time)
-    self.searcher.load_codes(check_all_updates=True)
-    last_refresh_time = self.searcher.last_refresh
+    self.searcher.start_refresh(check_all_updates=True)
+    last_refresh_time = self.searcher.get_last_refresh()
     status_dict['last_refresh_time'] = last_refresh_time.isoformat(' ')
+    status_dict['refresh_status'] = self.searcher.get_refresh_status()
     status_dict['nb_indexed'] = str(self.searcher.searcher.get_nb_indexed())
     return status_dict
 
@@ -0,0 +1,29 @@
+from __future__ import print_function
+
+# The searcher background threads index codes with CPU-bound calls, they need workers running
+# real threads: with gevent or eventlet workers they would be greenlets blocking all the requests
+# of their worker while indexing. These defaults can be overridden on the command line, e.g. with
+# -k sync, but not with an asynchronous worker class.
+worker_class = 'gthread'
+threads = 4
+
+ASYNC_WORKER_CLASSES = ['gevent', 'eventlet', 'tornado']
+
+
+def post_worker_init(worker):
+  """Start the background threads of the searcher, i.e. the refresh scheduler and the updates
+  consumer, in each gunicorn worker once it has loaded the application. Threads started before
+  forking, e.g. with --preload, do not survive in the workers.
+
+  :param worker: gunicorn worker
+  :type worker: :class:`gunicorn.workers.base.Worker`
+  """
+  from cufacesearch.api import api
+  if api.global_searcher is not None:
+    worker_class = str(worker.cfg.worker_class_str).lower()
+    if any(async_class in worker_class for async_class in ASYNC_WORKER_CLASSES):
+      msg = "[gunicorn_conf.post_worker_init: warning] worker class {} runs the searcher threads as greenlets,"
+      msg += " indexing will block requests. Use the gthread or sync worker class."
+      print(msg.format(worker.cfg.worker_class_str))
+    print("[gunicorn_conf.post_worker_init] Starting searcher threads in worker {}".format(worker.pid))
+    api.global_searcher.start_refresh_scheduler()
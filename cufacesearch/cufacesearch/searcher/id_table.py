@@ -0,0 +1,347 @@
+from __future__ import print_function
+
+import array
+import hashlib
+import binascii
+import struct
+import threading
+
+import numpy as np
+
+# Kinds of sample ids, see pack_sample_id
+KIND_SHA1 = 0
+KIND_SHA1_BBOX = 1
+KIND_RAW = 2
+SHA1_SIZE = 20
+BBOX_FORMAT = '<4h'
+# Offset and length in the raw ids buffer of a raw id, stored in place of its sha1
+RAW_REF_FORMAT = '<QI8x'
+
+
+def pack_sample_id(sample_id):
+  """Pack a sample id to bytes: a kind byte followed by the 20 bytes binary sha1 for an image id
+  ``<sha1>``, by the sha1 and the bounding box as 4 int16 for a detection id
+  ``<sha1>_<top>_<left>_<bottom>_<right>``, or by the id itself for any other id
+
+  :param sample_id: sample id
+  :type sample_id: str
+  :return: packed sample id
+  :rtype: bytes
+  """
+  sample_id = str(sample_id)
+  parts = sample_id.split('_')
+  if len(parts[0]) == 2 * SHA1_SIZE and len(parts) in [1, 5]:
+    try:
+      sha1 = binascii.unhexlify(parts[0])
+      if len(parts) == 1:
+        packed = struct.pack('B', KIND_SHA1) + sha1
+      else:
+        packed = struct.pack('B', KIND_SHA1_BBOX) + sha1 + struct.pack(BBOX_FORMAT, *[int(x) for x in parts[1:]])
+      # Only keep ids that are exactly rebuilt, e.g. lower case sha1 without padded coordinates
+      if unpack_sample_id(packed) == sample_id:
+        return packed
+    except (TypeError, ValueError, struct.error):
+      pass
+  return struct.pack('B', KIND_RAW) + sample_id
+
+
+def unpack_sample_id(packed):
+  """Rebuild a sample id packed by ``pack_sample_id``
+
+  :param packed: packed sample id
+  :type packed: bytes
+  :return: sample id
+  :rtype: str
+  """
+  kind = struct.unpack('B', packed[:1])[0]
+  if kind == KIND_RAW:
+    return packed[1:]
+  sha1 = binascii.hexlify(packed[1:1 + SHA1_SIZE])
+  if kind == KIND_SHA1:
+    return sha1
+  bbox = struct.unpack(BBOX_FORMAT, packed[1 + SHA1_SIZE:])
+  return '_'.join([sha1] + [str(x) for x in bbox])
+
+
+def hash_packed_id(packed):
+  """Hash a packed sample id to a signed 64 bits integer, see ``IdTable``
+
+  :param packed: packed sample id
+  :type packed: bytes
+  :return: hash
+  :rtype: int
+  """
+  return struct.unpack('<q', hashlib.md5(packed).digest()[:8])[0]
+
+
+class IdTable(object):
+  """Table mapping each sample id to a dense integer id, so that indexes store small integers
+  instead of sample id strings.
+
+  Sha1s are stored as 20 bytes binary and bounding boxes as packed int16 columns. Other ids are
+  stored in a bytes buffer, their offset and length taking the place of their sha1. Sample ids
+  are looked up by a 64 bits hash of their packed form in sorted arrays of (hash, integer id)
+  pairs, new pairs being first sorted in a small delta merged into them once large enough, so no
+  Python object is kept per id. When a LMDB path is given, the table is persisted there and
+  integer ids are allocated in LMDB write transactions, so processes sharing an index agree on ids.
+  """
+
+  def __init__(self, lmdb_path=None, map_size=1024 * 1000000 * 4):
+    """IdTable constructor
+
+    :param lmdb_path: path of the LMDB persisting the table, in memory only if None
+    :type lmdb_path: str
+    :param map_size: LMDB map size
+    :type map_size: int
+    """
+    self.lock = threading.Lock()
+    self.kinds = bytearray()
+    self.sha1s = bytearray()
+    self.bboxes = array.array('h')
+    self.raw_bytes = bytearray()
+    self._reset_index()
+    self.env = None
+    if lmdb_path is not None:
+      import lmdb
+      self.env = lmdb.open(lmdb_path, map_size=map_size, max_dbs=1)
+      self.ids_db = self.env.open_db("ids")
+      self.sync()
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def _reset_index(self):
+    self.index_hashes = np.zeros(0, dtype=np.int64)
+    self.index_ids = np.zeros(0, dtype=np.int32)
+    self.delta_hashes = np.zeros(0, dtype=np.int64)
+    self.delta_ids = np.zeros(0, dtype=np.int32)
+
+  def _index_add(self, hashes, int_ids):
+    hashes = np.concatenate([self.delta_hashes, np.asarray(hashes, dtype=np.int64)])
+    int_ids = np.concatenate([self.delta_ids, np.asarray(int_ids, dtype=np.int32)])
+    order = np.argsort(hashes, kind='mergesort')
+    self.delta_hashes, self.delta_ids = hashes[order], int_ids[order]
+    if len(self.delta_hashes) > max(1024, len(self.index_hashes) // 8):
+      hashes = np.concatenate([self.index_hashes, self.delta_hashes])
+      int_ids = np.concatenate([self.index_ids, self.delta_ids])
+      order = np.argsort(hashes, kind='mergesort')
+      self.index_hashes, self.index_ids = hashes[order], int_ids[order]
+      self.delta_hashes, self.delta_ids = self.delta_hashes[:0], self.delta_ids[:0]
+
+  def _index_find(self, packed_ids, hashes):
+    """Find the integer ids of packed sample ids, -1 for the ones not in the table
+    """
+    int_ids = np.full(len(packed_ids), -1, dtype=np.int64)
+    hashes = np.asarray(hashes, dtype=np.int64)
+    for index_hashes, index_ids in [(self.index_hashes, self.index_ids), (self.delta_hashes, self.delta_ids)]:
+      starts = np.searchsorted(index_hashes, hashes, side='left')
+      ends = np.searchsorted(index_hashes, hashes, side='right')
+      # Candidates are checked against the stored id, hashes may collide
+      for i in np.flatnonzero(ends > starts):
+        for j in xrange(starts[i], ends[i]):
+          if self._get_packed(int(index_ids[j])) == packed_ids[i]:
+            int_ids[i] = index_ids[j]
+            break
+    return int_ids
+
+  def _append(self, packed):
+    int_id = len(self.kinds)
+    kind = struct.unpack('B', packed[:1])[0]
+    self.kinds.append(kind)
+    if kind == KIND_RAW:
+      raw_id = packed[1:]
+      self.sha1s.extend(struct.pack(RAW_REF_FORMAT, len(self.raw_bytes), len(raw_id)))
+      self.raw_bytes.extend(raw_id)
+      self.bboxes.extend([0, 0, 0, 0])
+    else:
+      self.sha1s.extend(packed[1:1 + SHA1_SIZE])
+      if kind == KIND_SHA1_BBOX:
+        self.bboxes.extend(struct.unpack(BBOX_FORMAT, packed[1 + SHA1_SIZE:]))
+      else:
+        self.bboxes.extend([0, 0, 0, 0])
+    return int_id
+
+  def _get_raw_id(self, int_id):
+    offset, length = struct.unpack(RAW_REF_FORMAT, bytes(self.sha1s[int_id * SHA1_SIZE:(int_id + 1) * SHA1_SIZE]))
+    return bytes(self.raw_bytes[offset:offset + length])
+
+  def _get_packed(self, int_id):
+    kind = self.kinds[int_id]
+    if kind == KIND_RAW:
+      return struct.pack('B', kind) + self._get_raw_id(int_id)
+    packed = struct.pack('B', kind) + bytes(self.sha1s[int_id * SHA1_SIZE:(int_id + 1) * SHA1_SIZE])
+    if kind == KIND_SHA1_BBOX:
+      packed += struct.pack(BBOX_FORMAT, *self.bboxes[int_id * 4:(int_id + 1) * 4])
+    return packed
+
+  def _add_packed(self, packed_ids):
+    int_ids = [self._append(packed) for packed in packed_ids]
+    self._index_add([hash_packed_id(packed) for packed in packed_ids], int_ids)
+    return int_ids
+
+  def _truncate(self, nb_ids, nb_raw_bytes):
+    del self.kinds[nb_ids:]
+    del self.sha1s[nb_ids * SHA1_SIZE:]
+    del self.bboxes[nb_ids * 4:]
+    del self.raw_bytes[nb_raw_bytes:]
+    keep = self.index_ids < nb_ids
+    self.index_hashes, self.index_ids = self.index_hashes[keep], self.index_ids[keep]
+    keep = self.delta_ids < nb_ids
+    self.delta_hashes, self.delta_ids = self.delta_hashes[keep], self.delta_ids[keep]
+
+  def _sync(self, txn):
+    packed_ids = []
+    with txn.cursor(db=self.ids_db) as cursor:
+      if cursor.set_range(struct.pack('>I', len(self.kinds))):
+        for key, packed in cursor:
+          # Ids are allocated in order, so keys are contiguous
+          if struct.unpack('>I', key)[0] != len(self.kinds) + len(packed_ids):
+            raise ValueError("Inconsistent id table, missing id {}".format(len(self.kinds) + len(packed_ids)))
+          packed_ids.append(bytes(packed))
+    self._add_packed(packed_ids)
+
+  def sync(self):
+    """Load the ids added to the LMDB table by other processes
+    """
+    if self.env is None:
+      return
+    with self.lock:
+      with self.env.begin(write=False) as txn:
+        self._sync(txn)
+
+  def get_or_add_ids(self, sample_ids):
+    """Get the integer ids of sample ids, adding the ones not yet in the table
+
+    :param sample_ids: sample ids
+    :type sample_ids: list
+    :return: integer ids
+    :rtype: :class:`numpy.ndarray`
+    """
+    packed_ids = [pack_sample_id(sample_id) for sample_id in sample_ids]
+    hashes = [hash_packed_id(packed) for packed in packed_ids]
+    with self.lock:
+      int_ids = self._index_find(packed_ids, hashes)
+      missing = np.flatnonzero(int_ids < 0)
+      if len(missing):
+        nb_ids = len(self.kinds)
+        nb_raw_bytes = len(self.raw_bytes)
+        try:
+          if self.env is not None:
+            with self.env.begin(write=True) as txn:
+              self._sync(txn)
+              if len(self.kinds) > nb_ids:
+                # Ids added by another process meanwhile
+                int_ids[missing] = self._index_find([packed_ids[i] for i in missing], [hashes[i] for i in missing])
+                missing = np.flatnonzero(int_ids < 0)
+              first_id, new_packed_ids = self._allocate_ids(packed_ids, hashes, missing, int_ids)
+              for int_id, packed in enumerate(new_packed_ids, first_id):
+                txn.put(struct.pack('>I', int_id), packed, db=self.ids_db, append=True)
+          else:
+            self._allocate_ids(packed_ids, hashes, missing, int_ids)
+        except Exception:
+          # Keep the table in memory consistent with the LMDB table
+          self._truncate(nb_ids, nb_raw_bytes)
+          raise
+      return int_ids.astype(np.int32)
+
+  def _allocate_ids(self, packed_ids, hashes, missing, int_ids):
+    """Allocate integer ids to the missing packed ids, in order, a sample id repeated in a batch
+    getting a single integer id. Fills ``int_ids`` and returns the first new integer id and the
+    list of new packed ids
+    """
+    first_id = len(self.kinds)
+    new_ids = dict()
+    new_packed_ids = []
+    new_hashes = []
+    for i in missing:
+      packed = packed_ids[i]
+      int_id = new_ids.get(packed)
+      if int_id is None:
+        int_id = new_ids[packed] = self._append(packed)
+        new_packed_ids.append(packed)
+        new_hashes.append(hashes[i])
+      int_ids[i] = int_id
+    self._index_add(new_hashes, np.arange(first_id, len(self.kinds)))
+    return first_id, new_packed_ids
+
+  def get_state(self):
+    """Get the columns of a table kept in memory only, e.g. to save them along a snapshot of the
+    index
+
+    :return: columns of the table
+    :rtype: dict
+    """
+    with self.lock:
+      # The state holds a single sorted lookup array
+      hashes = np.concatenate([self.index_hashes, self.delta_hashes])
+      int_ids = np.concatenate([self.index_ids, self.delta_ids])
+      order = np.argsort(hashes, kind='mergesort')
+      return {'kinds': bytes(self.kinds), 'sha1s': bytes(self.sha1s), 'bboxes': self.bboxes.tostring(),
+              'raw_bytes': bytes(self.raw_bytes), 'index_hashes': hashes[order].tostring(),
+              'index_ids': int_ids[order].tostring()}
+
+  def set_state(self, state):
+    """Replace the content of a table kept in memory only by columns obtained with ``get_state``
+
+    :param state: columns of the table
+    :type state: dict
+    """
+    with self.lock:
+      self._reset_index()
+      self.kinds = bytearray()
+      self.sha1s = bytearray()
+      self.bboxes = array.array('h')
+      self.raw_bytes = bytearray()
+      self.kinds = bytearray(state['kinds'])
+      self.sha1s = bytearray(state['sha1s'])
+      self.bboxes.fromstring(state['bboxes'])
+      self.raw_bytes = bytearray(state['raw_bytes'])
+      self.index_hashes = np.frombuffer(state['index_hashes'], dtype=np.int64).copy()
+      self.index_ids = np.frombuffer(state['index_ids'], dtype=np.int32).copy()
+
+  def _check_ids(self, int_ids):
+    if len(int_ids) and max(int_ids) >= len(self.kinds):
+      # Ids added by another process
+      self.sync()
+
+  def resolve(self, int_ids):
+    """Get the sample ids of integer ids, e.g. of the final results of a search
+
+    :param int_ids: integer ids
+    :type int_ids: list
+    :return: sample ids
+    :rtype: list
+    """
+    int_ids = [int(int_id) for int_id in int_ids]
+    self._check_ids(int_ids)
+    sample_ids = []
+    for int_id in int_ids:
+      kind = self.kinds[int_id]
+      if kind == KIND_RAW:
+        sample_ids.append(self._get_raw_id(int_id))
+        continue
+      sha1 = binascii.hexlify(self.sha1s[int_id * SHA1_SIZE:(int_id + 1) * SHA1_SIZE])
+      if kind == KIND_SHA1:
+        sample_ids.append(sha1)
+      else:
+        bbox = self.bboxes[int_id * 4:(int_id + 1) * 4]
+        sample_ids.append('_'.join([sha1] + [str(x) for x in bbox]))
+    return sample_ids
+
+  def get_sha1s(self, int_ids):
+    """Get the image sha1 of integer ids, without building the full sample ids
+
+    :param int_ids: integer ids
+    :type int_ids: list
+    :return: sha1s
+    :rtype: list
+    """
+    int_ids = [int(int_id) for int_id in int_ids]
+    self._check_ids(int_ids)
+    sha1s = []
+    for int_id in int_ids:
+      if self.kinds[int_id] == KIND_RAW:
+        sha1s.append(self._get_raw_id(int_id).split('_')[0])
+      else:
+        sha1s.append(binascii.hexlify(self.sha1s[int_id * SHA1_SIZE:(int_id + 1) * SHA1_SIZE]))
+    return sha1s
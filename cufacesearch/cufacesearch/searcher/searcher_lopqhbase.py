@@ -2,8 +2,12 @@ from __future__ import print_function
 
 import os
 import sys
+import json
 import time
-from datetime import datetime
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timedelta
 
 import lmdb
 import numpy as np
@@ -17,9 +21,12 @@ from ..storer.s3 import S3Storer
 from ..common.error import full_trace_error
 
 START_HDFS = '/user/'
-DATE_DB_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Pushed updates not processed after that many seconds are left to the periodic refresh
+MAX_PENDING_UPDATE_AGE = 24 * 3600
 
 default_prefix = "SEARCHLOPQ_"
+# Searchers whose index persists on disk, indexed updates are then also tracked in a LMDB
+PERSISTENT_SEARCHERS = ["LOPQSearcherLMDB", "LOPQSearcherMmap"]
 
 
 class SearcherLOPQHBase(GenericSearcher):
@@ -34,8 +41,9 @@ class SearcherLOPQHBase(GenericSearcher):
     :param prefix: prefix in configuration
     :type prefix: str
     """
-    # number of processors to use for parallel computation of codes
-    self.num_procs = 8  # could be read from configuration
+    # number of processes to use for parallel computation of codes (1 to encode in process)
+    self.num_procs = 1
+    self.encoder_pool = None
     self.model_params = None
     self.get_pretrained_model = True
     self.nb_train_pca = 100000
@@ -43,13 +51,56 @@ class SearcherLOPQHBase(GenericSearcher):
     # NB: in load_codes full_refresh default is false...
     self.last_full_refresh = datetime.now()
     self.last_indexed_update = None
+    # Updates indexed by a persistent searcher, see init_updates_env
+    self.update_registry = None
     self.pca_model_str = None
     self.skipfailed = False
     # making LOPQSearcherLMDB the default LOPQSearcher
     self.lopq_searcher = "LOPQSearcherLMDB"
+    self.nb_shards = 4
+    self.shard_searcher = "LOPQSearcherColumnar"
+    self.shard_partition = "id"
+    self.use_id_table = False
+    self.id_table = None
+    self.dedup = "set"
+    self.use_snapshot = False
+    self.snapshot_interval = 3600
+    self.snapshot_control = None
+    self.shared_index = False
+    self.shared_control = None
+    self.index_generation = 0
+    # Background refresh of the index, see start_refresh
+    self.refresh_batch_size = 100000
+    self.refresh_interval = 0
+    self.refresh_thread = None
+    self.refresh_lock = threading.Lock()
+    self.refresh_status = {'running': False}
+    self.refresh_scheduler_pid = None
+    # Threads fetching the codes of updates during a refresh, see iter_updates_codes
+    self.load_threads = 1
+    self.load_prefetch = 8
+    self.load_pool = None
+    self.load_pool_pid = None
+    self.pools_lock = threading.Lock()
+    # Compression of the codes data of updates: "" or "zlib"
+    self.codes_compression = ""
+    # Only one thread of a process adds codes to the index at a time, see write_index
+    self.index_write_lock = threading.Lock()
+    self.nb_unsaved_updates = 0
+    # Updates pushed to the updates topic, indexed as soon as processed, see consume_updates
+    self.updates_consumer_prefix = None
+    self.updates_check_interval = 10
+    self.updates_consumer_pid = None
+    self.pushed_updates = dict()
+    # Date from which refreshes check updates when updates are pushed, see update_reconcile_date
+    self.reconcile_date = None
+    self.reconcile_margin = 1
     super(SearcherLOPQHBase, self).__init__(global_conf_in, prefix)
     self.set_pp(pp="SearcherLOPQHBase")
 
+    if self.use_snapshot:
+      # Restore the index saved at the end of a previous load, load_codes then adds newer updates
+      self.load_all_codes()
     # To load pickled codes files from s3 bucket
     print("[{}.load_codes: log] Starting to load codes".format(self.pp))
     self.load_codes()
@@ -70,6 +121,28 @@ class SearcherLOPQHBase(GenericSearcher):
     - ``nb_min_train_pca``
     - ``lopq_searcher``
     - ``skipfailed``
+    - ``cell_cutoff``
+    - ``num_procs``
+    - ``train_streaming``
+    - ``precompute_adc``
+    - ``search_threads``
+    - ``min_candidates_per_thread``
+    - ``nb_shards``
+    - ``shard_searcher``
+    - ``shard_partition``
+    - ``use_id_table``
+    - ``dedup``
+    - ``use_snapshot``
+    - ``snapshot_interval``
+    - ``shared_index``
+    - ``refresh_batch_size``
+    - ``refresh_interval``
+    - ``load_threads``
+    - ``load_prefetch``
+    - ``codes_compression``
+    - ``updates_consumer_prefix``
+    - ``updates_check_interval``
+    - ``reconcile_margin``
     """
     V = self.get_required_param('lopq_V')
     M = self.get_required_param('lopq_M')
@@ -85,6 +158,71 @@ class SearcherLOPQHBase(GenericSearcher):
         self.nb_min_train_pca = nb_min_train_pca
     self.lopq_searcher = self.get_param('lopq_searcher', default="LOPQSearcherLMDB")
     self.skipfailed = self.get_param('skipfailed', default=False)
+    # Stop visiting cells once their centroid is farther than the max_returned-th best result
+    self.cell_cutoff = self.get_param('cell_cutoff', default=False)
+    self.num_procs = int(self.get_param('num_procs', default=self.num_procs))
+    # Train with mini-batches streamed from the features database instead of loading all features
+    self.train_streaming = self.get_param('train_streaming', default=False)
+    self.precompute_adc = self.get_param('precompute_adc', default=False)
+    self.search_threads = int(self.get_param('search_threads', default=1))
+    self.min_candidates_per_thread = int(self.get_param('min_candidates_per_thread', default=10000))
+    # Sharded index, used when lopq_searcher is "LOPQSearcherSharded"
+    self.nb_shards = int(self.get_param('nb_shards', default=self.nb_shards))
+    self.shard_searcher = self.get_param('shard_searcher', default=self.shard_searcher)
+    self.shard_partition = self.get_param('shard_partition', default=self.shard_partition)
+    # Index dense integer ids mapped to sample ids by an IdTable instead of sample id strings
+    self.use_id_table = self.get_param('use_id_table', default=self.use_id_table)
+    # Duplicate detection mode of LOPQSearcher: "set", "bloom" or "scan"
+    self.dedup = self.get_param('dedup', default=self.dedup)
+    # Save and restore in-memory indexes as a single snapshot, see save_all_codes
+    self.use_snapshot = self.get_param('use_snapshot', default=self.use_snapshot)
+    # Minimum number of seconds between two snapshots saved by any process serving the index
+    self.snapshot_interval = int(self.get_param('snapshot_interval', default=self.snapshot_interval))
+    # Share a persistent index across processes, e.g. gunicorn workers, with a single refresher
+    self.shared_index = self.get_param('shared_index', default=self.shared_index)
+    # Number of codes staged before being added to the index during a refresh
+    self.refresh_batch_size = int(self.get_param('refresh_batch_size', default=self.refresh_batch_size))
+    # Seconds between background refreshes, 0 to only refresh on API calls
+    self.refresh_interval = int(self.get_param('refresh_interval', default=self.refresh_interval))
+    # Number of threads fetching codes and features of updates during a refresh, and number of
+    # updates fetched ahead. The indexer 'pool_thread' should be at least 'load_threads'
+    self.load_threads = int(self.get_param('load_threads', default=self.load_threads))
+    self.load_prefetch = int(self.get_param('load_prefetch', default=self.load_prefetch))
+    # Compression of the codes data saved for each update: "" or "zlib", smaller to download
+    # but decompressed before being read
+    self.codes_compression = self.get_param('codes_compression', default=self.codes_compression)
+    # Prefix of the configuration of a Kafka consumer of the updates topic of the extraction
+    # checker, i.e. its 'producer_updates_out_topic'. Pushed updates are indexed within seconds,
+    # the refresh every 'refresh_interval' seconds then checks updates since the oldest one that
+    # may have been missed as a backstop, see update_reconcile_date. Unless the index is shared,
+    # each process consumes all messages: its 'consumer_group' is ignored
+    self.updates_consumer_prefix = self.get_param('updates_consumer_prefix',
+                                                  default=self.updates_consumer_prefix)
+    # Seconds between checks of pushed updates that were not processed yet
+    self.updates_check_interval = int(self.get_param('updates_check_interval',
+                                                     default=self.updates_check_interval))
+    # Days checked again by refreshes before the oldest update that may have been missed
+    self.reconcile_margin = int(self.get_param('reconcile_margin', default=self.reconcile_margin))
+
+  def is_persistent_searcher(self):
+    """Check if the searcher index is persistent, in which case indexed updates are stored in LMDB
+
+    :return: True if the searcher, or the searcher of each shard, is in ``PERSISTENT_SEARCHERS``
+    :rtype: bool
+    """
+    if self.lopq_searcher == "LOPQSearcherSharded":
+      return self.shard_searcher in PERSISTENT_SEARCHERS
+    return self.lopq_searcher in PERSISTENT_SEARCHERS
+
+  def build_index_str(self):
+    """Build index string, i.e. the model string with a suffix when the index stores integer ids
+
+    :return: index string
+    :rtype: str
+    """
+    if self.use_id_table:
+      return self.build_model_str() + "_intids"
+    return self.build_model_str()
 
   def build_pca_model_str(self):
     """Build PCA model string
@@ -187,6 +325,9 @@ class SearcherLOPQHBase(GenericSearcher):
 
     # Setup searcher with LOPQ model
     if lopq_model:
+      if self.precompute_adc and getattr(lopq_model, 'adc_terms', None) is None:
+        # Precompute query independent terms of the distances used when scanning cells
+        lopq_model.precompute_adc_terms()
       # LOPQSearcherLMDB is now the default, as it makes the index more persistent
       # and potentially more easily usable with multiple processes.
       if self.lopq_searcher == "LOPQSearcherLMDB":
@@ -196,26 +337,131 @@ class SearcherLOPQHBase(GenericSearcher):
         # TODO: should we get path from a parameter? and/or add model_str to it?
         # path are inside the docker container only...
         self.searcher = LOPQSearcherLMDB(lopq_model,
-                                         lmdb_path='/data/lmdb_index_' + self.build_model_str(),
-                                         id_lambda=str)
-        # Should we move all that updates related lmbd in a call for each thread?
-        # How could we properly set the size of this?
-        up_map_size = 1024 * 1000000 * 1
-        # Again (see lopq.search LOPQSearcherLMDB), should we use writemap=True or not
-        # self.updates_env = lmdb.open('/data/lmdb_updates_' + self.build_model_str(),
-        #                              map_size=up_map_size, writemap=True, map_async=True, max_dbs=1)
-        self.updates_env = lmdb.open('/data/lmdb_updates_' + self.build_model_str(),
-                                     map_size=up_map_size, max_dbs=1)
-        self.updates_index_db = self.updates_env.open_db("updates")
+                                         lmdb_path='/data/lmdb_index_' + self.build_index_str(),
+                                         id_lambda=self.get_id_lambda())
+        self.init_updates_env()
         if self.verbose > 4:
           print("[{}.init_searcher: log] Local LMDB initialized".format(self.pp))
+      elif self.lopq_searcher == "LOPQSearcherMmap":
+        # Index stored in immutable memory-mapped segment files, shared by all workers
+        from lopq.search import LOPQSearcherMmap
+        self.searcher = LOPQSearcherMmap(lopq_model,
+                                         segments_path='/data/segments_index_' + self.build_index_str())
+        self.init_updates_env()
       elif self.lopq_searcher == "LOPQSearcher":
         from lopq.search import LOPQSearcher
-        self.searcher = LOPQSearcher(lopq_model)
+        self.searcher = LOPQSearcher(lopq_model, dedup=self.dedup)
+      elif self.lopq_searcher == "LOPQSearcherColumnar":
+        # In-memory index with codes stored in contiguous per-cell arrays
+        from lopq.search import LOPQSearcherColumnar
+        # Integer ids of the id table are used directly as rows of the index
+        self.searcher = LOPQSearcherColumnar(lopq_model, dense_ids=self.use_id_table)
+      elif self.lopq_searcher == "LOPQSearcherSharded":
+        # Index partitioned across local worker processes, queries are broadcast to all shards
+        from lopq.shard import LOPQSearcherSharded, PERSISTENT_SHARD_SEARCHERS
+        # gunicorn workers forked after the searcher is built (--preload) restart their own shards,
+        # which only works for shards stored on disk
+        if "gunicorn" in os.environ.get("SERVER_SOFTWARE", "") and \
+            self.shard_searcher not in PERSISTENT_SHARD_SEARCHERS:
+          msg = "[{}.init_searcher: error] shard_searcher {} keeps shards in memory, use one of {} with gunicorn"
+          raise ValueError(msg.format(self.pp, self.shard_searcher, PERSISTENT_SHARD_SEARCHERS))
+        shard_kwargs = dict()
+        if self.shard_searcher == "LOPQSearcherLMDB":
+          shard_kwargs['lmdb_path'] = '/data/lmdb_index_' + self.build_index_str() + '_shard{shard}'
+          shard_kwargs['id_lambda'] = self.get_id_lambda()
+        elif self.shard_searcher == "LOPQSearcherMmap":
+          shard_kwargs['segments_path'] = '/data/segments_index_' + self.build_index_str() + '_shard{shard}'
+        elif self.shard_searcher == "LOPQSearcherColumnar":
+          shard_kwargs['dense_ids'] = self.use_id_table
+        if self.verbose > 1:
+          msg = "[{}.init_searcher: log] Starting {} shards of {} partitioned by {}"
+          print(msg.format(self.pp, self.nb_shards, self.shard_searcher, self.shard_partition))
+        self.searcher = LOPQSearcherSharded(lopq_model, num_shards=self.nb_shards,
+                                            partition=self.shard_partition,
+                                            shard_searcher=self.shard_searcher,
+                                            shard_kwargs=shard_kwargs)
+        if self.is_persistent_searcher():
+          self.init_updates_env()
       else:
         raise ValueError("Unknown 'lopq_searcher' type: {}".format(self.lopq_searcher))
+      if self.search_threads > 1:
+        # Score the cells retrieved by a single query in parallel
+        self.searcher.set_scan_threads(self.search_threads, self.min_candidates_per_thread)
+      if self.use_id_table:
+        self.init_id_table()
+      if self.shared_index:
+        self.init_shared_control()
     # NB: an empty lopq_model would make sense only if we just want to detect...
 
+  def init_updates_env(self):
+    """ Initialize the registry of the updates indexed by a persistent searcher, stored in LMDB
+    """
+    from .update_registry import UpdateRegistry
+    # How could we properly set the size of this?
+    up_map_size = 1024 * 1000000 * 1
+    self.update_registry = UpdateRegistry('/data/lmdb_updates_' + self.build_index_str(),
+                                          map_size=up_map_size)
+
+  def init_shared_control(self):
+    """Initialize the control block shared by the processes serving the same index
+
+    :raises ValueError: if the searcher is not persistent, see ``is_persistent_searcher``
+    """
+    if not self.is_persistent_searcher():
+      msg = "[{}.init_shared_control: error] lopq_searcher {} is not persistent and cannot be shared"
+      raise ValueError(msg.format(self.pp, self.lopq_searcher))
+    from .shared_control import SharedControl
+    self.shared_control = SharedControl('/data/control_' + self.build_index_str())
+
+  def sync_shared_index(self):
+    """Attach to the latest generation of the shared index published by the refresher, if it
+    changed since the last call. Cheap enough to be called before each search.
+    """
+    if self.shared_control is None or self.shared_control.get_generation() == self.index_generation:
+      return
+    generation, nb_indexed, last_refresh, refresher_pid = self.shared_control.read()
+    # Segments of Mmap indexes, sharded or not, written by the refresher
+    if hasattr(self.searcher, "reload_segments"):
+      self.searcher.reload_segments()
+    if last_refresh:
+      self.last_refresh = datetime.fromtimestamp(last_refresh)
+    self.index_generation = generation
+    if self.verbose > 1:
+      msg = "[{}.sync_shared_index: log] Attached to generation {} with {} codes published by {}"
+      print(msg.format(self.pp, generation, nb_indexed, refresher_pid))
+
+  def get_last_refresh(self):
+    """Get the time of the last refresh of the index, by any process when the index is shared
+
+    :return: last refresh time
+    :rtype: :class:`datetime.datetime`
+    """
+    self.sync_shared_index()
+    return self.last_refresh
+
+  def get_id_lambda(self):
+    """Get the function used by LMDB searchers to deserialize ids
+
+    :return: ``int`` if indexing integer ids of the id table, ``str`` otherwise
+    :rtype: function
+    """
+    if self.use_id_table:
+      return int
+    return str
+
+  def init_id_table(self):
+    """Initialize the table mapping sample ids to the integer ids stored in the index, persisted
+    in LMDB next to the index for persistent searchers
+    """
+    from .id_table import IdTable
+    lmdb_path = None
+    if self.is_persistent_searcher():
+      lmdb_path = '/data/lmdb_ids_' + self.build_model_str()
+    self.id_table = IdTable(lmdb_path)
+    if self.verbose > 1:
+      msg = "[{}.init_id_table: log] Id table has {} ids"
+      print(msg.format(self.pp, len(self.id_table)))
+
   def get_feats_from_lmbd(self, feats_db, nb_features, dtype):
     """Get features from LMBD database
 
@@ -246,6 +492,35 @@ class SearcherLOPQHBase(GenericSearcher):
               feats[i, :] = np.frombuffer(item[1], dtype=dtype)
     return feats
 
+  def iter_feats_from_lmbd(self, feats_db, nb_features, dtype, chunk_size=10000):
+    """Iterate over features from LMBD database by chunks, without loading all of them
+
+    :param feats_db: features database
+    :type feats_db: str
+    :param nb_features: number of features
+    :type nb_features: int
+    :param dtype: numpy type
+    :type dtype: :class:`numpy.dtype`
+    :param chunk_size: number of features per chunk
+    :type chunk_size: int
+    :return: generator of features chunks
+    :rtype: generator(:class:`numpy.ndarray`)
+    """
+    chunk = []
+    nb_read = 0
+    with self.save_feat_env.begin(db=feats_db, write=False) as txn:
+      with txn.cursor() as cursor:
+        for _, value in cursor:
+          if nb_read >= nb_features:
+            break
+          chunk.append(np.frombuffer(value, dtype=dtype))
+          nb_read += 1
+          if len(chunk) >= chunk_size:
+            yield np.vstack(chunk).astype(np.float64)
+            chunk = []
+    if chunk:
+      yield np.vstack(chunk).astype(np.float64)
+
   def save_feats_to_lmbd(self, feats_db, samples_ids, np_features, max_feats=0):
     """Save features to LMDB database
 
@@ -291,6 +566,41 @@ class SearcherLOPQHBase(GenericSearcher):
     :return: features
     :rtype: :class:`numpy.ndarray`
     """
+    feats_db, dtype, nb_features_to_read = self.gather_train_features(nb_features, lopq_pca_model,
+                                                                      nb_min_train)
+    return self.get_feats_from_lmbd(feats_db, nb_features_to_read, dtype)
+
+  def get_train_features_chunks(self, nb_features, lopq_pca_model=None, nb_min_train=None):
+    """Get a function iterating over training features by chunks, to train without loading all
+    training features in memory
+
+    :param nb_features: number of features
+    :type nb_features: int
+    :param lopq_pca_model: whether model is lopq_pca_model
+    :type lopq_pca_model: bool
+    :param nb_min_train: minimum
+    :type nb_min_train: int
+    :return: function returning a generator of features chunks, and number of features
+    :rtype: tuple(function, int)
+    """
+    feats_db, dtype, nb_features_to_read = self.gather_train_features(nb_features, lopq_pca_model,
+                                                                      nb_min_train)
+    nb_features_to_read = min(nb_features_to_read, self.get_nb_saved_feats(feats_db))
+    get_chunks = lambda: self.iter_feats_from_lmbd(feats_db, nb_features_to_read, dtype)
+    return get_chunks, nb_features_to_read
+
+  def gather_train_features(self, nb_features, lopq_pca_model=None, nb_min_train=None):
+    """Gather training features in the LMDB features database
+
+    :param nb_features: number of features
+    :type nb_features: int
+    :param lopq_pca_model: whether model is lopq_pca_model
+    :type lopq_pca_model: bool
+    :param nb_min_train: minimum
+    :type nb_min_train: int
+    :return: features database, features type and number of features to read
+    :rtype: tuple
+    """
     if nb_min_train is None:
       nb_min_train = nb_features
     if lopq_pca_model:
@@ -386,7 +696,7 @@ class SearcherLOPQHBase(GenericSearcher):
               sys.stdout.flush()
               break
 
-    return self.get_feats_from_lmbd(feats_db, nb_features_to_read, dtype)
+    return feats_db, dtype, nb_features_to_read
 
   def train_index(self):
     """Train search index
@@ -396,9 +706,14 @@ class SearcherLOPQHBase(GenericSearcher):
     """
 
     if self.model_type == "lopq":
-      train_np = self.get_train_features(self.nb_train, nb_min_train=self.nb_min_train)
-      print("Got train features array with shape: {}".format(train_np.shape))
-      nb_train_feats = train_np.shape[0]
+      if self.train_streaming:
+        get_chunks, nb_train_feats = self.get_train_features_chunks(self.nb_train,
+                                                                    nb_min_train=self.nb_min_train)
+        print("Got {} train features to stream".format(nb_train_feats))
+      else:
+        train_np = self.get_train_features(self.nb_train, nb_min_train=self.nb_min_train)
+        print("Got train features array with shape: {}".format(train_np.shape))
+        nb_train_feats = train_np.shape[0]
       sys.stdout.flush()
 
       if nb_train_feats >= self.nb_train:
@@ -410,8 +725,11 @@ class SearcherLOPQHBase(GenericSearcher):
         msg = "[{}.train_model: info] Starting local training of 'lopq' model with parameters {} using {} features."
         print(msg.format(self.pp, self.model_params, nb_train_feats))
         start_train = time.time()
-        # specify a n_init < 10 (default value) to speed-up training?
-        lopq_model.fit(train_np, verbose=True)
+        if self.train_streaming:
+          lopq_model.fit_streaming(get_chunks, verbose=True)
+        else:
+          # specify a n_init < 10 (default value) to speed-up training?
+          lopq_model.fit(train_np, verbose=True)
         # save model
         self.storer.save(self.build_model_str(), lopq_model)
         msg = "[{}.train_model: info] Trained lopq model in {}s."
@@ -431,29 +749,46 @@ class SearcherLOPQHBase(GenericSearcher):
       # pca loading/training first
       pca_model = self.storer.load(self.build_pca_model_str())
       if pca_model is None:
-        train_np = self.get_train_features(self.nb_train_pca, nb_min_train=self.nb_min_train_pca)
         msg = "[{}.train_model: info] Training PCA model, keeping {} dimensions from features {}."
-        print(msg.format(self.pp, self.model_params['pca'], train_np.shape))
-        sys.stdout.flush()
-        start_train_pca = time.time()
-        lopq_model.fit_pca(train_np, pca_dims=self.model_params['pca'])
+        if self.train_streaming:
+          get_chunks, nb_train_feats = self.get_train_features_chunks(self.nb_train_pca,
+                                                                      nb_min_train=self.nb_min_train_pca)
+          print(msg.format(self.pp, self.model_params['pca'], nb_train_feats))
+          sys.stdout.flush()
+          start_train_pca = time.time()
+          lopq_model.fit_pca_streaming(get_chunks, pca_dims=self.model_params['pca'])
+        else:
+          train_np = self.get_train_features(self.nb_train_pca, nb_min_train=self.nb_min_train_pca)
+          print(msg.format(self.pp, self.model_params['pca'], train_np.shape))
+          sys.stdout.flush()
+          start_train_pca = time.time()
+          lopq_model.fit_pca(train_np, pca_dims=self.model_params['pca'])
+          del train_np
         info_msg = "[{}.train_model: info] Trained pca model in {}s."
         print(info_msg.format(self.pp, time.time() - start_train_pca))
-        del train_np
         self.storer.save(self.build_pca_model_str(),
                          {"P": lopq_model.pca_P, "mu": lopq_model.pca_mu})
       else:
         lopq_model.pca_P = pca_model["P"]
         lopq_model.pca_mu = pca_model["mu"]
       # train model
-      train_np = self.get_train_features(self.nb_train, lopq_pca_model=lopq_model,
-                                         nb_min_train=self.nb_min_train)
       msg = "[{}.train_model: info] Training 'lopq_pca' model with parameters {} using features {}"
-      print(msg.format(self.pp, self.model_params, train_np.shape))
-      sys.stdout.flush()
-      start_train = time.time()
-      # specify a n_init < 10 (default value) to speed-up training?
-      lopq_model.fit(train_np, verbose=True, apply_pca=False, train_pca=False)
+      if self.train_streaming:
+        get_chunks, nb_train_feats = self.get_train_features_chunks(self.nb_train,
+                                                                    lopq_pca_model=lopq_model,
+                                                                    nb_min_train=self.nb_min_train)
+        print(msg.format(self.pp, self.model_params, nb_train_feats))
+        sys.stdout.flush()
+        start_train = time.time()
+        lopq_model.fit_streaming(get_chunks, verbose=True, apply_pca=False, train_pca=False)
+      else:
+        train_np = self.get_train_features(self.nb_train, lopq_pca_model=lopq_model,
+                                           nb_min_train=self.nb_min_train)
+        print(msg.format(self.pp, self.model_params, train_np.shape))
+        sys.stdout.flush()
+        start_train = time.time()
+        # specify a n_init < 10 (default value) to speed-up training?
+        lopq_model.fit(train_np, verbose=True, apply_pca=False, train_pca=False)
       # TODO: we could evaluate model based on reconstruction of some randomly sampled features?
       # save model
       self.storer.save(self.build_model_str(), lopq_model)
@@ -473,6 +808,24 @@ class SearcherLOPQHBase(GenericSearcher):
   #    - analyze retrieval performance of approximate search?
   # technically we could even explore different configurations...
 
+  def get_encoder_pool(self):
+    """Get the pool of encoder processes of this process, (re)starting it if needed e.g. if
+    it was started before gunicorn forked this worker
+
+    :return: encoder pool
+    :rtype: :class:`lopq.utils.EncoderPool`
+    """
+    # Load threads may encode codes concurrently
+    with self.pools_lock:
+      if self.encoder_pool is None or not self.encoder_pool.is_usable():
+        from lopq.utils import EncoderPool
+        if self.encoder_pool is not None:
+          self.encoder_pool.close()
+        msg = "[{}.get_encoder_pool: log] Starting {} encoder processes"
+        print(msg.format(self.pp, self.num_procs))
+        self.encoder_pool = EncoderPool(self.searcher.model, self.num_procs)
+      return self.encoder_pool
+
   def compute_codes(self, det_ids, data, codes_path=None):
     """Compute codes for features in ``data`` corresponding to samples ``det_ids``
 
@@ -482,40 +835,49 @@ class SearcherLOPQHBase(GenericSearcher):
     :type data: list(:class:`numpy.ndarray`)
     :param codes_path: path to use to save codes using storer
     :type codes_path: str
-    :return: codes dictionary
-    :rtype: dict
+    :return: codes
+    :rtype: :class:`lopq.codes.CodesBatch`
     """
+    from lopq.codes import CodesBatch, dump_codes
     # Compute codes for each update batch and save them
-    #from lopq.utils import compute_codes_parallel
-    from lopq.utils import compute_codes_notparallel
     msg = "[{}.compute_codes: log] Computing codes for {} ({} unique) {}s from {} features"
     print(msg.format(self.pp, len(det_ids), len(set(det_ids)), self.input_type, len(data)))
 
-    # That keeps the ordering intact, but output is a chain
-    # Is this blocking now with gunicorn?
-    #codes = compute_codes_parallel(data, self.searcher.model, self.num_procs)
-    codes = compute_codes_notparallel(data, self.searcher.model)
+    # Encode all features at once, rows of the outputs are in the order of data
+    feats = np.reshape(data, (len(data), -1))
+    if self.num_procs > 1:
+      coarse_codes, fine_codes = self.get_encoder_pool().predict_batch(feats)
+    else:
+      coarse_codes, fine_codes = self.searcher.model.predict_batch(feats)
 
-    # Build dict output
-    codes_dict = dict()
-    count_codes = 0
-    for i, code in enumerate(codes):
-      count_codes += 1
-      codes_dict[det_ids[i]] = [code.coarse, code.fine]
+    # Some old updates have duplicate sha1s...
+    codes = CodesBatch(det_ids, coarse_codes, fine_codes).unique()
 
     if self.verbose > 3:
       msg = "[{}.compute_codes: log] Computed {} codes"
-      print(msg.format(self.pp, len(codes_dict)))
+      print(msg.format(self.pp, len(codes)))
 
-    # Save
+    # Save as codes data, i.e. arrays that are loaded without unpickling a tuple per code
     if codes_path:
-      # # Some old updates have duplicate sha1s...
-      # if self.verbose > 1 and len(codes_dict) < len(det_ids):
-      #   msg = "[{}.compute_codes: log] Saving only {} of {} codes. det_ids: {}"
-      #   print(msg.format(self.pp, len(codes_dict), count_codes, det_ids))
-      self.storer.save(codes_path, codes_dict)
+      self.storer.save(codes_path, dump_codes(codes, compression=self.codes_compression))
 
-    return codes_dict
+    return codes
+
+  def read_codes(self, codes_obj):
+    """Read the codes of an update loaded from the storer, saved as codes data or as a dictionary
+    by older versions
+
+    :param codes_obj: loaded codes
+    :type codes_obj: str, dict
+    :return: codes, None if ``codes_obj`` is not codes
+    :rtype: :class:`lopq.codes.CodesBatch`
+    """
+    from lopq.codes import CodesBatch, is_codes_data, load_codes
+    if is_codes_data(codes_obj):
+      return load_codes(codes_obj)
+    if isinstance(codes_obj, dict):
+      return CodesBatch.from_dict(codes_obj)
+    return None
 
   def add_update(self, update_id, date_db=None):
     """Add update id ``update_id`` to the database or list of update ids
@@ -525,44 +887,50 @@ class SearcherLOPQHBase(GenericSearcher):
     :param date_db: datetime to save for that update
     :type date_db: datetime
     """
-    if date_db is None:
-      date_db = datetime.now()
-    else:
-      if self.verbose > 4:
+    self.add_updates([(update_id, date_db)])
+
+  def add_updates(self, updates):
+    """Add updates to the database, in a single transaction, or list of update ids
+
+    :param updates: list of tuples (update id, datetime to save for that update or None)
+    :type updates: list
+    """
+    dtn = datetime.now()
+    updates = [(update_id, dtn if date_db is None else date_db) for update_id, date_db in updates]
+    if self.verbose > 4:
+      for update_id, date_db in updates:
         msg = "[{}.add_update: log] Saving update {} with date {}"
         print(msg.format(self.pp, update_id, date_db))
-    if self.lopq_searcher == "LOPQSearcherLMDB":
+    if self.is_persistent_searcher():
       # Use another LMDB to store updates indexed
-      with self.updates_env.begin(db=self.updates_index_db, write=True) as txn:
-        txn.put(bytes(update_id), bytes(date_db))
+      self.update_registry.add(updates)
     else:
-      self.indexed_updates.add(update_id)
-    if self.last_indexed_update is None or update_id > self.last_indexed_update:
-      self.last_indexed_update = update_id
+      self.indexed_updates.update([update_id for update_id, _ in updates])
+    for update_id, _ in updates:
+      if self.last_indexed_update is None or update_id > self.last_indexed_update:
+        self.last_indexed_update = update_id
 
   def get_update_date_db(self, update_id):
     """Get update id ``update_id`` saved date in database
 
     :param update_id: update id
     :type update_id: str
-    :raises TypeError: if self.lopq_searcher is not "LOPQSearcherLMDB"
+    :raises TypeError: if the searcher is not persistent, see ``is_persistent_searcher``
     :raises ValueError: if ``update_id`` is not in database
     """
-    if self.lopq_searcher == "LOPQSearcherLMDB":
-      with self.updates_env.begin(db=self.updates_index_db, write=False) as txn:
-        found_update = txn.get(bytes(update_id))
-        if found_update:
-          # parse found_update as string
-          if self.verbose > 4:
-            msg = "[{}.get_update_date_db: log] update {} date_db in database is: {}"
-            print(msg.format(self.pp, update_id, found_update))
-          return datetime.strptime(str(bytes(found_update)), DATE_DB_FORMAT)
-        else:
-          msg = "[{}.get_update_date_db: error] update {} is not in database"
-          raise ValueError(msg.format(self.pp, update_id))
+    if self.is_persistent_searcher():
+      date_db = self.update_registry.get_date(update_id)
+      if date_db is not None:
+        if self.verbose > 4:
+          msg = "[{}.get_update_date_db: log] update {} date_db in database is: {}"
+          print(msg.format(self.pp, update_id, date_db))
+        return date_db
+      else:
+        msg = "[{}.get_update_date_db: error] update {} is not in database"
+        raise ValueError(msg.format(self.pp, update_id))
     else:
-      msg = "[{}.get_update_date_db: error] lopq_searcher is not of type \"LOPQSearcherLMDB\""
-      raise TypeError(msg)
+      msg = "[{}.get_update_date_db: error] lopq_searcher {} is not persistent"
+      raise TypeError(msg.format(self.pp, self.lopq_searcher))
 
   def skip_update(self, update_id, dtn):
     """Check if we should skip loading update ``update_id`` because it has been marked as fully
@@ -599,14 +967,9 @@ class SearcherLOPQHBase(GenericSearcher):
     :return: True (if indexed), False (if not)
     :rtype: bool
     """
-    if self.lopq_searcher == "LOPQSearcherLMDB":
-      #  mdb_txn_begin: MDB_BAD_RSLOT: Invalid reuse of reader locktable slot?
-      with self.updates_env.begin(db=self.updates_index_db, write=False) as txn:
-        found_update = txn.get(bytes(update_id))
-        if found_update:
-          return True
-        else:
-          return False
+    if self.is_persistent_searcher():
+      # Checked in memory, without opening a LMDB transaction
+      return update_id in self.update_registry
     else:
       return update_id in self.indexed_updates
 
@@ -629,22 +992,13 @@ class SearcherLOPQHBase(GenericSearcher):
     :return: latest update suffix
     :rtype: str
     """
+    if self.last_indexed_update is None and self.is_persistent_searcher():
+      # Try to get in from DB
+      self.last_indexed_update = self.update_registry.get_latest()
     if self.last_indexed_update is None:
-      if self.lopq_searcher == "LOPQSearcherLMDB":
-        # Try to get in from DB
-        with self.updates_env.begin(db=self.updates_index_db, write=False) as txn:
-          with txn.cursor() as cursor:
-            if cursor.last():
-              item = cursor.item()
-              self.last_indexed_update = item[0]
-              suffix = '_'.join(self.last_indexed_update.split('_')[6:])
-            else:  # Would happen on empty db?
-              suffix = "1970-01-01"
-      else:
-        suffix = "1970-01-01"
-    else:
-      suffix = '_'.join(self.last_indexed_update.split('_')[6:])
-    return suffix
+      # Would happen on empty db
+      return "1970-01-01"
+    return '_'.join(self.last_indexed_update.split('_')[6:])
 
   def load_codes(self, full_refresh=False, check_all_updates=False):
     """Load codes
@@ -663,116 +1017,707 @@ class SearcherLOPQHBase(GenericSearcher):
       print(info_msg.format(self.pp))
       return
 
+    self.write_index(self.load_updates, (full_refresh, check_all_updates))
+
+  def write_index(self, load_method, args=(), wait=True):
+    """Run ``load_method`` to add codes to the index. Only one thread of a process adds codes at
+    a time, and only one process when the index is shared, the others attach to what it publishes.
+
+    :param load_method: method adding codes to the index
+    :type load_method: function
+    :param args: arguments of ``load_method``
+    :type args: tuple
+    :param wait: whether to wait for another thread of this process adding codes
+    :type wait: bool
+    :return: True if ``load_method`` was run, False otherwise
+    :rtype: bool
+    """
+    if not self.index_write_lock.acquire(wait):
+      return False
+    try:
+      if self.shared_control is None:
+        load_method(*args)
+        return True
+
+      # Only one process refreshes a shared index, the others attach to what it publishes
+      if not self.shared_control.try_lock_refresh():
+        info_msg = "[{}.write_index: info] Index is being refreshed by another process."
+        print(info_msg.format(self.pp))
+        self.sync_shared_index()
+        return False
+      try:
+        self.sync_shared_index()
+        load_method(*args)
+        last_refresh = time.mktime(self.last_refresh.timetuple()) + self.last_refresh.microsecond / 1e6
+        self.index_generation = self.shared_control.publish(self.searcher.get_nb_indexed(), last_refresh)
+      finally:
+        self.shared_control.unlock_refresh()
+      return True
+    finally:
+      self.index_write_lock.release()
+
+  def load_updates(self, full_refresh=False, check_all_updates=False):
+    """Index the codes of the updates not yet indexed, computing them if needed
+
+    :param full_refresh: whether to perform a full refresh or not
+    :type full_refresh: bool
+    :param check_all_updates: whether to check all updates, disregarding last update indexed suffix
+    :type check_all_updates: bool
+    """
     start_load = time.time()
-    total_compute_time = 0
-    total_skipped = 0
 
     try:
+      # Pick up segments written by other workers sharing the same index
+      if hasattr(self.searcher, "reload_segments"):
+        self.searcher.reload_segments()
+      # and the updates they indexed
+      if self.is_persistent_searcher():
+        self.update_registry.sync()
+
       # try to get date of last update
       start_date = "1970-01-01"
       if not full_refresh and not check_all_updates:
         start_date = self.get_latest_update_suffix()
+        if self.updates_consumer_prefix:
+          # Pushed updates are indexed out of order, older updates may still be missing
+          start_date = self.get_reconcile_date()
+      scan_time = datetime.now()
       extr_str = self.build_extr_str()
       feat_size = get_feat_size(self.featurizer_type)
       #feat_type = get_feat_dtype(self.featurizer_type)
       feat_type = self.featurizer_type
 
       # Get all updates ids for the extraction type
-      # TODO: this scan makes the API unresponsive for ~2 minutes during the update process...
+      # This scan can take minutes, the API runs refreshes in the background, see start_refresh
       msg = "[{}.load_codes: info] Looking for update of type {} since {}"
       print(msg.format(self.pp, extr_str, start_date))
-      for batch_updates in self.indexer.get_updates_from_date(start_date=start_date,
-                                                              extr_type=extr_str):
-        for update in batch_updates:
-          update_id = update[0]
-          # mdb_txn_begin: MDB_BAD_RSLOT: Invalid reuse of reader locktable slot?
-          if self.is_update_indexed(update_id) and not full_refresh:
-            total_skipped += 1
-            continue
-          else:
-            dtn = datetime.now()
-            if self.is_update_processed(update[1]) and not self.skip_update(update_id, dtn):
-              print("[{}: log] Looking for codes of update {}".format(self.pp, update_id))
-              # Get this update codes
-              codes_string = self.build_codes_string(update_id)
-              try:
-                # Check for precomputed codes
-                codes_dict = self.storer.load(codes_string, silent=True)
-                if codes_dict is None:
-                  msg = "[{}: log] Could not load codes from {}"
-                  raise ValueError(msg.format(self.pp, codes_string))
-                # If full_refresh, check that we have as many codes as available features
-                if full_refresh:
-                  # Also check for 'completed' flag?
-                  if self.indexer.get_col_listsha1s() in update[1]:
-                    set_sha1s = set(update[1][self.indexer.get_col_listsha1s()].split(','))
-                    sids, _ = self.indexer.get_features_from_sha1s(list(set_sha1s), extr_str)
-                    if len(set(sids)) > len(codes_dict):
-                      msg = "[{}: log] Update {} has {} new features"
-                      diff_count = len(set(sids)) - len(codes_dict)
-                      raise ValueError(msg.format(self.pp, update_id, diff_count))
-                    else:
-                      msg = "[{}: log] Skipping update {} indexed with all {}/{} features"
-                      print(msg.format(self.pp, update_id, len(codes_dict), len(set(sids))))
-                      miss_extr = self.indexer.get_missing_extr_sha1s(list(set_sha1s), extr_str,
-                                                                      skip_failed=self.skipfailed)
-                      # If all sha1s have been processed, no need to ever check that update again
-                      # Store that information as future date_db to avoid ever checking again...
-                      if not miss_extr and self.lopq_searcher == "LOPQSearcherLMDB":
-                        dtn = dtn.replace(year=9999)
-              except Exception as inst:
-                # Update codes not available
-                if self.verbose > 3:
-                  print(inst)
-                # Compute codes for update not yet processed and save them
-                start_compute = time.time()
-                # Get detections (if any) and features
-                if self.indexer.get_col_listsha1s() in update[1]:
-                  list_sha1s = list(set(update[1][self.indexer.get_col_listsha1s()].split(',')))
-                  sids, fts = self.indexer.get_features_from_sha1s(list_sha1s, extr_str, feat_type)
-                  if fts:
-                    if fts[0].shape[-1] != feat_size:
-                      msg = "[{}.load_codes: error] Invalid feature size {} vs {} expected"
-                      raise ValueError(msg.format(fts[0].shape[-1], feat_size))
-                    codes_dict = self.compute_codes(sids, fts, codes_string)
-                    update_compute_time = time.time() - start_compute
-                    total_compute_time += update_compute_time
-                    if self.verbose > 0:
-                      log_msg = "[{}: log] Update {} codes computation done in {}s"
-                      print(log_msg.format(self.pp, update_id, update_compute_time))
-                  else:
-                    print("[{}: warning] Update {} has no features.".format(self.pp, update_id))
-                    continue
-                else:
-                  print("[{}: warning] Update {} has no list of images.".format(self.pp, update_id))
-                  continue
-
-              # Use new method add_codes_from_dict of searcher
-              self.searcher.add_codes_from_dict(codes_dict)
-              self.add_update(update_id, date_db=dtn)
+      skipped = [0]
+      oldest_unprocessed = [None]
 
+      # Updates whose codes should be fetched, the scan runs in this thread
+      def iter_updates():
+        for batch_updates in self.indexer.get_updates_from_date(start_date=start_date,
+                                                                extr_type=extr_str):
+          for update in batch_updates:
+            update_id = update[0]
+            self.refresh_status['updates_checked'] = self.refresh_status.get('updates_checked', 0) + 1
+            if self.is_update_indexed(update_id) and not full_refresh:
+              skipped[0] += 1
+              continue
+            dtn = datetime.now()
+            if not self.is_update_processed(update[1]):
+              # Updates are scanned in order, the first unprocessed one is the oldest
+              if oldest_unprocessed[0] is None:
+                oldest_unprocessed[0] = update_id
+            elif not self.skip_update(update_id, dtn):
+              yield update, dtn
+
+      total_compute_time = self.index_updates(iter_updates(), full_refresh, extr_str, feat_type, feat_size)
       total_load = time.time() - start_load
+      # All updates since the watermark have been checked
+      if self.updates_consumer_prefix and start_date <= self.get_reconcile_date():
+        self.update_reconcile_date(scan_time, oldest_unprocessed[0])
       self.last_refresh = datetime.now()
 
-      print("[{}: log] Skipped {} updates already indexed.".format(self.pp, total_skipped))
+      print("[{}: log] Skipped {} updates already indexed.".format(self.pp, skipped[0]))
       print("[{}: log] Total udpates computation time is: {}s".format(self.pp, total_compute_time))
       print("[{}: log] Total udpates loading time is: {}s".format(self.pp, total_load))
       # Total udpates loading time is: 0.0346581935883s, really? Seems much longer
 
+      # Also saves updates pushed since the last snapshot, see load_pushed_updates
+      if self.use_snapshot and self.nb_unsaved_updates > 0:
+        self.save_all_codes()
+
     except Exception as inst:
       full_trace_error("[{}: error] Could not load codes. {}".format(self.pp, inst))
       #load_codesprint("[{}: error] Could not load codes. {}".format(self.pp, inst))
+      self.refresh_status['error'] = "{}: {}".format(type(inst), inst)
 
-  # def load_all_codes(self):
-  #   # load self.indexed_updates, self.searcher.index and self.searcher.nb_indexed
-  #   # NOT for LOPQSearcherLMDB
-  #   pass
-  #
-  # def save_all_codes(self):
-  #   # we should save self.indexed_updates, self.searcher.index and self.searcher.nb_indexed
-  #   # self.searcher.index could be big, how to save without memory issue...
-  #   # NOT for LOPQSearcherLMDB
-  #   pass
+  def index_updates(self, updates, full_refresh, extr_str, feat_type, feat_size):
+    """Add the codes of updates to the index, by batches of ``refresh_batch_size`` codes
+
+    :param updates: iterable of (update, date) tuples
+    :type updates: iterable
+    :param full_refresh: whether to check that codes cover all the features of the updates
+    :type full_refresh: bool
+    :param extr_str: extraction string
+    :type extr_str: str
+    :param feat_type: featurizer type
+    :type feat_type: str
+    :param feat_size: features size
+    :type feat_size: int
+    :return: total computation time of the codes of updates
+    :rtype: float
+    """
+    total_compute_time = 0
+    # Codes of updates are staged and added to the index by batches
+    staged_codes = []
+    staged_updates = []
+    nb_staged_codes = 0
+    # Codes are fetched ahead by the load threads, but added to the index in the updates order
+    for update_id, dtn, codes, compute_time in self.iter_updates_codes(updates, full_refresh,
+                                                                       extr_str, feat_type, feat_size):
+      total_compute_time += compute_time
+      if codes is None:
+        continue
+      if len(codes):
+        staged_codes.append(codes)
+        nb_staged_codes += len(codes)
+      staged_updates.append((update_id, dtn))
+      if nb_staged_codes >= self.refresh_batch_size:
+        self.add_staged_codes(staged_codes, staged_updates)
+        staged_codes = []
+        staged_updates = []
+        nb_staged_codes = 0
+    self.add_staged_codes(staged_codes, staged_updates)
+    return total_compute_time
+
+  def get_load_pool(self):
+    """Get the pool of threads fetching the codes of updates of this process, (re)starting it if
+    needed e.g. if it was started before gunicorn forked this worker
+
+    :return: thread pool
+    :rtype: :class:`multiprocessing.pool.ThreadPool`
+    """
+    with self.pools_lock:
+      if self.load_pool is None or self.load_pool_pid != os.getpid():
+        from multiprocessing.pool import ThreadPool
+        msg = "[{}.get_load_pool: log] Starting {} load threads"
+        print(msg.format(self.pp, self.load_threads))
+        self.load_pool = ThreadPool(self.load_threads)
+        self.load_pool_pid = os.getpid()
+      return self.load_pool
+
+  def iter_updates_codes(self, updates, full_refresh, extr_str, feat_type, feat_size):
+    """Fetch the codes of updates, up to ``load_prefetch`` updates ahead in ``load_threads``
+    threads, and yield them in the order of the updates
+
+    :param updates: iterable of (update, date) tuples
+    :type updates: iterable
+    :param full_refresh: whether to check that codes cover all the features of the updates
+    :type full_refresh: bool
+    :param extr_str: extraction string
+    :type extr_str: str
+    :param feat_type: featurizer type
+    :type feat_type: str
+    :param feat_size: features size
+    :type feat_size: int
+    :return: generator of (update id, date, codes, computation time) tuples
+    :rtype: generator
+    """
+    args = (full_refresh, extr_str, feat_type, feat_size)
+    if self.load_threads <= 1:
+      for update, dtn in updates:
+        yield (update[0],) + self.get_update_codes(update, dtn, *args)
+      return
+
+    pool = self.get_load_pool()
+    pending = deque()
+    for update, dtn in updates:
+      pending.append((update[0], pool.apply_async(self.get_update_codes, (update, dtn) + args)))
+      if len(pending) >= max(self.load_prefetch, 1):
+        update_id, result = pending.popleft()
+        # Errors of the load thread are raised here
+        yield (update_id,) + result.get()
+    while pending:
+      update_id, result = pending.popleft()
+      yield (update_id,) + result.get()
+
+  def get_update_codes(self, update, dtn, full_refresh, extr_str, feat_type, feat_size):
+    """Get the codes of an update, computing and saving them if they are not available.
+    Called by the load threads, see ``iter_updates_codes``
+
+    :param update: update id and columns
+    :type update: tuple
+    :param dtn: date the update is marked as indexed with
+    :type dtn: :class:`datetime.datetime`
+    :param full_refresh: whether to check that codes cover all the features of the update
+    :type full_refresh: bool
+    :param extr_str: extraction string
+    :type extr_str: str
+    :param feat_type: featurizer type
+    :type feat_type: str
+    :param feat_size: features size
+    :type feat_size: int
+    :return: tuple (date, codes or None if the update has no features, computation time)
+    :rtype: tuple
+    """
+    update_id = update[0]
+    compute_time = 0
+    print("[{}: log] Looking for codes of update {}".format(self.pp, update_id))
+    # Get this update codes
+    codes_string = self.build_codes_string(update_id)
+    try:
+      # Check for precomputed codes
+      codes = self.read_codes(self.storer.load(codes_string, silent=True))
+      if codes is None:
+        msg = "[{}: log] Could not load codes from {}"
+        raise ValueError(msg.format(self.pp, codes_string))
+      # If full_refresh, check that we have as many codes as available features
+      if full_refresh:
+        # Also check for 'completed' flag?
+        if self.indexer.get_col_listsha1s() in update[1]:
+          set_sha1s = set(update[1][self.indexer.get_col_listsha1s()].split(','))
+          sids, _ = self.indexer.get_features_from_sha1s(list(set_sha1s), extr_str)
+          if len(set(sids)) > len(codes):
+            msg = "[{}: log] Update {} has {} new features"
+            diff_count = len(set(sids)) - len(codes)
+            raise ValueError(msg.format(self.pp, update_id, diff_count))
+          else:
+            msg = "[{}: log] Skipping update {} indexed with all {}/{} features"
+            print(msg.format(self.pp, update_id, len(codes), len(set(sids))))
+            miss_extr = self.indexer.get_missing_extr_sha1s(list(set_sha1s), extr_str,
+                                                            skip_failed=self.skipfailed)
+            # If all sha1s have been processed, no need to ever check that update again
+            # Store that information as future date_db to avoid ever checking again...
+            if not miss_extr and self.is_persistent_searcher():
+              dtn = dtn.replace(year=9999)
+    except Exception as inst:
+      # Update codes not available
+      if self.verbose > 3:
+        print(inst)
+      # Compute codes for update not yet processed and save them
+      start_compute = time.time()
+      # Get detections (if any) and features
+      if self.indexer.get_col_listsha1s() in update[1]:
+        list_sha1s = list(set(update[1][self.indexer.get_col_listsha1s()].split(',')))
+        sids, fts = self.indexer.get_features_from_sha1s(list_sha1s, extr_str, feat_type)
+        if fts:
+          if fts[0].shape[-1] != feat_size:
+            msg = "[{}.load_codes: error] Invalid feature size {} vs {} expected"
+            raise ValueError(msg.format(fts[0].shape[-1], feat_size))
+          codes = self.compute_codes(sids, fts, codes_string)
+          compute_time = time.time() - start_compute
+          if self.verbose > 0:
+            log_msg = "[{}: log] Update {} codes computation done in {}s"
+            print(log_msg.format(self.pp, update_id, compute_time))
+        else:
+          print("[{}: warning] Update {} has no features.".format(self.pp, update_id))
+          return dtn, None, compute_time
+      else:
+        print("[{}: warning] Update {} has no list of images.".format(self.pp, update_id))
+        return dtn, None, compute_time
+
+    return dtn, codes, compute_time
+
+  def add_staged_codes(self, staged_codes, staged_updates):
+    """Add the staged codes of updates to the index at once, then mark these updates as indexed
+
+    :param staged_codes: codes of the updates, in the updates order
+    :type staged_codes: list(:class:`lopq.codes.CodesBatch`)
+    :param staged_updates: list of tuples (update id, date to save for that update)
+    :type staged_updates: list
+    """
+    if not staged_updates:
+      return
+    nb_codes = 0
+    if staged_codes:
+      from lopq.codes import CodesBatch
+      # Keep the codes of the first update of a sample, as the index does for duplicates
+      codes = CodesBatch.concatenate(staged_codes).unique()
+      nb_codes = len(codes)
+      ids = codes.ids
+      if self.id_table is not None:
+        # Index dense integer ids instead of sample id strings
+        ids = self.id_table.get_or_add_ids(ids.tolist())
+      # Codes arrays are added to the index without building a tuple per code
+      self.searcher.add_codes_arrays(codes.coarse_codes, codes.fine_codes, ids)
+    self.add_updates(staged_updates)
+    self.nb_unsaved_updates += len(staged_updates)
+    self.refresh_status['updates_indexed'] = self.refresh_status.get('updates_indexed', 0) + len(staged_updates)
+    self.refresh_status['codes_staged'] = self.refresh_status.get('codes_staged', 0) + nb_codes
+
+  def start_refresh(self, full_refresh=False, check_all_updates=False):
+    """Start a refresh of the index in a background thread, see ``load_codes``, unless a refresh
+    is already running. Searches keep being served during the refresh, use
+    ``get_refresh_status`` to follow its progress.
+
+    :param full_refresh: whether to perform a full refresh or not
+    :type full_refresh: bool
+    :param check_all_updates: whether to check all updates, disregarding last update indexed suffix
+    :type check_all_updates: bool
+    :return: True if a refresh was started, False if a refresh is already running
+    :rtype: bool
+    """
+    with self.refresh_lock:
+      if self.refresh_thread is not None and self.refresh_thread.is_alive():
+        return False
+      self.refresh_status = {'running': True, 'full_refresh': full_refresh,
+                             'check_all_updates': check_all_updates,
+                             'start_time': datetime.now().isoformat(' ')}
+      self.refresh_thread = threading.Thread(target=self.run_refresh, args=(full_refresh, check_all_updates))
+      self.refresh_thread.daemon = True
+      self.refresh_thread.start()
+      return True
+
+  def run_refresh(self, full_refresh=False, check_all_updates=False):
+    """Run a refresh of the index started by ``start_refresh``
+
+    :param full_refresh: whether to perform a full refresh or not
+    :type full_refresh: bool
+    :param check_all_updates: whether to check all updates, disregarding last update indexed suffix
+    :type check_all_updates: bool
+    """
+    try:
+      self.load_codes(full_refresh=full_refresh, check_all_updates=check_all_updates)
+    except Exception as inst:
+      full_trace_error("[{}.run_refresh: error] Refresh failed. {}".format(self.pp, inst))
+      self.refresh_status['error'] = "{}: {}".format(type(inst), inst)
+    finally:
+      self.refresh_status['end_time'] = datetime.now().isoformat(' ')
+      self.refresh_status['running'] = False
+
+  def get_refresh_status(self):
+    """Get the progress of the current or last background refresh
+
+    :return: refresh status
+    :rtype: dict
+    """
+    self.start_refresh_scheduler()
+    status = dict(self.refresh_status)
+    status['last_refresh_time'] = self.get_last_refresh().isoformat(' ')
+    return status
+
+  def start_refresh_scheduler(self):
+    """Start the thread refreshing the index every ``refresh_interval`` seconds and the updates
+    consumer, if enabled and not yet started by this process. Threads do not survive gunicorn
+    forking its workers, the API starts them in each worker, see ``api.gunicorn_conf``
+    """
+    self.start_updates_consumer()
+    if not self.refresh_interval or self.refresh_scheduler_pid == os.getpid():
+      return
+    self.refresh_scheduler_pid = os.getpid()
+
+    # When updates are pushed, periodic refreshes start from the reconciliation watermark
+    def schedule_refresh():
+      while True:
+        time.sleep(self.refresh_interval)
+        self.start_refresh()
+
+    scheduler = threading.Thread(target=schedule_refresh)
+    scheduler.daemon = True
+    scheduler.start()
+
+  def get_reconcile_date(self):
+    """Get the date from which refreshes check updates when updates are pushed, i.e. the
+    reconciliation watermark. All updates are checked by the first refresh of a process
+
+    :return: date, formatted as YYYY-MM-DD
+    :rtype: str
+    """
+    if self.reconcile_date is None:
+      return "1970-01-01"
+    return self.reconcile_date
+
+  def update_reconcile_date(self, scan_time, oldest_unprocessed=None):
+    """Move the reconciliation watermark after a refresh checked all updates since the current
+    one. Pushed updates may be lost, or not processed in time, see ``load_pushed_updates``: the
+    next refreshes check updates since the oldest update still pending or seen unprocessed by the
+    refresh, or since the refresh started, minus ``reconcile_margin`` days
+
+    :param scan_time: time the refresh started scanning updates
+    :type scan_time: :class:`datetime.datetime`
+    :param oldest_unprocessed: oldest update seen unprocessed by the refresh
+    :type oldest_unprocessed: str
+    """
+    update_ids = list(self.pushed_updates.keys())
+    if oldest_unprocessed is not None:
+      update_ids.append(oldest_unprocessed)
+    dates = [scan_time]
+    try:
+      for update_id in update_ids:
+        # Update ids end with their date YYYY-MM-DD and a counter, see get_latest_update_suffix
+        dates.append(datetime.strptime(update_id.split('_')[-2], '%Y-%m-%d'))
+    except (IndexError, ValueError) as inst:
+      msg = "[{}.update_reconcile_date: warning] Keeping watermark {}. {}"
+      print(msg.format(self.pp, self.get_reconcile_date(), inst))
+      return
+    self.reconcile_date = (min(dates) - timedelta(days=self.reconcile_margin)).strftime('%Y-%m-%d')
+    if self.verbose > 1:
+      print("[{}.update_reconcile_date: log] Watermark is {}".format(self.pp, self.reconcile_date))
+
+  def start_updates_consumer(self):
+    """Start the thread consuming the updates topic, see ``consume_updates``, if enabled and not
+    yet started by this process
+    """
+    if not self.updates_consumer_prefix or self.updates_consumer_pid == os.getpid():
+      return
+    self.updates_consumer_pid = os.getpid()
+    consumer = threading.Thread(target=self.consume_updates)
+    consumer.daemon = True
+    consumer.start()
+
+  def consume_updates(self):
+    """Consume the updates pushed by the extraction checker to its updates topic, as messages
+    ``{update_id: list_sha1s}``, and index them as soon as their extraction is processed.
+
+    Updates are pushed when created, before being processed, so they are kept pending and checked
+    in HBase every ``updates_check_interval`` seconds. Messages may be lost e.g. if the process
+    dies, periodic refreshes then index the missed updates.
+
+    The processes sharing an index can share a consumer group, each message being indexed once
+    in the shared index. Otherwise each process indexes all updates in its own index: the
+    ``consumer_group`` is dropped, the consumer reading all partitions.
+    """
+    from ..ingester.generic_kafka_processor import GenericKafkaProcessor
+    conf = self.global_conf
+    group_key = self.updates_consumer_prefix + 'consumer_group'
+    if not self.shared_index and conf.get(group_key):
+      msg = "[{}.consume_updates: warning] Ignoring '{}', the index of each process needs all updates"
+      print(msg.format(self.pp, group_key))
+      conf = dict(conf)
+      del conf[group_key]
+    try:
+      ingester = GenericKafkaProcessor(conf, prefix=self.updates_consumer_prefix)
+      if ingester.consumer is None:
+        raise ValueError("No 'consumer_topics' in configuration")
+    except Exception as inst:
+      msg = "[{}.consume_updates: error] Could not start updates consumer. {}"
+      full_trace_error(msg.format(self.pp, inst))
+      return
+
+    extr_str = self.build_extr_str()
+    last_check = 0
+    while True:
+      try:
+        nb_new = 0
+        for msgs in ingester.consumer.poll(timeout_ms=1000).values():
+          for msg in msgs:
+            for update_id in json.loads(msg.value):
+              # Same filtering of other extractions updates as get_updates_from_date
+              if extr_str in update_id and update_id not in self.pushed_updates:
+                self.pushed_updates[update_id] = time.time()
+                nb_new += 1
+        if self.pushed_updates and (nb_new or time.time() - last_check > self.updates_check_interval):
+          last_check = time.time()
+          # Pushed updates are left pending while a refresh is running
+          self.write_index(self.load_pushed_updates, wait=False)
+      except Exception as inst:
+        full_trace_error("[{}.consume_updates: error] {}".format(self.pp, inst))
+        time.sleep(self.updates_check_interval)
+
+  def load_pushed_updates(self):
+    """Index the pushed updates that have been processed, see ``consume_updates``
+    """
+    extr_str = self.build_extr_str()
+    feat_size = get_feat_size(self.featurizer_type)
+    feat_type = self.featurizer_type
+    if self.is_persistent_searcher():
+      self.update_registry.sync()
+
+    updates = []
+    update_ids = sorted(self.pushed_updates)
+    for update in self.indexer.get_rows_by_batch(update_ids, self.indexer.table_updateinfos_name):
+      if self.is_update_indexed(update[0]):
+        del self.pushed_updates[update[0]]
+      elif self.is_update_processed(update[1]):
+        del self.pushed_updates[update[0]]
+        updates.append((update, datetime.now()))
+    for update_id in update_ids:
+      if update_id in self.pushed_updates and time.time() - self.pushed_updates[update_id] > MAX_PENDING_UPDATE_AGE:
+        msg = "[{}.load_pushed_updates: warning] Update {} not processed, leaving it to refreshes"
+        print(msg.format(self.pp, update_id))
+        del self.pushed_updates[update_id]
+
+    if updates:
+      start_load = time.time()
+      self.index_updates(updates, False, extr_str, feat_type, feat_size)
+      self.last_refresh = datetime.now()
+      msg = "[{}.load_pushed_updates: log] Indexed {} pushed updates in {:0.3}s, {} still pending"
+      print(msg.format(self.pp, len(updates), time.time() - start_load, len(self.pushed_updates)))
+
+  def build_snapshot_str(self):
+    """Build the prefix of the snapshot files of the index
+
+    :return: snapshot string
+    :rtype: str
+    """
+    return self.build_index_str() + "_snapshot/"
+
+  def can_snapshot(self):
+    """Check if the index can be saved by ``save_all_codes``, i.e. is kept in memory only and
+    its searcher supports snapshots
+
+    :return: True if the index can be saved
+    :rtype: bool
+    """
+    return not self.is_persistent_searcher() and hasattr(self.searcher, "save_snapshot")
+
+  def get_snapshot_control(self):
+    """Get the control block of the snapshots of the index, shared by all the processes of this
+    host serving it: its refresh lock is held while saving a snapshot and it records the time of
+    the last snapshot
+
+    :return: snapshot control block
+    :rtype: :class:`SharedControl`
+    """
+    if self.snapshot_control is None:
+      from .shared_control import SharedControl
+      self.snapshot_control = SharedControl('/data/snapshot_control_' + self.build_index_str())
+    return self.snapshot_control
+
+  def load_all_codes(self):
+    """Restore the index, the indexed updates and the id table from the snapshot saved by
+    ``save_all_codes``. The snapshot file is downloaded then read once sequentially.
+
+    :return: True if a snapshot was restored, False otherwise
+    :rtype: bool
+    """
+    if not self.searcher or not self.can_snapshot():
+      return False
+    snapshot_str = self.build_snapshot_str()
+    meta = self.storer.load(snapshot_str + "meta", silent=True)
+    if meta is None:
+      print("[{}.load_all_codes: log] No snapshot found at {}".format(self.pp, snapshot_str))
+      return False
+
+    from lopq.segment import LOPQSegment
+    start_load = time.time()
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix="lopq_snapshot_")
+    os.close(tmp_fd)
+    try:
+      # Snapshots saved before indexes were versioned have no 'index_key'
+      self.storer.load_file(snapshot_str + meta.get('index_key', "index.lopq"), tmp_path)
+      # Sanity check, meta points to the index it was saved with
+      nb_codes = len(LOPQSegment(tmp_path))
+      if nb_codes != meta['nb_indexed']:
+        msg = "snapshot index has {} codes but {} are expected"
+        raise ValueError(msg.format(nb_codes, meta['nb_indexed']))
+      if self.id_table is not None:
+        self.id_table.set_state(meta['id_table'])
+      # The index is only replaced once the snapshot has been read
+      self.searcher.load_snapshot(tmp_path)
+      self.indexed_updates = set(meta['indexed_updates'])
+      self.last_indexed_update = meta['last_indexed_update']
+    except Exception as inst:
+      # All updates will then be loaded by load_codes
+      full_trace_error("[{}.load_all_codes: error] Could not restore snapshot. {}".format(self.pp, inst))
+      return False
+    finally:
+      os.remove(tmp_path)
+
+    msg = "[{}.load_all_codes: log] Restored {} codes of {} updates from snapshot in {:0.3}s"
+    print(msg.format(self.pp, meta['nb_indexed'], len(self.indexed_updates), time.time() - start_load))
+    return True
+
+  def save_all_codes(self):
+    """Save the index, the indexed updates and the id table as a snapshot, restored by
+    ``load_all_codes``. The index is written cell by cell to a local file that is then streamed
+    to the storer, so it is never copied in memory.
+
+    All the processes serving the index hold the same updates, so only one of them saves a
+    snapshot at a time, at most every ``snapshot_interval`` seconds. The index is saved under a
+    new key that ``meta``, written last, points to: a restore always reads an index and a meta
+    of the same snapshot. The index of the previous snapshot is kept for restores in progress,
+    older ones are deleted.
+
+    :return: True if a snapshot was saved, False otherwise
+    :rtype: bool
+    """
+    if not self.searcher or not self.can_snapshot():
+      return False
+    snapshot_control = self.get_snapshot_control()
+    if not snapshot_control.try_lock_refresh():
+      print("[{}.save_all_codes: log] Snapshot being saved by another process".format(self.pp))
+      return False
+    try:
+      _, _, last_snapshot, saver_pid = snapshot_control.read()
+      if time.time() - last_snapshot < self.snapshot_interval:
+        msg = "[{}.save_all_codes: log] Skipping snapshot, last one saved {:0.1f}s ago by process {}"
+        print(msg.format(self.pp, time.time() - last_snapshot, saver_pid))
+        return False
+      return self.write_snapshot(snapshot_control)
+    finally:
+      snapshot_control.unlock_refresh()
+
+  def write_snapshot(self, snapshot_control):
+    """Write a snapshot of the index, see ``save_all_codes``. Should only be called by the process
+    holding the refresh lock of ``snapshot_control``.
+
+    :param snapshot_control: snapshot control block
+    :type snapshot_control: :class:`SharedControl`
+    :return: True if a snapshot was saved, False otherwise
+    :rtype: bool
+    """
+    snapshot_str = self.build_snapshot_str()
+    start_save = time.time()
+    prev_meta = self.storer.load(snapshot_str + "meta", silent=True)
+    index_key = "index_{}_{}.lopq".format(datetime.now().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix="lopq_snapshot_")
+    os.close(tmp_fd)
+    try:
+      self.searcher.save_snapshot(tmp_path)
+      self.storer.save_file(snapshot_str + index_key, tmp_path)
+      meta = {'nb_indexed': self.searcher.get_nb_indexed(),
+              'index_key': index_key,
+              'prev_index_key': prev_meta.get('index_key') if prev_meta else None,
+              'indexed_updates': sorted(self.indexed_updates),
+              'last_indexed_update': self.last_indexed_update,
+              'id_table': self.id_table.get_state() if self.id_table is not None else None}
+      self.storer.save(snapshot_str + "meta", meta)
+      self.nb_unsaved_updates = 0
+      snapshot_control.publish(meta['nb_indexed'], time.time())
+    except Exception as inst:
+      full_trace_error("[{}.save_all_codes: error] Could not save snapshot. {}".format(self.pp, inst))
+      return False
+    finally:
+      os.remove(tmp_path)
+
+    # The index of the previous snapshot may still be downloaded by a restore
+    if prev_meta and prev_meta.get('prev_index_key'):
+      try:
+        self.storer.delete(snapshot_str + prev_meta['prev_index_key'])
+      except Exception as inst:
+        msg = "[{}.save_all_codes: warning] Could not delete old snapshot index {}. {}"
+        print(msg.format(self.pp, prev_meta['prev_index_key'], inst))
+
+    msg = "[{}.save_all_codes: log] Saved snapshot of {} codes in {:0.3}s"
+    print(msg.format(self.pp, meta['nb_indexed'], time.time() - start_save))
+    return True
+
+  def search_batch_feats(self, keys, feats, quota, max_returned):
+    """Search the index with all features ``feats`` at once
+
+    :param keys: list of keys identifying each query feature
+    :type keys: list
+    :param feats: list of features
+    :type feats: list
+    :param quota: number of results to rank for each query
+    :type quota: int
+    :param max_returned: number of results to return for each query
+    :type max_returned: int
+    :return: dictionary mapping each key to the tuple (results, normalized feature, sha1s of the
+      results)
+    :rtype: dict
+    """
+    batch_results = dict()
+    if not self.searcher or not keys:
+      return batch_results
+
+    start_search = time.time()
+    # Normalize features first as it is how it is done during extraction...
+    normed_feats = []
+    for feat in feats:
+      norm_feat = np.linalg.norm(feat)
+      normed_feats.append(np.squeeze(feat / norm_feat))
+    all_results, all_visited = self.searcher.search_batch(np.asarray(normed_feats), quota=quota,
+                                                          limit=max_returned, with_dists=True,
+                                                          cell_cutoff=self.cell_cutoff)
+    search_time = time.time() - start_search
+    res_msg = "[{}.search_batch_feats: log] Got {} results by visiting {} cells in: {:0.3}s"
+    print(res_msg.format(self.pp, sum([len(r) for r in all_results]), sum(all_visited), search_time))
+
+    for key, normed_feat, results in zip(keys, normed_feats, all_results):
+      res_ids = [res.id for res in results]
+      if self.id_table is not None:
+        # Only the final top results are mapped back from integer ids to sample ids
+        sha1s = self.id_table.get_sha1s(res_ids)
+        sample_ids = self.id_table.resolve(res_ids)
+        results = [res._replace(id=sample_id) for res, sample_id in zip(results, sample_ids)]
+      else:
+        sha1s = [str(res_id).split('_')[0] for res_id in res_ids]
+      batch_results[key] = (results, normed_feat, sha1s)
+    return batch_results
 
   def search_from_feats(self, dets, feats, options_dict=dict()):
     """Search the index using features ``feats`` of samples ``dets``
@@ -790,6 +1735,9 @@ class SearcherLOPQHBase(GenericSearcher):
     import time
     # For multi-workers setting with gunicorn
     self.set_pp(pp="SearcherLOPQHBase." + str(os.getpid()))
+    # Pick up the latest index published by the refresher of a shared index
+    self.sync_shared_index()
+    self.start_refresh_scheduler()
 
     start_search = time.time()
     extr_str = self.build_extr_str()
@@ -832,6 +1780,16 @@ class SearcherLOPQHBase(GenericSearcher):
 
     # print dets
     if self.detector is not None:
+      # Search all faces of all images in one batch
+      batch_keys = []
+      batch_feats = []
+      if "detect_only" not in options_dict or not options_dict["detect_only"]:
+        for i in range(len(dets)):
+          for j in range(len(dets[i][1])):
+            batch_keys.append((i, j))
+            batch_feats.append(feats[i][j])
+      batch_results = self.search_batch_feats(batch_keys, batch_feats, quota, max_returned)
+
       # query for each feature
       for i in range(len(dets)):
 
@@ -841,16 +1799,9 @@ class SearcherLOPQHBase(GenericSearcher):
 
         for j in range(len(dets[i][1])):
           results = []
-          if "detect_only" not in options_dict or not options_dict["detect_only"]:
-            if self.searcher:
-              # Normalize feature first as it is how it is done during extraction...
-              norm_feat = np.linalg.norm(feats[i][j])
-              normed_feat = np.squeeze(feats[i][j] / norm_feat)
-              results, visited = self.searcher.search(normed_feat, quota=quota, limit=max_returned,
-                                                      with_dists=True)
-              res_msg = "[{}.search_from_feats: log] Got {} results by visiting {} cells in: {:0.3}s"
-              search_time = time.time() - start_search
-              print(res_msg.format(self.pp, len(results), visited, search_time))
+          results_sha1s = []
+          if (i, j) in batch_results:
+            results, normed_feat, results_sha1s = batch_results[(i, j)]
 
           # If reranking, get features from hbase for detections using res.id
           #   we could also already get 's3_url' to avoid a second call to HBase later...
@@ -858,7 +1809,7 @@ class SearcherLOPQHBase(GenericSearcher):
             try:
               start_rerank = time.time()
               results = results[:min(curr_rerank_nb, len(results))]
-              res_list_sha1s = [str(x.id).split('_')[0] for x in results]
+              res_list_sha1s = results_sha1s[:len(results)]
               res_sids, res_fts = self.indexer.get_features_from_sha1s(res_list_sha1s, extr_str,
                                                                        feat_type)
               msg = "[{}: log] Retrieved {}/{} features for re-ranking in {:0.3}s"
@@ -887,7 +1838,7 @@ class SearcherLOPQHBase(GenericSearcher):
               if not max_returned or (max_returned and ires < max_returned):
                 tmp_dets_sim_ids.append(res.id)
                 # here id would be face_id that we could build as sha1_facebbox?
-                tmp_img_sim.append(str(res.id).split('_')[0])
+                tmp_img_sim.append(results_sha1s[ires])
                 tmp_dets_sim_score.append(dist)
 
           # If reranking, we need to reorder
@@ -951,16 +1902,12 @@ class SearcherLOPQHBase(GenericSearcher):
       sim_images = []
       sim_score = []
 
+      # Search all images in one batch
+      batch_results = self.search_batch_feats(range(len(feats)), feats, quota, max_returned)
+
       for i in range(len(feats)):
-        if self.searcher:
-          # Normalize feature first as it is how it is done during extraction...
-          norm_feat = np.linalg.norm(feats[i])
-          normed_feat = np.squeeze(feats[i] / norm_feat)
-          results, visited = self.searcher.search(normed_feat, quota=quota, limit=max_returned,
-                                                  with_dists=True)
-          res_msg = "[{}.search_from_feats: log] Got {} results by visiting {} cells in: {:0.3}s"
-          search_time = time.time() - start_search
-          print(res_msg.format(self.pp, len(results), visited, search_time))
+        if i in batch_results:
+          results, normed_feat, _ = batch_results[i]
 
         # Reranking, get features from hbase for detections using res.id
         if curr_reranking:
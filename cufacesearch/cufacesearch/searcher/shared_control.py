@@ -0,0 +1,111 @@
+from __future__ import print_function
+
+import os
+import mmap
+import time
+import fcntl
+import errno
+import struct
+
+# Layout of the control block: generation, number of indexed codes, last refresh time
+# (seconds since epoch) and pid of the last refresher
+CONTROL_FORMAT = '<QQdI'
+CONTROL_SIZE = struct.calcsize(CONTROL_FORMAT)
+
+
+class SharedControl(object):
+  """Small control block shared through a memory-mapped file by all the processes serving the
+  same index, e.g. gunicorn workers.
+
+  One process at a time holds the refresh lock and refreshes the index, then publishes a new
+  generation of the index. The other processes poll the generation and attach to the new one.
+  Writes follow a sequence lock protocol: the generation is odd while the block is written, so
+  readers never see a partially written block.
+  """
+
+  def __init__(self, path):
+    """SharedControl constructor
+
+    :param path: path of the control block file, created if it does not exist
+    :type path: str
+    """
+    self.path = path
+    self.lock_path = path + ".lock"
+    self.lock_file = None
+    self.lock_pid = None
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      if os.fstat(fd).st_size < CONTROL_SIZE:
+        # New file, the block is zero filled, i.e. generation 0
+        os.ftruncate(fd, CONTROL_SIZE)
+      self.block = mmap.mmap(fd, CONTROL_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    finally:
+      os.close(fd)
+
+  def read(self):
+    """Read the control block
+
+    :return: tuple (generation, number of indexed codes, last refresh time, refresher pid)
+    :rtype: tuple
+    """
+    while True:
+      values = struct.unpack_from(CONTROL_FORMAT, self.block)
+      generation = values[0]
+      # Retry if the block is being written or was written meanwhile
+      if generation % 2 == 0 and struct.unpack_from('<Q', self.block)[0] == generation:
+        return values
+      time.sleep(0.001)
+
+  def get_generation(self):
+    """Get the current generation of the index, without reading the whole block
+
+    :return: generation
+    :rtype: int
+    """
+    return struct.unpack_from('<Q', self.block)[0]
+
+  def publish(self, nb_indexed, last_refresh):
+    """Publish a new generation of the index. Should only be called by the process holding the
+    refresh lock.
+
+    :param nb_indexed: number of indexed codes
+    :type nb_indexed: int
+    :param last_refresh: time of the refresh, in seconds since epoch
+    :type last_refresh: float
+    :return: the new generation
+    :rtype: int
+    """
+    generation = self.get_generation()
+    if generation % 2:
+      # A refresher died while writing the block
+      generation += 1
+    struct.pack_into('<Q', self.block, 0, generation + 1)
+    struct.pack_into(CONTROL_FORMAT, self.block, 0, generation + 1, nb_indexed, last_refresh, os.getpid())
+    struct.pack_into('<Q', self.block, 0, generation + 2)
+    self.block.flush()
+    return generation + 2
+
+  def try_lock_refresh(self):
+    """Try to take the refresh lock, without waiting. The lock is released if the process dies.
+
+    :return: True if the lock was taken, False if another process holds it
+    :rtype: bool
+    """
+    # flock locks are shared by file descriptors inherited through fork, so each process
+    # opens its own
+    if self.lock_pid != os.getpid():
+      self.lock_file = open(self.lock_path, 'a')
+      self.lock_pid = os.getpid()
+    try:
+      fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return True
+    except IOError as inst:
+      if inst.errno in [errno.EAGAIN, errno.EACCES]:
+        return False
+      raise
+
+  def unlock_refresh(self):
+    """Release the refresh lock taken by ``try_lock_refresh``
+    """
+    if self.lock_pid == os.getpid():
+      fcntl.flock(self.lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,111 @@
+from __future__ import print_function
+
+import threading
+from datetime import datetime
+
+DATE_DB_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Dates saved as str(datetime) before the registry, without microseconds when they are zero
+DATE_DB_FORMAT_NO_MICROSECONDS = '%Y-%m-%d %H:%M:%S'
+
+
+class UpdateRegistry(object):
+  """Registry of the updates indexed by a searcher and of the date saved for each of them.
+
+  All update ids and dates are loaded in memory once, so checking whether an update is indexed
+  does not open a LMDB transaction. Added updates are written through to the LMDB, one write
+  transaction per call of ``add``.
+  """
+
+  def __init__(self, lmdb_path=None, map_size=1024 * 1000000 * 1):
+    """UpdateRegistry constructor
+
+    :param lmdb_path: path of the LMDB persisting the registry, in memory only if None
+    :type lmdb_path: str
+    :param map_size: LMDB map size
+    :type map_size: int
+    """
+    self.lock = threading.Lock()
+    self.dates = dict()
+    self.latest = None
+    self.env = None
+    # Id of the last LMDB transaction reflected in memory, see sync
+    self.txn_id = None
+    if lmdb_path is not None:
+      import lmdb
+      # Again (see lopq.search LOPQSearcherLMDB), should we use writemap=True or not
+      self.env = lmdb.open(lmdb_path, map_size=map_size, max_dbs=1)
+      self.updates_db = self.env.open_db("updates")
+      self.sync()
+
+  def __len__(self):
+    return len(self.dates)
+
+  def __contains__(self, update_id):
+    return bytes(update_id) in self.dates
+
+  def sync(self):
+    """Reload the registry if the LMDB was written by another process, e.g. by the process
+    previously refreshing a shared index. Any committed write transaction triggers a reload, as
+    dates of updates already in the registry can be overwritten, see ``SearcherLOPQHBase.skip_update``
+    """
+    if self.env is None:
+      return
+    with self.lock:
+      with self.env.begin(db=self.updates_db, write=False) as txn:
+        # A read transaction sees the last committed write transaction, and has its id
+        if txn.id() == self.txn_id:
+          return
+        txn_id = txn.id()
+        with txn.cursor() as cursor:
+          items = [(bytes(key), bytes(value)) for key, value in cursor]
+      self.txn_id = txn_id
+      self.dates = dict(items)
+      # Keys are sorted, the latest update is the last one
+      self.latest = items[-1][0] if items else None
+
+  def add(self, updates):
+    """Add updates to the registry, in a single LMDB write transaction
+
+    :param updates: list of tuples (update id, datetime to save for that update)
+    :type updates: list
+    """
+    updates = [(bytes(update_id), date_db.strftime(DATE_DB_FORMAT)) for update_id, date_db in updates]
+    if not updates:
+      return
+    with self.lock:
+      if self.env is not None:
+        with self.env.begin(db=self.updates_db, write=True) as txn:
+          write_txn_id = txn.id()
+          for update_id, date_db in updates:
+            txn.put(update_id, date_db)
+        # Memory is still in sync with the LMDB if no other process wrote since the last sync
+        if self.txn_id == write_txn_id - 1:
+          self.txn_id = write_txn_id
+      for update_id, date_db in updates:
+        self.dates[update_id] = date_db
+        if self.latest is None or update_id > self.latest:
+          self.latest = update_id
+
+  def get_date(self, update_id):
+    """Get the date saved for an update
+
+    :param update_id: update id
+    :type update_id: str
+    :return: date saved for that update, None if the update is not in the registry
+    :rtype: :class:`datetime.datetime`
+    """
+    date_db = self.dates.get(bytes(update_id))
+    if date_db is None:
+      return None
+    try:
+      return datetime.strptime(date_db, DATE_DB_FORMAT)
+    except ValueError:
+      return datetime.strptime(date_db, DATE_DB_FORMAT_NO_MICROSECONDS)
+
+  def get_latest(self):
+    """Get the latest indexed update, i.e. the greatest update id
+
+    :return: update id, None if the registry is empty
+    :rtype: str
+    """
+    return self.latest
@@ -67,6 +67,37 @@ class GenericStorer(ConfReader):
     """
     raise NotImplementedError()
 
+  def save_file(self, key, file_path):
+    """Save local file ``file_path`` as is to ``key``, streaming its content
+
+    :param key: location to save
+    :type key: str
+    :param file_path: path of the local file
+    :type file_path: str
+    :raises NotImplementedError: if not implemented
+    """
+    raise NotImplementedError()
+
+  def load_file(self, key, file_path):
+    """Load content saved with ``save_file`` at ``key`` to local file ``file_path``
+
+    :param key: location
+    :type key: str
+    :param file_path: path of the local file
+    :type file_path: str
+    :raises NotImplementedError: if not implemented
+    """
+    raise NotImplementedError()
+
+  def delete(self, key):
+    """Delete the object or file at ``key``
+
+    :param key: location
+    :type key: str
+    :raises NotImplementedError: if not implemented
+    """
+    raise NotImplementedError()
+
   # This would be used to load all codes
   def get_all_from_prefix(self, prefix_path):
     """Get all objects in ``prefix_path`` (generator)
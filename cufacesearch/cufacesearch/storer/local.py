@@ -1,5 +1,6 @@
 import os
 import glob
+import shutil
 import cPickle as pickle
 from cufacesearch.storer.generic_storer import GenericStorer
 from cufacesearch.common.dl import mkpath
@@ -55,7 +56,8 @@ class LocalStorer(GenericStorer):
     # Pickle and save to disk
     full_path = self.get_full_path(key)
     mkpath(full_path)
-    pickle.dump(obj, open(full_path, 'wb'))
+    # Binary protocol, so that strings e.g. codes data are stored as is
+    pickle.dump(obj, open(full_path, 'wb'), pickle.HIGHEST_PROTOCOL)
     if self.verbose > 1:
       print "[{}: log] Saved file: {}".format(self.pp, full_path)
 
@@ -82,6 +84,46 @@ class LocalStorer(GenericStorer):
         print(err_msg.format(self.pp, type(e), e, full_path))
 
 
+  def save_file(self, key, file_path):
+    """Save local file ``file_path`` as is at location ``key``
+
+    :param key: location to save
+    :type key: str
+    :param file_path: path of the local file
+    :type file_path: str
+    """
+    full_path = self.get_full_path(key)
+    mkpath(full_path)
+    # Copy then rename so the file at full_path is never seen partially written
+    shutil.copyfile(file_path, full_path + ".tmp")
+    os.rename(full_path + ".tmp", full_path)
+    if self.verbose > 1:
+      print("[{}: log] Saved file: {}".format(self.pp, full_path))
+
+  def load_file(self, key, file_path):
+    """Load file at location ``key`` to local file ``file_path``
+
+    :param key: location
+    :type key: str
+    :param file_path: path of the local file
+    :type file_path: str
+    """
+    full_path = self.get_full_path(key)
+    shutil.copyfile(full_path, file_path)
+    if self.verbose > 1:
+      print("[{}: log] Loaded file: {}".format(self.pp, full_path))
+
+  def delete(self, key):
+    """Delete the file at location ``key``
+
+    :param key: location
+    :type key: str
+    """
+    full_path = self.get_full_path(key)
+    os.remove(full_path)
+    if self.verbose > 1:
+      print("[{}: log] Deleted file: {}".format(self.pp, full_path))
+
   def list_prefix(self, prefix_path):
     """List all objects starting with ``prefix_path``
 
@@ -1,3 +1,4 @@
+import threading
 import boto3
 import botocore
 # TODO: use botocore to properly catch exceptions as below...
@@ -40,6 +41,9 @@ class S3Storer(GenericStorer):
     # we can define a prefix, i.e. folder in a bucket as a parameter
     self.aws_prefix = self.get_param('aws_prefix', default='')
     self.session = None
+    # boto3 resources are not thread safe, each thread e.g. loading codes gets its own
+    self.local = threading.local()
+    self.session_lock = threading.Lock()
     #self.transferConfig = TransferConfig(use_threads=False)
 
     try:
@@ -52,6 +56,7 @@ class S3Storer(GenericStorer):
     """
     self.session = boto3.Session(profile_name=self.aws_profile, region_name=self.region)
     self.s3 = self.session.resource('s3')
+    self.local.s3 = self.s3
     # Try to access first to make sure
     try:
       self.s3.meta.client.head_bucket(Bucket=self.bucket_name)
@@ -64,6 +69,20 @@ class S3Storer(GenericStorer):
       msg = "[{}: log] Initialized with bucket '{}' and profile '{}' in region '{}'."
       print(msg.format(self.pp, self.bucket_name, self.aws_profile, self.region))
 
+  def get_s3(self):
+    """Get the S3 resource of the calling thread
+
+    :return: S3 resource
+    :rtype: :class:`boto3.resources.base.ServiceResource`
+    """
+    s3 = getattr(self.local, 's3', None)
+    if s3 is None:
+      # Sessions are not thread safe either
+      with self.session_lock:
+        s3 = self.session.resource('s3')
+      self.local.s3 = s3
+    return s3
+
   def _get_s3obj_key_noprefix(self, s3_obj):
     """Get clean object key from s3 object
 
@@ -89,12 +108,13 @@ class S3Storer(GenericStorer):
     """
     # Pickle and save to s3 bucket
     #buffer = sio.StringIO(pickle.dumps(obj))
-    buffer = sio(pickle.dumps(obj))
+    # Binary protocol, so that strings e.g. codes data are stored as is
+    buffer = sio(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
     save_key = key
     if self.aws_prefix:
       save_key = '/'.join([self.aws_prefix, key])
     # TODO: Can this fail? Can we check if it was successful?
-    self.bucket.upload_fileobj(buffer, save_key)
+    self.get_s3().Bucket(self.bucket_name).upload_fileobj(buffer, save_key)
     if self.verbose > 2:
       print("[{}: log] Saved file: {}".format(self.pp, save_key))
 
@@ -120,7 +140,7 @@ class S3Storer(GenericStorer):
       #self.bucket.download_fileobj(load_key, buffer)
       # Other solution with TransferConfig
       #self.bucket.download_fileobj(load_key, buffer, Config=self.transferConfig)
-      resp = self.s3.Object(bucket_name=self.bucket_name, key=load_key)
+      resp = self.get_s3().Object(bucket_name=self.bucket_name, key=load_key)
       # Try to access 'content_length' to generate an 404 error if not found
       if resp.content_length == 0:
         return None
@@ -136,6 +156,50 @@ class S3Storer(GenericStorer):
         err_msg = "[{}: error ({}: {})] Could not load object with key: {}"
         print(err_msg.format(self.pp, type(e), e, load_key))
 
+  def save_file(self, key, file_path):
+    """Save local file ``file_path`` as is at location ``key``, using a multipart upload for
+    large files
+
+    :param key: location to save
+    :type key: str
+    :param file_path: path of the local file
+    :type file_path: str
+    """
+    save_key = key
+    if self.aws_prefix:
+      save_key = '/'.join([self.aws_prefix, key])
+    self.bucket.upload_file(file_path, save_key)
+    if self.verbose > 2:
+      print("[{}: log] Saved file: {}".format(self.pp, save_key))
+
+  def load_file(self, key, file_path):
+    """Load file at location ``key`` to local file ``file_path``
+
+    :param key: location
+    :type key: str
+    :param file_path: path of the local file
+    :type file_path: str
+    """
+    load_key = key
+    if self.aws_prefix:
+      load_key = '/'.join([self.aws_prefix, key])
+    self.bucket.download_file(load_key, file_path)
+    if self.verbose > 2:
+      print("[{}: log] Loaded file: {}".format(self.pp, load_key))
+
+  def delete(self, key):
+    """Delete the object at location ``key``
+
+    :param key: location
+    :type key: str
+    """
+    delete_key = key
+    if self.aws_prefix:
+      delete_key = '/'.join([self.aws_prefix, key])
+    self.get_s3().Object(bucket_name=self.bucket_name, key=delete_key).delete()
+    if self.verbose > 2:
+      print("[{}: log] Deleted file: {}".format(self.pp, delete_key))
+
   def list_prefix(self, prefix_path):
     """List all objects starting with ``prefix_path``
 
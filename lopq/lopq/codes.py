@@ -0,0 +1,204 @@
+# Versioned binary format of the LOPQ codes of a batch of items, e.g. of one update.
+#
+# Codes data is made of, in order:
+#   - a fixed size header (see CODES_HEADER_DTYPE), padded to CODES_HEADER_SIZE bytes
+#   - the payload, compressed with zlib if the header compression is 'zlib', made of:
+#     - the N ids of the items, int64 or fixed width byte strings
+#     - the N x 2 block of coarse codes
+#     - the N x M block of fine codes
+#     each block being aligned to 8 bytes
+#
+# Uncompressed codes are loaded as zero-copy arrays over the data, so a batch can be added
+# to an index without building Python tuples for each code.
+import zlib
+import numpy as np
+from .segment import normalize_ids
+
+CODES_MAGIC = 'LOPQCOD1'
+CODES_VERSION = 1
+CODES_HEADER_SIZE = 64
+CODES_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('M', '<u4'), ('coarse_dtype', 'S8'),
+                               ('fine_dtype', 'S8'), ('id_dtype', 'S8'), ('compression', 'S8'),
+                               ('n_items', '<u8')])
+CODES_COMPRESSIONS = ['', 'zlib']
+
+
+def get_codes_layout(n_items, M, coarse_dtype, fine_dtype, id_dtype):
+    """
+    Compute the byte offsets of the blocks of the payload of codes data.
+
+    :returns int coarse_start:
+        the byte offset of the coarse codes block
+    :returns int fine_start:
+        the byte offset of the fine codes block
+    :returns int end:
+        the total size of the payload
+    """
+    ids_end = n_items * np.dtype(id_dtype).itemsize
+    coarse_start = ids_end + (-ids_end % 8)
+    coarse_end = coarse_start + n_items * 2 * np.dtype(coarse_dtype).itemsize
+    fine_start = coarse_end + (-coarse_end % 8)
+    end = fine_start + n_items * M * np.dtype(fine_dtype).itemsize
+    return coarse_start, fine_start, end
+
+
+def normalize_batch_ids(ids):
+    """
+    Convert item ids as `normalize_ids` does, an empty list of ids giving an empty
+    array of byte strings.
+    """
+    if not len(ids):
+        return np.zeros(0, dtype='S1')
+    return normalize_ids(ids)
+
+
+def is_codes_data(data):
+    """
+    Check if an object is codes data written by `dump_codes`, e.g. to tell it apart
+    from a legacy dict of codes.
+    """
+    return isinstance(data, bytes) and data[:len(CODES_MAGIC)] == CODES_MAGIC
+
+
+class CodesBatch(object):
+    """
+    The codes of a batch of items as arrays: a length N array of ids, a N x 2 array
+    of coarse codes and a N x M array of fine codes.
+    """
+
+    def __init__(self, ids, coarse_codes, fine_codes):
+        self.ids = np.asarray(ids)
+        self.coarse_codes = np.asarray(coarse_codes)
+        self.fine_codes = np.asarray(fine_codes)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_dict(cls, codes_dict):
+        """
+        Build a batch from a dict mapping item ids to (coarse, fine) code tuples, as
+        pickled for updates before codes data was introduced.
+        """
+        if not codes_dict:
+            return cls(normalize_batch_ids([]), np.zeros((0, 2), dtype=np.uint8), np.zeros((0, 0), dtype=np.uint8))
+        ids = normalize_ids(list(codes_dict.keys()))
+        codes = list(codes_dict.values())
+        coarse_codes = np.array([code[0] for code in codes]).reshape(len(codes), 2)
+        fine_codes = np.array([code[1] for code in codes]).reshape(len(codes), -1)
+        return cls(ids, coarse_codes, fine_codes)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        Concatenate batches, in order.
+        """
+        return cls(np.concatenate([b.ids for b in batches]),
+                   np.concatenate([b.coarse_codes for b in batches]),
+                   np.concatenate([b.fine_codes for b in batches]))
+
+    def take(self, indices):
+        return CodesBatch(self.ids[indices], self.coarse_codes[indices], self.fine_codes[indices])
+
+    def unique(self):
+        """
+        Get the batch without duplicate ids, keeping the first item of each id in order.
+        """
+        _, first = np.unique(self.ids, return_index=True)
+        if len(first) == len(self):
+            return self
+        return self.take(np.sort(first))
+
+    def to_dict(self):
+        """
+        Get the codes as a dict mapping item ids to (coarse, fine) code tuples.
+        """
+        return dict((item_id, (tuple(coarse), tuple(fine))) for item_id, coarse, fine in
+                    zip(self.ids.tolist(), self.coarse_codes.tolist(), self.fine_codes.tolist()))
+
+
+def dump_codes(batch, compression=''):
+    """
+    Write the codes of a batch as versioned codes data.
+
+    :param CodesBatch batch:
+        the codes of the items
+    :param str compression:
+        '' to store the payload as is, 'zlib' to compress it
+
+    :returns bytes:
+        the codes data
+    """
+    if compression not in CODES_COMPRESSIONS:
+        raise ValueError('Unsupported codes compression: {}'.format(compression))
+    ids = normalize_batch_ids(batch.ids)
+    n_items = len(ids)
+    coarse_codes = np.ascontiguousarray(batch.coarse_codes).reshape(n_items, 2)
+    fine_codes = np.ascontiguousarray(batch.fine_codes)
+    M = fine_codes.shape[-1]
+    fine_codes = fine_codes.reshape(n_items, M)
+
+    header = np.zeros(1, dtype=CODES_HEADER_DTYPE)
+    header['magic'] = CODES_MAGIC
+    header['version'] = CODES_VERSION
+    header['M'] = M
+    header['coarse_dtype'] = coarse_codes.dtype.str
+    header['fine_dtype'] = fine_codes.dtype.str
+    header['id_dtype'] = ids.dtype.str
+    header['compression'] = compression
+    header['n_items'] = n_items
+
+    coarse_start, fine_start, _ = get_codes_layout(n_items, M, coarse_codes.dtype, fine_codes.dtype, ids.dtype)
+    ids_bytes = ids.tobytes()
+    coarse_bytes = coarse_codes.tobytes()
+    payload = b''.join([ids_bytes, b'\0' * (coarse_start - len(ids_bytes)), coarse_bytes,
+                        b'\0' * (fine_start - coarse_start - len(coarse_bytes)), fine_codes.tobytes()])
+    if compression == 'zlib':
+        payload = zlib.compress(payload)
+    return header.tobytes() + b'\0' * (CODES_HEADER_SIZE - CODES_HEADER_DTYPE.itemsize) + payload
+
+
+def load_codes(data):
+    """
+    Read codes data written by `dump_codes`. Arrays of uncompressed data are read-only
+    views of `data`.
+
+    :param bytes data:
+        the codes data
+
+    :returns CodesBatch:
+        the codes of the items
+    """
+    if not is_codes_data(data) or len(data) < CODES_HEADER_SIZE:
+        raise ValueError('Not LOPQ codes data')
+    header = np.frombuffer(data, dtype=CODES_HEADER_DTYPE, count=1)
+    if header['version'][0] != CODES_VERSION:
+        raise ValueError('Unsupported LOPQ codes version {}'.format(header['version'][0]))
+
+    M = int(header['M'][0])
+    n_items = int(header['n_items'][0])
+    coarse_dtype = np.dtype(header['coarse_dtype'][0])
+    fine_dtype = np.dtype(header['fine_dtype'][0])
+    id_dtype = np.dtype(header['id_dtype'][0])
+    compression = header['compression'][0]
+    if compression not in CODES_COMPRESSIONS:
+        raise ValueError('Unsupported LOPQ codes compression: {}'.format(compression))
+
+    # Uncompressed arrays are read at their offset in data, to avoid copying it
+    payload, start = data, CODES_HEADER_SIZE
+    if compression == 'zlib':
+        payload, start = zlib.decompress(data[CODES_HEADER_SIZE:]), 0
+    coarse_start, fine_start, end = get_codes_layout(n_items, M, coarse_dtype, fine_dtype, id_dtype)
+    if len(payload) < start + end:
+        raise ValueError('Truncated LOPQ codes data')
+    if not n_items:
+        # Buffers cannot be empty
+        return CodesBatch(np.zeros(0, dtype=id_dtype), np.zeros((0, 2), dtype=coarse_dtype),
+                          np.zeros((0, M), dtype=fine_dtype))
+
+    ids = np.frombuffer(payload, dtype=id_dtype, count=n_items, offset=start)
+    coarse_codes = np.frombuffer(payload, dtype=coarse_dtype, count=n_items * 2,
+                                 offset=start + coarse_start).reshape(n_items, 2)
+    fine_codes = np.frombuffer(payload, dtype=fine_dtype, count=n_items * M,
+                               offset=start + fine_start).reshape(n_items, M)
+    return CodesBatch(ids, coarse_codes, fine_codes)
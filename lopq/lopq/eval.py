@@ -2,6 +2,7 @@
 # Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
 import time
 import numpy as np
+from .utils import mmap_xvecs, save_xvecs, iterate_chunks, get_mp_context
 
 
 def compute_all_neighbors(data1, data2=None, just_nn=True):
@@ -22,19 +23,161 @@ def compute_all_neighbors(data1, data2=None, just_nn=True):
     if data2 is None:
         data2 = data1
 
+    if just_nn:
+        # Avoid building the full distance matrix
+        return compute_nearest_neighbors(data1, data2, k=1)[0][:, 0]
+
     dists = cdist(data1, data2)
 
-    if just_nn:
-        nns = np.zeros((data1.shape[0]), dtype=int)
+    nns = np.zeros(dists.shape, dtype=int)
+    for i in xrange(dists.shape[0]):
+        nns[i] = np.argsort(dists[i])
+
+    return nns
+
+
+def update_top_k(top_dists, top_indices, dists, indices, k):
+    """
+    Merge a block of candidate distances into a running top-k per row.
+
+    :param ndarray top_dists:
+        a Q x k' matrix of the current best distances, k' <= k
+    :param ndarray top_indices:
+        a Q x k' matrix of the corresponding indices
+    :param ndarray dists:
+        a Q x B matrix of candidate distances
+    :param ndarray indices:
+        a length B array of the candidate indices
+
+    :returns ndarray top_dists:
+        a Q x min(k, k' + B) matrix of the best distances, unsorted
+    :returns ndarray top_indices:
+        the corresponding indices
+    """
+    dists = np.hstack((top_dists, dists))
+    indices = np.hstack((top_indices, np.broadcast_to(indices, (dists.shape[0], len(indices)))))
+    if dists.shape[1] <= k:
+        return dists, indices
+    sel = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    rows = np.arange(dists.shape[0])[:, np.newaxis]
+    return dists[rows, sel], indices[rows, sel]
+
+
+def compute_block_neighbors(queries, data, k, data_chunk_size=65536):
+    """
+    Compute the exact k nearest neighbors of a block of queries by scanning the
+    data by chunks, with squared distances computed in the GEMM form
+    ||a||^2 - 2ab + ||b||^2.
+
+    :returns ndarray nns:
+        a Q x k matrix of neighbor indices sorted by distance
+    :returns ndarray dists:
+        the corresponding Q x k matrix of squared distances
+    """
+    queries = np.asarray(queries, dtype=np.float64)
+    queries_sqnorms = (queries ** 2).sum(axis=1)[:, np.newaxis]
+
+    top_dists = np.zeros((len(queries), 0))
+    top_indices = np.zeros((len(queries), 0), dtype=np.int64)
+    start = 0
+    for chunk in iterate_chunks(data, data_chunk_size):
+        chunk = chunk.astype(np.float64)
+        dists = queries_sqnorms - 2 * np.dot(queries, chunk.T) + (chunk ** 2).sum(axis=1)
+        np.maximum(dists, 0, out=dists)
+        top_dists, top_indices = update_top_k(top_dists, top_indices, dists,
+                                              np.arange(start, start + len(chunk)), k)
+        start += len(chunk)
+
+    # Sort by distance, breaking ties by index
+    order = np.lexsort((top_indices, top_dists), axis=1)
+    rows = np.arange(len(queries))[:, np.newaxis]
+    return top_indices[rows, order], top_dists[rows, order]
+
+
+# Data scanned by the ground truth worker processes
+_worker_data = None
+
+
+def neighbors_worker_init(data, base_type):
+    global _worker_data
+    _worker_data = mmap_xvecs(data, base_type) if isinstance(data, basestring) else data
+
+
+def neighbors_worker(args):
+    queries, k, data_chunk_size = args
+    return compute_block_neighbors(queries, _worker_data, k, data_chunk_size)
+
+
+def compute_nearest_neighbors(queries, data, k=100, query_chunk_size=1024, data_chunk_size=65536,
+                              num_procs=1, base_type='f'):
+    """
+    Compute the exact k nearest neighbors in data of each query without building the
+    full distance matrix. Queries and data are tiled into chunks and a running top-k
+    is kept per query, so memory is bounded by the size of a tile.
+
+    :param ndarray queries:
+        a Q x D matrix of queries
+    :param ndarray|str data:
+        a N x D matrix of observations, e.g. a memmap returned by `mmap_xvecs`, or the
+        path of a xvecs file that is memory-mapped by each worker process
+    :param int k:
+        the number of neighbors per query
+    :param int query_chunk_size:
+        the number of queries per tile
+    :param int data_chunk_size:
+        the number of observations per tile
+    :param int num_procs:
+        the number of worker processes scanning query chunks. An array given as
+        data is copied to every worker, give a file path to share it instead
+    :param str base_type:
+        the xvecs type of the data file, if data is a path
+
+    :returns ndarray nns:
+        a Q x k matrix of neighbor indices sorted by distance
+    :returns ndarray dists:
+        the corresponding Q x k matrix of squared distances
+    """
+    k = min(k, len(mmap_xvecs(data, base_type) if isinstance(data, basestring) else data))
+    tasks = ((chunk, k, data_chunk_size) for chunk in iterate_chunks(queries, query_chunk_size))
+
+    if num_procs > 1:
+        pool = get_mp_context().Pool(num_procs, initializer=neighbors_worker_init, initargs=(data, base_type))
+        try:
+            results = pool.map(neighbors_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        nns = np.zeros(dists.shape, dtype=int)
+        neighbors_worker_init(data, base_type)
+        results = map(neighbors_worker, tasks)
+        neighbors_worker_init(None, base_type)
+
+    if not results:
+        return np.zeros((0, k), dtype=np.int64), np.zeros((0, k))
+    nns, dists = zip(*results)
+    return np.vstack(nns), np.vstack(dists)
 
-    for i in xrange(dists.shape[0]):
-        if just_nn:
-            nns[i] = np.argmin(dists[i])
-        else:
-            nns[i] = np.argsort(dists[i])
 
+def compute_ground_truth(queries, data, filename, k=100, **kwargs):
+    """
+    Compute the exact k nearest neighbors of queries with `compute_nearest_neighbors`
+    and save them to an ivecs file, that can be read back with `load_xvecs(filename, 'i')`
+    and given to `get_recall`.
+
+    :param ndarray queries:
+        a Q x D matrix of queries
+    :param ndarray|str data:
+        a N x D matrix of observations or the path of a xvecs file
+    :param str filename:
+        the path of the ivecs file to write
+    :param int k:
+        the number of neighbors per query
+
+    :returns ndarray:
+        a Q x k matrix of neighbor indices sorted by distance
+    """
+    nns, _ = compute_nearest_neighbors(queries, data, k=k, **kwargs)
+    save_xvecs(nns, filename, base_type='i')
     return nns
 
 
@@ -99,7 +242,8 @@ def get_recall(searcher, queries, nns, thresholds=[1, 10, 100, 1000], normalize=
     :param ndarray queries:
         a collect of test vectors with vectors on the rows
     :param ndarray nns:
-        a list of true nearest neighbor ids for each vector in queries
+        a list of true nearest neighbor ids for each vector in queries, or a matrix
+        of ranked true neighbor ids per query, e.g. as written by `compute_ground_truth`
     :param list thresholds:
         the recall thresholds to evaluate - the last entry defines the number of
         results to retrieve before ranking
@@ -114,6 +258,10 @@ def get_recall(searcher, queries, nns, thresholds=[1, 10, 100, 1000], normalize=
         the elapsed query time
     """
 
+    nns = np.asarray(nns)
+    if nns.ndim == 2:
+        nns = nns[:, 0]
+
     recall = np.zeros(len(thresholds))
     query_time = 0.0
     for i, d in enumerate(queries):
@@ -142,6 +290,83 @@ def get_recall(searcher, queries, nns, thresholds=[1, 10, 100, 1000], normalize=
         return recall, query_time
 
 
+def count_candidates(searcher, x, visited):
+    """
+    Count the number of index items in the first `visited` cells traversed for a query
+    in the model space, i.e. the number of candidates scored by a search that visited
+    that many cells.
+    """
+    candidates = 0
+    for i, (_, _, items, _) in enumerate(searcher.iter_cell_codes(x)):
+        if i >= visited:
+            break
+        candidates += len(items)
+    return candidates
+
+
+def get_recall_stats(searcher, queries, nns, thresholds=[1, 10, 100], quota=None, limit=None, cell_cutoff=False):
+    """
+    Like `get_recall`, but with separate quota and limit, and collecting per query statistics
+    to characterize the recall/latency trade-off of an index.
+
+    :param LOPQSearcher searcher:
+        a searcher that contains the indexed nearest neighbors
+    :param ndarray queries:
+        a collect of test vectors with vectors on the rows
+    :param ndarray nns:
+        a list of true nearest neighbor ids for each vector in queries, or a matrix
+        of ranked true neighbor ids per query
+    :param list thresholds:
+        the recall thresholds to evaluate
+    :param int quota:
+        the number of results to rank - defaults to the last threshold
+    :param int limit:
+        the number of results to return - defaults to quota
+    :param bool cell_cutoff:
+        whether to stop visiting cells early, see `LOPQSearcherBase.search`
+
+    :returns dict:
+        a dict with the normalized recall of each threshold in 'recall', and
+        length N arrays of the query times in seconds in 'latencies', of the numbers
+        of cells visited in 'visited' and of the numbers of candidates scored in 'candidates'
+    """
+    from .model import LOPQModelPCA
+
+    if quota is None:
+        quota = thresholds[-1]
+
+    nns = np.asarray(nns)
+    if nns.ndim == 2:
+        nns = nns[:, 0]
+
+    is_pca = type(searcher.model) == LOPQModelPCA
+    N = len(queries)
+    recall = np.zeros(len(thresholds))
+    latencies = np.zeros(N)
+    visited = np.zeros(N, dtype=int)
+    candidates = np.zeros(N, dtype=int)
+    for i, d in enumerate(queries):
+
+        start = time.time()
+        x = searcher.model.apply_PCA(d) if is_pca else d
+        results, visited[i] = searcher.search_projected(x, quota, limit, cell_cutoff=cell_cutoff)
+        latencies[i] = time.time() - start
+
+        candidates[i] = count_candidates(searcher, x, visited[i])
+
+        for j, res in enumerate(results):
+            if res.id == nns[i]:
+                recall += j < np.array(thresholds)
+                break
+
+    return {
+        'recall': recall / max(N, 1),
+        'latencies': latencies,
+        'visited': visited,
+        'candidates': candidates
+    }
+
+
 def get_subquantizer_distortion(data, model):
     from .model import compute_residuals, project_residuals_to_local
 
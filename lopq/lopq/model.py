@@ -5,7 +5,7 @@ from sklearn.cluster import KMeans, MiniBatchKMeans
 import logging
 import sys
 from collections import namedtuple
-from .utils import iterate_splits, predict_cluster
+from .utils import iterate_splits, iterate_clusters, predict_cluster, predict_clusters, predict_subquantizer_clusters
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
@@ -106,14 +106,22 @@ def compute_local_rotations(data, C, num_buckets):
     return R, mu, assignments, residuals
 
 
-def accumulate_covariance_estimators(data, C):
+def accumulate_covariance_estimators(data, C, A=None, mu=None, count=None):
     """
     Accumulate covariance estimators for each cluster with a pass through the data.
+    Estimators can be accumulated over several chunks of data by passing the
+    accumulators returned for the previous chunks.
 
     :param ndarray data:
         NxD array - observations on the rows
     :param ndarray C:
         VxD array of cluster centroids
+    :param ndarray A:
+        optional VxDxD accumulator to add to
+    :param ndarray mu:
+        optional VxD accumulator to add to
+    :param ndarray count:
+        optional Vx1 accumulator to add to
 
     :returns ndarray A:
         VxDxD array - total sum of residual outer products for each cluster
@@ -128,31 +136,26 @@ def accumulate_covariance_estimators(data, C):
     """
 
     V = C.shape[0]
-    N = data.shape[0]
     D = data.shape[1]
 
     # Essential variables
-    A = np.zeros((V, D, D))                 # accumulators for covariance estimator per cluster
-    mu = np.zeros((V, D))                   # residual means
-    count = np.zeros(V, dtype=int)          # count of points per cluster
-    assignments = np.zeros(N, dtype=int)    # point cluster assignments
-    residuals = np.zeros((N, D))            # residual for data points given cluster assignment
-
-    # Iterate data points, accumulate estimators
-    for i in xrange(N):
-        d = data[i]
-
-        # Find cluster assignment and residual
-        cluster = predict_cluster(d, C)
-        centroid = C[cluster]
-        residual = d - centroid
-        assignments[i] = cluster
+    if A is None:
+        A = np.zeros((V, D, D))             # accumulators for covariance estimator per cluster
+    if mu is None:
+        mu = np.zeros((V, D))               # residual means
+    if count is None:
+        count = np.zeros(V, dtype=int)      # count of points per cluster
+
+    # Find cluster assignments and residuals of all points
+    assignments = predict_clusters(data, C).astype(int)
+    residuals = data - C[assignments]
 
-        # Accumulate estimators for covariance matrix for the assigned cluster
-        mu[cluster] += residual
-        count[cluster] += 1
-        A[cluster] += np.outer(residual, residual)
-        residuals[i] = residual
+    # Accumulate estimators for covariance matrix of each cluster
+    for cluster, rows in iterate_clusters(assignments):
+        r = residuals[rows]
+        mu[cluster] += r.sum(axis=0)
+        count[cluster] += len(rows)
+        A[cluster] += np.dot(r.T, r)
 
     return A, mu, count, assignments, residuals
 
@@ -226,16 +229,14 @@ def project_residuals_to_local(residuals, assignments, Rs, mu):
         an NxD array of locally projected residuals
     """
     projected = np.zeros(residuals.shape)
-    for i in xrange(residuals.shape[0]):
-        res = residuals[i]
-        a = assignments[i]
-        projected[i] = np.dot(Rs[a], res - mu[a])
+    for a, rows in iterate_clusters(assignments):
+        projected[rows] = np.dot(residuals[rows] - mu[a], Rs[a].T)
 
     return projected
 
 
 def compute_residuals(data, C):
-    assignments = np.apply_along_axis(predict_cluster, 1, data, C)
+    assignments = predict_clusters(data, C).astype(int)
     residuals = data - C[assignments]
     return residuals, assignments
 
@@ -436,6 +437,259 @@ def train(data, V=8, M=4, subquantizer_clusters=256, parameters=None,
 
     return (C1, C2), (Rs1, Rs2), (mu1, mu2), (subquantizers1, subquantizers2)
 
+########################################
+# Streaming training algo
+########################################
+
+class StreamingKMeans(object):
+    """
+    Mini-batch kmeans fitted on a stream of chunks of data, each chunk being one
+    mini-batch update. The first rows are buffered until there are enough of them
+    to initialize the centroids with k-means++.
+    """
+
+    def __init__(self, n_clusters, init_size=None, random_state=None):
+        self.n_clusters = n_clusters
+        self.init_size = init_size if init_size is not None else 3 * n_clusters
+        self.model = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', init_size=self.init_size,
+                                     compute_labels=False, random_state=random_state)
+        self.buffer = []
+        self.buffered = 0
+        self.initialized = False
+
+    def partial_fit(self, data):
+        if data.shape[0] == 0:
+            return
+        if not self.initialized:
+            self.buffer.append(data)
+            self.buffered += data.shape[0]
+            if self.buffered < self.init_size:
+                return
+            data = np.concatenate(self.buffer)
+            self.buffer = []
+            self.initialized = True
+        self.model.partial_fit(data)
+
+    def flush(self):
+        """
+        Fit the buffered rows, if the stream was too short to reach `init_size`.
+        """
+        if self.initialized:
+            return
+        if self.buffered < self.n_clusters:
+            raise ValueError('Not enough data (%d points) to fit %d clusters' % (self.buffered, self.n_clusters))
+        self.init_size = self.buffered
+        self.model.init_size = self.buffered
+        data = np.concatenate(self.buffer)
+        self.buffer = []
+        self.initialized = True
+        self.model.partial_fit(data)
+
+    @property
+    def cluster_centers_(self):
+        return self.model.cluster_centers_
+
+
+def train_pca_streaming(get_chunks, pca_dims=256):
+    """
+    Train the pca model with a single pass over chunks of data, see `train_pca`.
+
+    :param callable get_chunks:
+        a function returning an iterator of NxD chunks of data
+    :param int pca_dims:
+        the number of dimensions to keep
+
+    :returns dict:
+        the pca parameters
+    :returns int:
+        the number of dimensions kept
+    """
+    count = 0
+    summed = None
+    summed_covar = None
+    for chunk in get_chunks():
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if summed is None:
+            summed = np.zeros(chunk.shape[1])
+            summed_covar = np.zeros((chunk.shape[1], chunk.shape[1]))
+        count += chunk.shape[0]
+        summed += chunk.sum(axis=0)
+        summed_covar += np.dot(chunk.T, chunk)
+
+    D = summed.shape[0]
+    pca_dims = min(pca_dims, D)
+    mu = summed / count
+
+    A = summed_covar / (count - 1) - np.outer(mu, mu)
+    E, P = np.linalg.eigh(A)
+
+    # Reduce dimension - eigenvalues assumed in ascending order
+    E = E[-pca_dims:]
+    P = P[:, -pca_dims:]
+
+    # Balance variance across halves
+    permuted_inds = eigenvalue_allocation(2, E)
+    P = P[:, permuted_inds]
+
+    params = {
+        'mu': mu,  # mean
+        'P': P,  # PCA matrix
+        'E': E,  # eigenvalues
+        'A': A,  # covariance matrix
+        'c': count  # sample size
+    }
+    return params, pca_dims
+
+
+def train_streaming(get_chunks, V=8, M=4, subquantizer_clusters=256, parameters=None,
+                    kmeans_coarse_iters=5, kmeans_local_iters=5, subquantizer_sample_ratio=1.0,
+                    random_state=None, verbose=False):
+    """
+    Fit an LOPQ model with passes over chunks of data, so that the training data does not
+    need to fit in memory, e.g. chunks read from a memmap with `iterate_chunks` or from a
+    database. Coarse quantizers and subquantizers are fitted with mini-batch kmeans, one
+    mini-batch per chunk, and local rotations are computed from covariance estimators
+    accumulated over all chunks.
+
+    :param callable get_chunks:
+        a function returning an iterator of NxD chunks of training data,
+        called once per pass over the data
+    :param int V:
+        number of coarse clusters
+    :param int M:
+        number of fine codes; same as number of bytes per compressed
+        vector in memory with 256 subquantizer clusters
+    :param int subquantizer_clusters:
+        the number of clusters for each subquantizer
+    :param tuple parameters:
+        a tuple of parameters - missing parameters are allowed to be None
+    :param int kmeans_coarse_iters:
+        the number of passes over the data to fit the coarse quantizers
+    :param int kmeans_local_iters:
+        the number of passes over the data to fit the subquantizers
+    :param float subquantizer_sample_ratio:
+        the proportion of each chunk to sample for training subquantizers
+    :param int random_state:
+        a random seed used in all random operations during training if provided
+    :param bool verbose:
+        a bool enabling verbose output during training
+
+    :returns tuple:
+        a tuple of model parameters that can be used to instantiate an LOPQModel object
+    """
+
+    # Set logging level for verbose mode
+    if (verbose):
+        logger.setLevel(logging.DEBUG)
+
+    # Extract parameters
+    Cs = Rs = mus = subquantizers = None
+    if parameters is not None:
+        Cs, Rs, mus, subquantizers = parameters
+
+    # Enforce parameter dependencies
+    if Rs is None or mus is None:
+        Rs = mus = None
+
+    # Cluster coarse splits
+    if Cs is not None:
+        logger.info('Using existing coarse quantizers.')
+    else:
+        logger.info('Fitting coarse quantizers...')
+        coarse_models = [StreamingKMeans(V, random_state=random_state) for _ in range(2)]
+        for it in xrange(kmeans_coarse_iters):
+            for chunk in get_chunks():
+                for model, half in zip(coarse_models, np.split(chunk, 2, axis=1)):
+                    model.partial_fit(half)
+            for model in coarse_models:
+                model.flush()
+            logger.info('Coarse quantizers pass %d of %d.' % (it + 1, kmeans_coarse_iters))
+        Cs = [model.cluster_centers_ for model in coarse_models]
+        logger.info('Done fitting coarse quantizers.')
+
+    # Compute local rotations
+    if Rs is not None:
+        logger.info('Using existing rotations.')
+    else:
+        logger.info('Fitting local rotations...')
+        accumulators = [(None, None, None), (None, None, None)]
+        for chunk in get_chunks():
+            for split, half in enumerate(np.split(chunk, 2, axis=1)):
+                A, mu, count = accumulators[split]
+                A, mu, count, _, _ = accumulate_covariance_estimators(half, Cs[split], A, mu, count)
+                accumulators[split] = (A, mu, count)
+        Rs = []
+        mus = []
+        for A, mu, count in accumulators:
+            R, mu = compute_rotations_from_accumulators(A, mu, count, M / 2)
+            Rs.append(R)
+            mus.append(mu)
+        logger.info('Done fitting local rotations.')
+
+    # Fit subquantizers on projected residuals, subvector by subvector
+    logger.info('Fitting subquantizers...')
+    rs = np.random.RandomState(random_state)
+    sub_models = [[StreamingKMeans(subquantizer_clusters, random_state=random_state) for _ in range(M / 2)]
+                  for _ in range(2)]
+    for it in xrange(kmeans_local_iters):
+        for chunk in get_chunks():
+            if subquantizer_sample_ratio < 1.0:
+                chunk = chunk[rs.rand(chunk.shape[0]) < subquantizer_sample_ratio]
+            for split, half in enumerate(np.split(chunk, 2, axis=1)):
+                residuals, assignments = compute_residuals(half, Cs[split])
+                projected = project_residuals_to_local(residuals, assignments, Rs[split], mus[split])
+                for model, sub in zip(sub_models[split], np.split(projected, M / 2, axis=1)):
+                    model.partial_fit(sub)
+        for models in sub_models:
+            for model in models:
+                model.flush()
+        logger.info('Subquantizers pass %d of %d.' % (it + 1, kmeans_local_iters))
+    subquantizers = [[model.cluster_centers_ for model in models] for models in sub_models]
+    logger.info('Done fitting subquantizers.')
+
+    return tuple(Cs), tuple(Rs), tuple(mus), tuple(subquantizers)
+
+def compute_adc_terms(C, Rs, mu, subquantizers):
+    """
+    Precompute the query independent terms of the subquantizer distances of one coarse split.
+
+    In the local frame of coarse cluster c, a query subvector x is projected to
+    px = R_c (x - C_c - mu_c) = R_c x - o_c with o_c = R_c (C_c + mu_c), and for the j-th
+    subvector and subquantizer cluster k of centroid y_jk:
+
+        ||px_j - y_jk||^2 = ||px_j||^2 - 2 <(R_c x)_j, y_jk> + (||y_jk||^2 + 2 <o_cj, y_jk>)
+
+    The first term only depends on the query and the cell, the last one is query independent
+    and is precomputed here, so that the distances of a query to all subquantizer clusters of a
+    cell cost a single rotation of x and one inner product with every centroid.
+
+    :param ndarray C:
+        a VxD/2 matrix of coarse centroids
+    :param ndarray Rs:
+        a VxD/2xD/2 array of rotation matrices
+    :param ndarray mu:
+        a VxD/2 matrix of mean residuals
+    :param list subquantizers:
+        a list of M/2 SxD/M matrices of subquantizer centroids
+
+    :returns ndarray offsets:
+        the VxD/2 matrix of the o_c vectors
+    :returns ndarray biases:
+        a VxM/2xS array of the query independent terms
+    :returns ndarray centroids:
+        the M/2xSxD/M array of subquantizer centroids
+    """
+    Rs = np.asarray(Rs)
+    centroids = np.array(subquantizers)
+    num_fine_splits, S, d = centroids.shape
+
+    offsets = np.einsum('vij,vj->vi', Rs, np.asarray(C) + np.asarray(mu))
+    norms = (centroids ** 2).sum(axis=2)
+    biases = norms + 2 * np.einsum('vjd,jkd->vjk', offsets.reshape(-1, num_fine_splits, d), centroids)
+
+    return offsets, biases, centroids
+
+
 ########################################
 # Model class
 ########################################
@@ -492,6 +746,9 @@ class LOPQModel(object):
             self.M = M
             self.subquantizer_clusters = subquantizer_clusters
 
+        # Optional precomputed terms of the subquantizer distances, see `precompute_adc_terms`
+        self.adc_terms = None
+
     def fit(self, data, kmeans_coarse_iters=10, kmeans_local_iters=20, n_init=10, subquantizer_sample_ratio=1.0, random_state=None, verbose=False):
         """
         Fit a model with the current model parameters. This method will use existing parameters and only
@@ -518,6 +775,37 @@ class LOPQModel(object):
                            random_state, verbose)
 
         self.Cs, self.Rs, self.mus, self.subquantizers = parameters
+        self.adc_terms = None
+
+    def fit_streaming(self, get_chunks, kmeans_coarse_iters=5, kmeans_local_iters=5, subquantizer_sample_ratio=1.0,
+                      random_state=None, verbose=False):
+        """
+        Fit a model with the current model parameters from chunks of data, without loading
+        all the training data in memory. This method will use existing parameters and only
+        train missing parameters. See `train_streaming`.
+
+        :param callable get_chunks:
+            a function returning an iterator of NxD chunks of training data,
+            called once per pass over the data
+        :param int kmeans_coarse_iters:
+            the number of passes over the data to fit the coarse quantizers
+        :param int kmeans_local_iters:
+            the number of passes over the data to fit the subquantizers
+        :param float subquantizer_sample_ratio:
+            the proportion of the training data to sample for training subquantizers
+        :param int random_state:
+            a random seed used in all random operations during training if provided
+        :param bool verbose:
+            a bool enabling verbose output during training
+        """
+        existing_parameters = (self.Cs, self.Rs, self.mus, self.subquantizers)
+
+        parameters = train_streaming(get_chunks, self.V, self.M, self.subquantizer_clusters, existing_parameters,
+                                     kmeans_coarse_iters, kmeans_local_iters, subquantizer_sample_ratio,
+                                     random_state, verbose)
+
+        self.Cs, self.Rs, self.mus, self.subquantizers = parameters
+        self.adc_terms = None
 
     def get_split_parameters(self, split):
         """
@@ -560,6 +848,29 @@ class LOPQModel(object):
 
         return LOPQCode(coarse_codes, fine_codes)
 
+    def predict_batch(self, X):
+        """
+        Compute both coarse and fine codes for a batch of datapoints. This gives the codes
+        of `predict` for each row, but each step is computed for all rows at once.
+
+        :param ndarray X:
+            a NxD array of points to code
+
+        :returns ndarray:
+            a Nx2 array of coarse codes
+        :returns ndarray:
+            a NxM array of fine codes
+        """
+        X = np.atleast_2d(X)
+
+        # Compute coarse quantizer codes
+        coarse_codes = self.predict_coarse_batch(X)
+
+        # Compute fine codes
+        fine_codes = self.predict_fine_batch(X, coarse_codes)
+
+        return LOPQCode(coarse_codes, fine_codes)
+
     def predict_coarse(self, x):
         """
         Compute the coarse codes for a datapoint.
@@ -572,6 +883,80 @@ class LOPQModel(object):
         """
         return tuple([predict_cluster(cx, self.Cs[split]) for cx, split in iterate_splits(x, self.num_coarse_splits)])
 
+    def predict_coarse_batch(self, X):
+        """
+        Compute the coarse codes for a batch of datapoints.
+
+        :param ndarray X:
+            a NxD array of points to code
+
+        :returns ndarray:
+            a Nx2 array of coarse codes
+        """
+        splits = np.split(X, self.num_coarse_splits, axis=1)
+        return np.column_stack([predict_clusters(cx, self.Cs[split]) for split, cx in enumerate(splits)])
+
+    def predict_fine_batch(self, X, coarse_codes=None):
+        """
+        Compute the fine codes for a batch of datapoints.
+
+        :param ndarray X:
+            a NxD array of points to code
+        :param ndarray coarse_codes:
+            the Nx2 coarse codes for the points
+            if they are already computed
+
+        :returns ndarray:
+            a NxM array of fine codes
+        """
+        if coarse_codes is None:
+            coarse_codes = self.predict_coarse_batch(X)
+
+        PX = self.project_batch(X, coarse_codes)
+
+        fine_codes = []
+        for split, cx in enumerate(np.split(PX, self.num_coarse_splits, axis=1)):
+
+            # Get product quantizer parameters for this split
+            _, _, _, subC = self.get_split_parameters(split)
+
+            # Compute the codes of all subquantizers at once
+            fine_codes.append(predict_subquantizer_clusters(cx, subC))
+
+        return np.hstack(fine_codes)
+
+    def project_batch(self, X, coarse_codes):
+        """
+        Project a batch of vectors to the local residual spaces defined by their coarse codes.
+        Rows are grouped by coarse cluster so that each local rotation is applied to all the
+        rows of its cluster with one matrix product.
+
+        :param ndarray X:
+            a NxD array of points to project
+        :param ndarray coarse_codes:
+            the Nx2 coarse codes defining the local spaces
+
+        :returns ndarray:
+            the NxD projected vectors
+        """
+        PX = []
+        for split, cx in enumerate(np.split(X, self.num_coarse_splits, axis=1)):
+
+            # Get product quantizer parameters for this split
+            C, R, mu, _ = self.get_split_parameters(split)
+
+            # Compute residuals
+            clusters = coarse_codes[:, split]
+            r = cx - C[clusters] - mu[clusters]
+
+            # Project residuals to local frame, one cluster at a time
+            pr = np.empty(r.shape, dtype=np.result_type(r, R[0]))
+            for cluster, rows in iterate_clusters(clusters):
+                pr[rows] = np.dot(r[rows], R[cluster].T)
+            PX.append(pr)
+
+        return np.hstack(PX)
+
     def predict_fine(self, x, coarse_codes=None):
         """
         Compute the fine codes for a datapoint.
@@ -703,6 +1088,53 @@ class LOPQModel(object):
 
         return subquantizer_dists
 
+    def precompute_adc_terms(self):
+        """
+        Precompute the query independent terms of the subquantizer distances of every
+        coarse cluster with `compute_adc_terms`. They are stored with the model, and
+        `get_subquantizer_distances_precomputed` can then be used in place of
+        `get_subquantizer_distances`.
+        """
+        self.adc_terms = [compute_adc_terms(*self.get_split_parameters(split))
+                          for split in xrange(self.num_coarse_splits)]
+
+    def get_subquantizer_distances_precomputed(self, x, coarse_codes, coarse_split=None):
+        """
+        Compute the distances of each subvector of a query, in the local space of the given
+        coarse codes, to the corresponding subquantizer clusters with the terms precomputed
+        by `precompute_adc_terms`. Distances are the ones of `get_subquantizer_distances`
+        up to float rounding.
+
+        :param ndarray x:
+            a query  vector
+        :param tuple coarse_codes:
+            the coarse codes defining which local space to project to
+        :param int coarse_split:
+            index of the coarse split to get distances for - if None then all splits
+            are computed
+
+        :returns ndarray:
+            a M x S array (M/2 x S for a single split) of distances to each subquantizer
+            cluster for each subquantizer
+        """
+        if coarse_split is None:
+            split_iter = iterate_splits(x, self.num_coarse_splits)
+        else:
+            split_iter = [(np.split(x, self.num_coarse_splits)[coarse_split], coarse_split)]
+
+        subquantizer_dists = []
+        for cx, split in split_iter:
+            offsets, biases, centroids = self.adc_terms[split]
+            cluster = coarse_codes[split]
+
+            rx = np.dot(self.Rs[split][cluster], cx).reshape(self.num_fine_splits, -1)
+            px = rx - offsets[cluster].reshape(self.num_fine_splits, -1)
+            dists = biases[cluster] - 2 * np.matmul(centroids, rx[:, :, np.newaxis])[:, :, 0]
+            dists += (px ** 2).sum(axis=1)[:, np.newaxis]
+            subquantizer_dists.append(dists)
+
+        return np.concatenate(subquantizer_dists)
+
     def get_cell_id_for_coarse_codes(self, coarse_codes):
         return coarse_codes[1] + coarse_codes[0] * self.V
 
@@ -874,6 +1306,9 @@ class LOPQModelPCA(LOPQModel):
             self.M = M
             self.subquantizer_clusters = subquantizer_clusters
 
+        # Optional precomputed terms of the subquantizer distances, see `precompute_adc_terms`
+        self.adc_terms = None
+
 
     def fit_pca(self, data, pca_dims=256, pca_subsample=None):
         if self.pca_P is None or self.pca_mu is None:
@@ -935,6 +1370,63 @@ class LOPQModelPCA(LOPQModel):
                            random_state, verbose)
 
         self.Cs, self.Rs, self.mus, self.subquantizers = parameters
+        self.adc_terms = None
+
+    def fit_pca_streaming(self, get_chunks, pca_dims=256):
+        """
+        Train PCA with a single pass over chunks of data, see `fit_pca`.
+        """
+        if self.pca_P is None or self.pca_mu is None:
+            pca_params, pca_dims = train_pca_streaming(get_chunks, pca_dims)
+            self.pca_P = pca_params['P']
+            self.pca_mu = pca_params['mu']
+        else:
+            raise ValueError("You are trying to retrain PCA...")
+
+    def fit_streaming(self, get_chunks, pca_dims=256, kmeans_coarse_iters=5, kmeans_local_iters=5,
+                      subquantizer_sample_ratio=1.0, random_state=None, verbose=False, apply_pca=True,
+                      train_pca=True):
+        """
+        Fit a model with the current model parameters from chunks of data, without loading
+        all the training data in memory. This method will use existing parameters and only
+        train missing parameters. See `train_streaming`.
+
+        :param callable get_chunks:
+            a function returning an iterator of NxD chunks of training data,
+            called once per pass over the data
+        :param int pca_dims:
+            the number of dimensions to keep after PCA
+        :param int kmeans_coarse_iters:
+            the number of passes over the data to fit the coarse quantizers
+        :param int kmeans_local_iters:
+            the number of passes over the data to fit the subquantizers
+        :param float subquantizer_sample_ratio:
+            the proportion of the training data to sample for training subquantizers
+        :param int random_state:
+            a random seed used in all random operations during training if provided
+        :param bool verbose:
+            a bool enabling verbose output during training
+        :param bool apply_pca:
+            whether chunks should be PCA projected, i.e. they are not already projected
+        :param bool train_pca:
+            whether PCA should be trained first
+        """
+        existing_parameters = (self.Cs, self.Rs, self.mus, self.subquantizers)
+
+        if train_pca:
+            self.fit_pca_streaming(get_chunks, pca_dims)
+
+        if apply_pca:
+            get_pca_chunks = lambda: (self.apply_PCA(chunk) for chunk in get_chunks())
+        else:
+            get_pca_chunks = get_chunks
+
+        parameters = train_streaming(get_pca_chunks, self.V, self.M, self.subquantizer_clusters, existing_parameters,
+                                     kmeans_coarse_iters, kmeans_local_iters, subquantizer_sample_ratio,
+                                     random_state, verbose)
+
+        self.Cs, self.Rs, self.mus, self.subquantizers = parameters
+        self.adc_terms = None
 
 
     def get_split_parameters(self, split):
@@ -1002,6 +1494,22 @@ class LOPQModelPCA(LOPQModel):
 
         return LOPQCode(coarse_codes, fine_codes)
 
+    def predict_batch(self, X):
+        """
+        Compute both coarse and fine codes for a batch of datapoints,
+        applying PCA to all of them with a single matrix product.
+
+        :param ndarray X:
+            a NxD array of points to code
+
+        :returns ndarray:
+            a Nx2 array of coarse codes
+        :returns ndarray:
+            a NxM array of fine codes
+        """
+        X_pca = self.apply_PCA(np.atleast_2d(X))
+        return super(LOPQModelPCA, self).predict_batch(X_pca)
+
     def predict_coarse(self, x):
         """
         Compute the coarse codes for a datapoint.
@@ -5,14 +5,28 @@ from collections import defaultdict, namedtuple
 from itertools import count
 import numpy as np
 import array
-from .utils import iterate_splits, compute_codes_parallel, copy_from_hdfs
-from .model import LOPQModel, LOPQModelPCA
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from .utils import iterate_splits, compute_codes_parallel, copy_from_hdfs, BloomFilter
+from .model import LOPQModel, LOPQModelPCA, LOPQCode
+from .segment import LOPQSegment, get_segment_name, write_segment, write_segment_cells, normalize_ids, read_manifest, \
+    write_manifest, locked_segments_dir
 
 # Modifications by Svebor Karaman
 
-def multisequence(x, centroids):
+# Named tuple types for search results
+SearchResult = namedtuple('SearchResult', ['id', 'code'])
+SearchResultWithDist = namedtuple('SearchResultWithDist', ['id', 'code', 'dist'])
+
+# Duplicate detection modes of LOPQSearcher, see LOPQSearcher.__init__
+DEDUP_MODES = ['set', 'bloom', 'scan']
+
+def multisequence_heap(x, centroids):
     """
-    Implementation of multi-sequence algorithm for traversing a multi-index.
+    Reference implementation of multi-sequence algorithm for traversing a multi-index,
+    walking the priority queue one cell at a time. Kept for validation and benchmarking
+    of the vectorized `multisequence` below.
 
     The algorithm is described in http://download.yandex.ru/company/cvpr2012.pdf.
 
@@ -82,15 +96,312 @@ def multisequence(x, centroids):
                 heapq.heappush(h, (dist, c))
 
 
+def get_sorted_coarse_distances(x, centroids):
+    """
+    Compute the distances of each subvector of a query to the corresponding coarse
+    centroids, sorted in ascending order.
+
+    :param ndarray x:
+        a query vector
+    :param list centroids:
+        a list of ndarrays containing cluster centroids for each subvector
+
+    :returns list sorted_inds:
+        a list of arrays of cluster indices sorted by distance for each split
+    :returns list sorted_dists:
+        a list of arrays of the corresponding sorted distances for each split
+    """
+    sorted_inds = []
+    sorted_dists = []
+    for cx, split in iterate_splits(x, len(centroids)):
+        dists = ((cx - centroids[split]) ** 2).sum(axis=1)
+        inds = np.argsort(dists)
+        sorted_inds.append(inds)
+        sorted_dists.append(dists[inds])
+    return sorted_inds, sorted_dists
+
+
+def get_sorted_coarse_distances_batch(X, centroids):
+    """
+    Compute the sorted coarse distances of a batch of queries, with one matrix product
+    per split using the ||x||^2 - 2 x.c + ||c||^2 expansion.
+
+    Distances computed this way may differ from `get_sorted_coarse_distances` by a few ulps,
+    which can only swap the traversal order of cells at near-equal distances.
+
+    :param ndarray X:
+        a NxD array of query vectors
+    :param list centroids:
+        a list of ndarrays containing cluster centroids for each subvector
+
+    :returns list:
+        a length N list of (sorted_inds, sorted_dists) pairs, one for each query
+    """
+    N = X.shape[0]
+    split_size = X.shape[1] / len(centroids)
+    rows = np.arange(N)[:, np.newaxis]
+
+    all_inds = []
+    all_dists = []
+    for split, C in enumerate(centroids):
+        cX = X[:, split * split_size:(split + 1) * split_size]
+        dists = (cX ** 2).sum(axis=1)[:, np.newaxis] - 2 * np.dot(cX, C.T) + (C ** 2).sum(axis=1)[np.newaxis, :]
+        inds = np.argsort(dists, axis=1)
+        all_inds.append(inds)
+        all_dists.append(dists[rows, inds])
+
+    return [([inds[i] for inds in all_inds], [dists[i] for dists in all_dists]) for i in xrange(N)]
+
+
+def multisequence_top_cells(sorted_inds, sorted_dists, K):
+    """
+    Compute the first K cells of the multi-sequence traversal of a two-split multi-index.
+
+    Since the per-split distances are sorted, the distance of a cell is non-decreasing along
+    both ranks. The heap traversal of `multisequence_heap` thus pops cells in increasing order
+    of (dist, rank0, rank1), and a cell at ranks (i, j) is preceded by at least (i + 1) * (j + 1) - 1
+    cells. Only cells with (i + 1) * (j + 1) <= K can be in the top K, so we score those
+    candidates at once and sort them with the same tie-breaking as the heap.
+
+    :param list sorted_inds:
+        the sorted cluster indices per split, as returned by `get_sorted_coarse_distances`
+    :param list sorted_dists:
+        the sorted distances per split, as returned by `get_sorted_coarse_distances`
+    :param int K:
+        the number of cells to return
+
+    :returns ndarray dists:
+        a length K (or V ** 2 if smaller) array of cell distances
+    :returns ndarray cells:
+        a Kx2 array of cells (coarse cluster indices) in traversal order
+    """
+    sd0, sd1 = sorted_dists
+    V0, V1 = len(sd0), len(sd1)
+    K = min(K, V0 * V1)
+
+    # Enumerate candidate ranks (i, j) with (i + 1) * (j + 1) <= K
+    rows = min(K, V0)
+    counts = np.minimum(K // np.arange(1, rows + 1), V1)
+    total = counts.sum()
+    ri = np.repeat(np.arange(rows), counts)
+    rj = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # Same float operation as the heap traversal, then sort on (dist, rank0, rank1)
+    d = sd0[ri] + sd1[rj]
+    order = np.lexsort((rj, ri, d))[:K]
+
+    ri = ri[order]
+    rj = rj[order]
+    cells = np.column_stack((sorted_inds[0][ri], sorted_inds[1][rj]))
+
+    return d[order], cells
+
+
+def multisequence_batches(x, centroids, batch_size=16, max_cells=None, sorted_coarse=None):
+    """
+    Vectorized multi-sequence traversal of a multi-index, emitting cells in batches.
+    Successive batches grow geometrically, so retrieving the first K cells costs O(K log K)
+    overall instead of one heap operation and several Python tuples per cell.
+
+    The cell order is exactly the one of `multisequence_heap`.
+
+    :param ndarray x:
+        a query vector
+    :param list centroids:
+        a list of ndarrays containing cluster centroids for each subvector
+    :param int batch_size:
+        the number of cells in the first batch
+    :param int max_cells:
+        an optional bound on the total number of cells to traverse
+    :param tuple sorted_coarse:
+        optional precomputed (sorted_inds, sorted_dists) of the query
+
+    :yields ndarray dists:
+        the cell distances of the batch
+    :yields ndarray cells:
+        a Bx2 array of the cells of the batch
+    """
+    if sorted_coarse is None:
+        sorted_coarse = get_sorted_coarse_distances(x, centroids)
+    sorted_inds, sorted_dists = sorted_coarse
+    total_cells = len(sorted_dists[0]) * len(sorted_dists[1])
+    if max_cells is not None:
+        total_cells = min(total_cells, max_cells)
+
+    done = 0
+    K = max(batch_size, 1)
+    while done < total_cells:
+        K = min(K, total_cells)
+        dists, cells = multisequence_top_cells(sorted_inds, sorted_dists, K)
+        yield dists[done:], cells[done:]
+        done = K
+        K *= 4
+
+
+def multisequence(x, centroids, batch_size=16):
+    """
+    Implementation of multi-sequence algorithm for traversing a multi-index.
+
+    The algorithm is described in http://download.yandex.ru/company/cvpr2012.pdf.
+    Cells are computed in batches by `multisequence_batches`.
+
+    :param ndarray x:
+        a query vector
+    :param list centroids:
+        a list of ndarrays containing cluster centroids for each subvector
+    :param int batch_size:
+        the number of cells in the first computed batch
+
+    :yields int d:
+        the cell distance approximation used to order cells
+    :yields tuple cell:
+        the cell indices
+    """
+    for dists, cells in multisequence_batches(x, centroids, batch_size):
+        for d, cell in zip(dists.tolist(), cells.tolist()):
+            yield d, tuple(cell)
+
+
+def adc_distances(table, fine_codes):
+    """
+    Table-driven asymmetric distance computation for the codes of one coarse cell.
+
+    The M lookups of every code are gathered at once from the flattened table. Columns are
+    then accumulated in order rather than with a pairwise `sum(axis=1)`, so the result is
+    bit-for-bit identical to summing the M table entries of each code sequentially.
+
+    :param ndarray table:
+        a M x S array of distances of the query subvectors to each of the S subquantizer
+        clusters, as returned by `LOPQSearcherBase.get_adc_table`
+    :param ndarray fine_codes:
+        a N x M array of fine codes
+
+    :returns ndarray:
+        a length N array of approximate distances
+    """
+    M, S = table.shape
+    offsets = np.arange(M) * S
+    gathered = table.take(fine_codes.astype(np.intp) + offsets)
+
+    dists = gathered[:, 0].copy()
+    for m in xrange(1, M):
+        dists += gathered[:, m]
+    return dists
+
+
+def get_fine_codes_dtype(model):
+    """
+    Get the smallest unsigned integer type able to store the fine codes of a model.
+    """
+    if model.subquantizer_clusters <= 256:
+        return np.uint8
+    elif model.subquantizer_clusters <= 65536:
+        return np.uint16
+    else:
+        return np.uint32
+
+
+def group_by_cell(cell_ids):
+    """
+    Group items by cell id.
+
+    :param ndarray cell_ids:
+        a length N array of cell ids, as given by `get_cell_id_for_coarse_codes`
+
+    :returns list:
+        a list of (cell id, indices) pairs, one per distinct cell id in increasing order,
+        indices of the items of each cell being in increasing order
+    """
+    cell_ids = np.asarray(cell_ids, dtype=np.int64)
+    if not len(cell_ids):
+        return []
+    # Stable sort keeps the insertion order of the items of a cell
+    order = np.argsort(cell_ids, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(cell_ids[order])) + 1
+    return [(int(cell_ids[inds[0]]), inds) for inds in np.split(order, bounds)]
+
+
+def top_k_order(dists, k):
+    """
+    Get the indices of the k smallest distances in increasing order of distance.
+
+    Candidates are selected with a linear time partition and only those are sorted.
+    Ties are ordered by index, so the result is the same as the first k entries of a
+    stable full sort, including ties at the k-th distance.
+
+    :param ndarray dists:
+        a length N array of distances
+    :param int k:
+        the number of indices to return
+
+    :returns ndarray:
+        the indices of the min(k, N) smallest distances
+    """
+    N = len(dists)
+    if k >= N:
+        return np.argsort(dists, kind='mergesort')
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+
+    kth = np.partition(dists, k - 1)[k - 1]
+    below = np.flatnonzero(dists < kth)
+    ties = np.flatnonzero(dists == kth)[:k - len(below)]
+    selected = np.concatenate((below, ties))
+    return selected[np.argsort(dists[selected], kind='mergesort')]
+
+
+def grow_capacity(capacity):
+    """
+    Get the next capacity of a growable array, a quarter larger so that at most a fifth
+    of an array is unused while appends stay amortized.
+    """
+    return capacity + max(4, capacity // 4)
+
+
 class LOPQSearcherBase(object):
 
     def __init__(self):
         self.nb_indexed = 0
         self.verbose = 0
+        # Intra-query parallel scanning of cells, see `set_scan_threads`
+        self.num_threads = 1
+        self.min_candidates_per_thread = 10000
+        self.scan_pool = None
+        self.scan_pool_pid = None
+        self.scan_pool_lock = threading.Lock()
 
     def get_nb_indexed(self):
         return self.nb_indexed
 
+    def set_scan_threads(self, num_threads, min_candidates_per_thread=10000):
+        """
+        Set the number of threads used to score the cells retrieved by a single query.
+        Cells are split in contiguous groups of at least `min_candidates_per_thread`
+        candidates, so small queries are still scored in the calling thread.
+
+        :param int num_threads:
+            the maximum number of threads scoring the cells of a query, 1 to disable
+        :param int min_candidates_per_thread:
+            the minimum number of candidates scored by each thread
+        """
+        self.num_threads = max(1, int(num_threads))
+        self.min_candidates_per_thread = max(1, int(min_candidates_per_thread))
+        with self.scan_pool_lock:
+            if self.scan_pool is not None and self.scan_pool_pid == os.getpid():
+                self.scan_pool.close()
+            self.scan_pool = None
+
+    def get_scan_pool(self):
+        """
+        Get the thread pool scoring cells, created on first use. The pool is recreated
+        in a forked process, where the threads of the parent do not exist.
+        """
+        with self.scan_pool_lock:
+            if self.scan_pool is None or self.scan_pool_pid != os.getpid():
+                self.scan_pool = ThreadPool(self.num_threads)
+                self.scan_pool_pid = os.getpid()
+            return self.scan_pool
+
     def add_data(self, data, ids=None, num_procs=1):
         """
         Add raw data into the search index.
@@ -107,7 +418,18 @@ class LOPQSearcherBase(object):
         codes = compute_codes_parallel(data, self.model, num_procs)
         self.add_codes(codes, ids)
 
-    def get_result_quota(self, x, quota=10):
+    def get_cell_cached(self, cell, cell_cache=None):
+        """
+        Retrieve a cell bucket from the index, through `cell_cache` if provided
+        to share cell fetches between queries.
+        """
+        if cell_cache is None:
+            return self.get_cell(cell)
+        if cell not in cell_cache:
+            cell_cache[cell] = self.get_cell(cell)
+        return cell_cache[cell]
+
+    def get_result_quota(self, x, quota=10, sorted_coarse=None, cell_cache=None):
         """
         Given a query vector and result quota, retrieve as many cells as necessary
         to fill the quota.
@@ -116,6 +438,10 @@ class LOPQSearcherBase(object):
             a query vector
         :param int quota:
             the desired number of items to retrieve
+        :param tuple sorted_coarse:
+            optional precomputed sorted coarse distances of the query
+        :param dict cell_cache:
+            optional dict of already fetched cells, shared between queries of a batch
 
         :returns list retrieved:
             a list of index items
@@ -125,58 +451,309 @@ class LOPQSearcherBase(object):
         retrieved = []
         visited = 0
         # We should apply PCA here if model needs it.
-        for _, cell in multisequence(x, self.model.Cs):
-            retrieved += self.get_cell(cell)
-            visited += 1
+        for _, cells in multisequence_batches(x, self.model.Cs, sorted_coarse=sorted_coarse):
+            for cell in cells.tolist():
+                retrieved += self.get_cell_cached(tuple(cell), cell_cache)
+                visited += 1
 
-            if len(retrieved) >= quota:
-                break
+                if len(retrieved) >= quota:
+                    return retrieved, visited
 
         return retrieved, visited
 
-    def compute_distances(self, x, items):
+    def get_adc_table(self, x, coarse, memoized_tables):
         """
-        Given a query and a list of index items, compute the approximate distance of the query
-        to each item and return a list of tuples that contain the distance and the item.
-        Memoize subquantizer distances per coarse cluster to save work.
+        Get the stacked subquantizer distance lookup tables of a query for a coarse cell.
+        Tables of each coarse split are memoized per coarse cluster in `memoized_tables`.
+        Tables are computed from the precomputed terms of the model if it has them, see
+        `LOPQModel.precompute_adc_terms`.
 
         :param ndarray x:
             a query vector
-        :param list items:
-            a list of items from the index
+        :param tuple coarse:
+            the coarse codes of the cell
+        :param list memoized_tables:
+            a pair of dicts used to memoize tables per coarse cluster for each split
+
+        :returns ndarray:
+            a M x subquantizer_clusters array of distances of the query subvectors
+            to each subquantizer cluster
+        """
+        d0, d1 = memoized_tables
+        c0, c1 = coarse
 
-        :returns list:
-            a list of items with distance
+        if getattr(self.model, 'adc_terms', None) is not None:
+            if c0 not in d0:
+                d0[c0] = self.model.get_subquantizer_distances_precomputed(x, coarse, coarse_split=0)
+            if c1 not in d1:
+                d1[c1] = self.model.get_subquantizer_distances_precomputed(x, coarse, coarse_split=1)
+            return np.concatenate((d0[c0], d1[c1]))
+
+        if c0 not in d0:
+            d0[c0] = np.array(self.model.get_subquantizer_distances(x, coarse, coarse_split=0))
+
+        if c1 not in d1:
+            d1[c1] = np.array(self.model.get_subquantizer_distances(x, coarse, coarse_split=1))
+
+        return np.concatenate((d0[c0], d1[c1]))
+
+    def compute_codes_distances(self, x, coarse_codes, fine_codes, memoized_tables=None):
+        """
+        Given a query and arrays of codes, compute the approximate distance of the query
+        to each code. Codes are grouped by coarse cell and each cell is scored at once
+        with `adc_distances`.
+
+        :param ndarray x:
+            a query vector
+        :param ndarray coarse_codes:
+            a Nx2 array of coarse codes
+        :param ndarray fine_codes:
+            a NxM array of fine codes
+        :param list memoized_tables:
+            an optional pair of dicts to memoize lookup tables across calls for the same query
+
+        :returns ndarray:
+            a length N array of distances
+        """
+        if memoized_tables is None:
+            memoized_tables = [{}, {}]
+
+        N = coarse_codes.shape[0]
+        if N == 0:
+            return np.zeros(0)
+
+        # Group codes by cell, keeping items of the same cell contiguous
+        cell_ids = coarse_codes[:, 0].astype(np.int64) * self.model.V + coarse_codes[:, 1]
+        order = np.argsort(cell_ids, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(cell_ids[order])) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [N]))
+
+        dists = None
+        for start, end in zip(starts, ends):
+            rows = order[start:end]
+            coarse = tuple(coarse_codes[rows[0]])
+            table = self.get_adc_table(x, coarse, memoized_tables)
+            cell_dists = adc_distances(table, fine_codes[rows])
+            if dists is None:
+                dists = np.empty(N, dtype=cell_dists.dtype)
+            dists[rows] = cell_dists
+
+        return dists
+
+    def get_cell_codes(self, cell, cell_cache=None):
         """
-        memoized_subquant_dists = [{}, {}]
+        Retrieve the codes of a cell bucket, through `cell_cache` if provided.
 
-        def get_subquantizer_distances(x, coarse):
+        Backends storing codes as arrays should override this method along with
+        `build_retrieved_items` to avoid building Python tuples for every item.
 
-            d0, d1 = memoized_subquant_dists
-            c0, c1 = coarse
+        :param tuple cell:
+            a cell tuple
+        :param dict cell_cache:
+            optional dict of already fetched cells, shared between queries of a batch
+
+        :returns sequence items:
+            the index items of the cell, or any backend specific reference to them
+            understood by `build_retrieved_items`
+        :returns ndarray fine_codes:
+            the NxM matrix of fine codes of the items
+        """
+        items = self.get_cell_cached(cell, cell_cache)
+        fine_codes = np.array([item[1][1] for item in items]).reshape(-1, self.model.M)
+        return items, fine_codes
 
-            if c0 not in d0:
-                d0[c0] = self.model.get_subquantizer_distances(x, coarse, coarse_split=0)
+    def iter_cell_codes(self, x, sorted_coarse=None, cell_cache=None):
+        """
+        Traverse the multi-index cells of a query in multi-sequence order
+        and yield the codes of each cell.
 
-            if c1 not in d1:
-                d1[c1] = self.model.get_subquantizer_distances(x, coarse, coarse_split=1)
+        :param ndarray x:
+            a query vector
+        :param tuple sorted_coarse:
+            optional precomputed sorted coarse distances of the query
+        :param dict cell_cache:
+            optional dict of already fetched cells, shared between queries of a batch
+
+        :returns generator:
+            (cell_dist, cell, items, fine_codes) tuples where cell_dist is the distance of
+            the query to the cell centroid and items, fine_codes are from `get_cell_codes`
+        """
+        for dists, cells in multisequence_batches(x, self.model.Cs, sorted_coarse=sorted_coarse):
+            for cell_dist, cell in zip(dists.tolist(), cells.tolist()):
+                cell = tuple(cell)
+                items, fine_codes = self.get_cell_codes(cell, cell_cache)
+                yield cell_dist, cell, items, fine_codes
 
-            return d0[c0] + d1[c1]
+    def stack_cell_codes(self, cells, cell_items, cell_fine_codes):
+        """
+        Stack the codes of several non empty cells into coarse and fine codes arrays.
+        """
+        if not cells:
+            coarse_codes = np.zeros((0, self.model.num_coarse_splits), dtype=int)
+            fine_codes = np.zeros((0, self.model.M), dtype=get_fine_codes_dtype(self.model))
+            return coarse_codes, fine_codes
 
-        results = []
-        for item in items:
+        coarse_codes = np.repeat(np.array(cells), [len(items) for items in cell_items], axis=0)
+        fine_codes = np.concatenate(cell_fine_codes)
+        return coarse_codes, fine_codes
 
-            codes = item[1]
-            coarse, fine = codes
+    def build_retrieved_items(self, cell_items, coarse_codes, fine_codes):
+        """
+        Build the sequence of retrieved index items, indexable by position,
+        from the items of the visited cells as returned by `get_cell_codes`.
+        """
+        return [item for items in cell_items for item in items]
 
-            subquantizer_distances = get_subquantizer_distances(x, coarse)
-            dist = sum([subquantizer_distances[i][fc] for i, fc in enumerate(fine)])
+    def get_result_quota_codes(self, x, quota=10, sorted_coarse=None, cell_cache=None):
+        """
+        Given a query vector and result quota, retrieve as many cells as necessary
+        to fill the quota and return the retrieved codes as arrays.
 
-            results.append((dist, item))
+        :param ndarray x:
+            a query vector
+        :param int quota:
+            the desired number of items to retrieve
+        :param tuple sorted_coarse:
+            optional precomputed sorted coarse distances of the query
+        :param dict cell_cache:
+            optional dict of already fetched cells, shared between queries of a batch
+
+        :returns sequence retrieved:
+            a sequence of index items, i.e. (id, code) pairs, indexable by position
+        :returns ndarray coarse_codes:
+            a Nx2 array of the coarse codes of the retrieved items
+        :returns ndarray fine_codes:
+            a NxM array of the fine codes of the retrieved items
+        :returns int visited:
+            the number of multi-index cells visited
+        """
+        cells, cell_items, cell_fine_codes, visited = self.get_result_quota_cells(x, quota, sorted_coarse, cell_cache)
+        coarse_codes, fine_codes = self.stack_cell_codes(cells, cell_items, cell_fine_codes)
+        retrieved = self.build_retrieved_items(cell_items, coarse_codes, fine_codes)
+        return retrieved, coarse_codes, fine_codes, visited
 
-        return results
+    def get_result_quota_cells(self, x, quota=10, sorted_coarse=None, cell_cache=None):
+        """
+        Given a query vector and result quota, retrieve as many cells as necessary
+        to fill the quota and return the codes of the non empty cells.
+
+        :returns list cells:
+            the non empty cells visited, in traversal order
+        :returns list cell_items:
+            the items of each cell, as returned by `get_cell_codes`
+        :returns list cell_fine_codes:
+            the NxM fine codes of each cell
+        :returns int visited:
+            the number of multi-index cells visited
+        """
+        cells = []
+        cell_items = []
+        cell_fine_codes = []
+        nb_retrieved = 0
+        visited = 0
+        for _, cell, items, fine_codes in self.iter_cell_codes(x, sorted_coarse, cell_cache):
+            visited += 1
+            if len(items):
+                cells.append(cell)
+                cell_items.append(items)
+                cell_fine_codes.append(fine_codes)
+                nb_retrieved += len(items)
+            if nb_retrieved >= quota:
+                break
+
+        return cells, cell_items, cell_fine_codes, visited
+
+    def score_cells(self, x, cells, cell_fine_codes, limit, start=0):
+        """
+        Compute the distances of a query to the codes of a list of cells and select the
+        best ones. This is the kernel run by each thread of `scan_cells`.
+
+        :param ndarray x:
+            a query vector
+        :param list cells:
+            the cells to score
+        :param list cell_fine_codes:
+            the NxM fine codes of each cell
+        :param int limit:
+            the number of best items to select
+        :param int start:
+            the position of the first item of the cells among all retrieved items
+
+        :returns ndarray selected:
+            the positions of the selected items, sorted by distance
+        :returns ndarray dists:
+            the distances of the selected items
+        """
+        memoized_tables = [{}, {}]
+        dists = [adc_distances(self.get_adc_table(x, cell, memoized_tables), fine_codes)
+                 for cell, fine_codes in zip(cells, cell_fine_codes)]
+        dists = np.concatenate(dists) if dists else np.zeros(0)
+        selected = top_k_order(dists, limit)
+        return selected + start, dists[selected]
+
+    def scan_cells(self, x, cells, cell_fine_codes, limit):
+        """
+        Score the codes of the retrieved cells of a query and select the best ones. With
+        several scan threads, cells are split in contiguous groups of similar numbers of
+        candidates that are scored concurrently, the NumPy kernels releasing the GIL, and
+        the best items of each group are merged. Ties are kept in retrieval order, so the
+        results are the same as when scoring all cells at once.
+
+        :returns ndarray selected:
+            the positions of the selected items among the retrieved items, sorted by distance
+        :returns ndarray dists:
+            the distances of the selected items
+        """
+        sizes = [len(fine_codes) for fine_codes in cell_fine_codes]
+        nb_retrieved = sum(sizes)
+        num_groups = min(self.num_threads, nb_retrieved // self.min_candidates_per_thread, len(cells))
+        if num_groups <= 1:
+            return self.score_cells(x, cells, cell_fine_codes, limit)
+
+        ends = np.cumsum(sizes)
+        bounds = np.searchsorted(ends, nb_retrieved * np.arange(1, num_groups) / float(num_groups))
+        bounds = np.concatenate(([0], bounds + 1, [len(cells)]))
+        starts = np.concatenate(([0], ends))
+
+        def score_group(group):
+            first, last = bounds[group], bounds[group + 1]
+            return self.score_cells(x, cells[first:last], cell_fine_codes[first:last], limit, starts[first])
+
+        groups = [group for group in xrange(num_groups) if bounds[group] < bounds[group + 1]]
+        results = self.get_scan_pool().map(score_group, groups)
+
+        # Groups are in retrieval order and sorted by distance then position, so ties of the
+        # concatenated lists stay in retrieval order
+        selected = np.concatenate([group_selected for group_selected, _ in results])
+        dists = np.concatenate([group_dists for _, group_dists in results])
+        order = top_k_order(dists, limit)
+        return selected[order], dists[order]
+
+    def compute_distances(self, x, items):
+        """
+        Given a query and a list of index items, compute the approximate distance of the query
+        to each item and return a list of tuples that contain the distance and the item.
+        Memoize subquantizer distances per coarse cluster to save work.
 
-    def search(self, x, quota=10, limit=None, with_dists=False):
+        :param ndarray x:
+            a query vector
+        :param list items:
+            a list of items from the index
+
+        :returns list:
+            a list of items with distance
+        """
+        if not items:
+            return []
+
+        coarse_codes = np.array([item[1][0] for item in items])
+        fine_codes = np.array([item[1][1] for item in items])
+        dists = self.compute_codes_distances(x, coarse_codes, fine_codes)
+
+        return zip(dists, items)
+
+    def search(self, x, quota=10, limit=None, with_dists=False, cell_cutoff=False):
         """
         Return euclidean distance ranked results, along with the number of cells
         traversed to fill the quota.
@@ -189,6 +766,12 @@ class LOPQSearcherBase(object):
             the number of desired results to return - defaults to quota
         :param bool with_dists:
             boolean indicating whether result items should be returned with their distance
+        :param bool cell_cutoff:
+            boolean indicating whether to stop visiting cells before the quota is filled once
+            the distance of the query to the next cell centroid is above the distance of the
+            limit-th best result so far. Cells are visited by increasing centroid distance, so
+            the remaining cells are unlikely to improve the results, but as the centroid distance
+            is not a strict lower bound of item distances this may trade some recall for speed
 
         :returns list results:
             the list of ranked results
@@ -199,30 +782,127 @@ class LOPQSearcherBase(object):
             print "Performing search with PCA projected feature since model is LOPQModelPCA"
             x = self.model.apply_PCA(x)
 
-        # Retrieve results with multi-index
-        retrieved, visited = self.get_result_quota(x, quota)
+        return self.search_projected(x, quota, limit, with_dists, cell_cutoff=cell_cutoff)
+
+    def search_batch(self, X, quota=10, limit=None, with_dists=False, cell_cutoff=False):
+        """
+        Search a batch of queries at once. PCA (for LOPQModelPCA) and coarse distances are
+        computed for all queries with matrix products, and cells visited by several queries
+        are only fetched once from the index.
+
+        :param ndarray X:
+            a NxD array of query vectors
+        :param int quota:
+            the number of desired results to rank for each query
+        :param int limit:
+            the number of desired results to return for each query - defaults to quota
+        :param bool with_dists:
+            boolean indicating whether result items should be returned with their distance
+        :param bool cell_cutoff:
+            boolean indicating whether to stop visiting cells early, see `search`
+
+        :returns list all_results:
+            the list of ranked results of each query
+        :returns list all_visited:
+            the number of cells visited by each query
+        """
+        X = np.atleast_2d(X)
+        if type(self.model) == LOPQModelPCA:
+            X = self.model.apply_PCA(X)
+
+        return self.search_projected_batch(X, quota, limit, with_dists, cell_cutoff)
+
+    def search_projected_batch(self, X, quota=10, limit=None, with_dists=False, cell_cutoff=False):
+        """
+        Search a batch of query vectors that are already in the model space, i.e. PCA projected
+        for LOPQModelPCA. See `search_batch` for the parameters and returned values.
+        """
+        all_sorted_coarse = get_sorted_coarse_distances_batch(X, self.model.Cs)
+        cell_cache = dict()
 
-        # Compute distance for results
-        results = self.compute_distances(x, retrieved)
+        all_results = []
+        all_visited = []
+        for x, sorted_coarse in zip(X, all_sorted_coarse):
+            results, visited = self.search_projected(x, quota, limit, with_dists, sorted_coarse, cell_cache,
+                                                     cell_cutoff)
+            all_results.append(results)
+            all_visited.append(visited)
 
-        # Sort by distance
-        # NB: could be a partial up to limit, interesting if limit << quota
-        results = sorted(results, key=lambda d: d[0])
+        return all_results, all_visited
 
+    def search_projected(self, x, quota=10, limit=None, with_dists=False, sorted_coarse=None, cell_cache=None,
+                         cell_cutoff=False):
+        """
+        Search with a query vector that is already in the model space, i.e. PCA projected
+        for LOPQModelPCA. See `search` for the parameters and returned values.
+        """
         # Limit number returned
         if limit is None:
             limit = quota
-        results = results[:limit]
 
-        if with_dists:
-            Result = namedtuple('Result', ['id', 'code', 'dist'])
-            results = map(lambda d: Result(d[1][0], d[1][1], d[0]), results)
-        else:
-            Result = namedtuple('Result', ['id', 'code'])
-            results = map(lambda d: Result(d[1][0], d[1][1]), results)
+        if self.num_threads > 1 and not cell_cutoff:
+            # Retrieve all the cells first and score them in parallel
+            cells, cell_items, cell_fine_codes, visited = self.get_result_quota_cells(x, quota, sorted_coarse,
+                                                                                       cell_cache)
+            selected, dists = self.scan_cells(x, cells, cell_fine_codes, limit)
+            coarse_codes, fine_codes = self.stack_cell_codes(cells, cell_items, cell_fine_codes)
+            retrieved = self.build_retrieved_items(cell_items, coarse_codes, fine_codes)
+            return self.build_results(retrieved, selected, dists, with_dists), visited
+
+        # Retrieve results with multi-index, scoring each cell as it is visited
+        memoized_tables = [{}, {}]
+        cells = []
+        cell_items = []
+        cell_fine_codes = []
+        cell_dists = []
+        best_dists = np.zeros(0)
+        kth_dist = np.inf
+        nb_retrieved = 0
+        visited = 0
+        for cell_dist, cell, items, fine_codes in self.iter_cell_codes(x, sorted_coarse, cell_cache):
+            if cell_cutoff and cell_dist > kth_dist:
+                break
+            visited += 1
+            if len(items):
+                dists = adc_distances(self.get_adc_table(x, cell, memoized_tables), fine_codes)
+                cells.append(cell)
+                cell_items.append(items)
+                cell_fine_codes.append(fine_codes)
+                cell_dists.append(dists)
+                nb_retrieved += len(items)
+
+                # Keep track of the limit-th best distance so far
+                if cell_cutoff and limit > 0:
+                    best_dists = np.concatenate((best_dists, dists))
+                    if len(best_dists) >= limit:
+                        best_dists = np.partition(best_dists, limit - 1)[:limit]
+                        kth_dist = best_dists[-1]
+            if nb_retrieved >= quota:
+                break
+
+        coarse_codes, fine_codes = self.stack_cell_codes(cells, cell_items, cell_fine_codes)
+        retrieved = self.build_retrieved_items(cell_items, coarse_codes, fine_codes)
+        dists = np.concatenate(cell_dists) if cell_dists else np.zeros(0)
 
-        return results, visited
+        # Select and sort the top results only, keeping retrieval order between ties
+        order = top_k_order(dists, limit)
 
+        return self.build_results(retrieved, order, dists[order], with_dists), visited
+
+    def build_results(self, retrieved, selected, dists, with_dists=False):
+        """
+        Build the list of results from the positions of the selected retrieved items
+        and their distances.
+        """
+        results = []
+        for i, dist in zip(selected, dists):
+            item_id, code = retrieved[i]
+            if with_dists:
+                results.append(SearchResultWithDist(item_id, code, dist))
+            else:
+                results.append(SearchResult(item_id, code))
+
+        return results
 
     def _add_codes_from_one_file(self, one_file, samples_count):
         import ast
@@ -282,6 +962,23 @@ class LOPQSearcherBase(object):
             list_ids.append(k)
         self.add_codes(list_codes, list_ids)
 
+    def add_codes_arrays(self, coarse_codes, fine_codes, ids):
+        """
+        Add LOPQ codes given as arrays into the search index, e.g. the codes of a
+        `lopq.codes.CodesBatch`. Backends storing codes as arrays add them without
+        building a Python tuple for each code.
+
+        :param ndarray coarse_codes:
+            a N x 2 array of coarse codes
+        :param ndarray fine_codes:
+            a N x M array of fine codes
+        :param ndarray ids:
+            a length N array of ids
+        """
+        ids = ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+        codes = [LOPQCode(tuple(coarse), tuple(fine))
+                 for coarse, fine in zip(np.asarray(coarse_codes).tolist(), np.asarray(fine_codes).tolist())]
+        self.add_codes(codes, ids)
 
     def add_codes(self, codes, ids=None):
         """
@@ -309,18 +1006,67 @@ class LOPQSearcherBase(object):
 
 class LOPQSearcher(LOPQSearcherBase):
     
-    def __init__(self, model):
+    def __init__(self, model, dedup='set', bloom_capacity=10000000, bloom_error_rate=0.001):
         """
         Create an LOPQSearcher instance that encapsulates retrieving and ranking
         with LOPQ. Requires an LOPQModel instance. This class uses a Python dict
         to implement the index.
 
+        Items already in a cell are discarded when added again. With the 'set' dedup mode,
+        a set of the ids of each cell is maintained along the index, so the cost of adding
+        items does not depend on the size of the index. With the 'bloom' mode, a Bloom filter
+        of (cell, id) pairs is maintained instead, using about 2 bytes per item, and a cell
+        is only scanned when the filter reports a possible duplicate. With the 'scan' mode,
+        each cell receiving new items is scanned once per call.
+
         :param LOPQModel model:
             the model for indexing and ranking
+        :param str dedup:
+            the duplicate detection mode, one of 'set', 'bloom' or 'scan'
+        :param int bloom_capacity:
+            the number of items the Bloom filter is sized for in 'bloom' mode
+        :param float bloom_error_rate:
+            the false positive rate of the Bloom filter at capacity in 'bloom' mode
         """
+        if dedup not in DEDUP_MODES:
+            raise ValueError('Unknown dedup mode {}, should be one of {}'.format(dedup, DEDUP_MODES))
+
         super(LOPQSearcher, self).__init__()
         self.model = model
         self.index = defaultdict(list)
+        self.dedup = dedup
+        self.cell_ids = defaultdict(set) if dedup == 'set' else None
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate) if dedup == 'bloom' else None
+
+    def get_bloom_key(self, cell, item_id):
+        """
+        Get the Bloom filter key of an item of a cell, equal for ids that compare equal
+        whatever their type, e.g. str and unicode or int and numpy integers.
+        """
+        return '%r:%s' % (tuple(cell), item_id)
+
+    def is_duplicate(self, cell, item_id, scanned_ids):
+        """
+        Check if an item is already in a cell.
+
+        :param tuple cell:
+            a cell tuple
+        :param item_id:
+            the id of the item
+        :param dict scanned_ids:
+            the sets of ids of the cells scanned in the current call to `add_codes`
+
+        :returns bool:
+            True if the item is already in the cell
+        """
+        if self.dedup == 'set':
+            return cell in self.cell_ids and item_id in self.cell_ids[cell]
+        if self.dedup == 'bloom' and self.get_bloom_key(cell, item_id) not in self.bloom:
+            return False
+        # Possible duplicate, check exactly by scanning the cell once
+        if cell not in scanned_ids:
+            scanned_ids[cell] = set(iid for iid, _ in self.index.get(cell, []))
+        return item_id in scanned_ids[cell]
 
     def add_codes(self, codes, ids=None):
         """
@@ -337,7 +1083,7 @@ class LOPQSearcher(LOPQSearcherBase):
             ids = count()
             # Should we add the current number of indexed samples?
 
-        dict_ids = dict()
+        scanned_ids = dict()
 
         for item_id, code in zip(ids, codes):
             try:
@@ -346,18 +1092,17 @@ class LOPQSearcher(LOPQSearcherBase):
                 #    If we have many collisions that could be beneficial
                 # We need to avoid duplicate insertions,
                 # to deal with images that could appear in two different updates...
-                if cell not in dict_ids:
-                    dict_ids[cell] = set()
-                    if cell in self.index:
-                        for iid, _ in self.index[cell]:
-                            dict_ids[cell].add(iid)
-                # should the cell maintain the set of item_id too?
-                # or just get it and memoize it in this method?
-                if item_id not in dict_ids[cell]:
+                if not self.is_duplicate(cell, item_id, scanned_ids):
                     # if code[0] is cell, why do we store it?
                     # are codes memory optimized here? using the smallest uint possible?
                     self.index[cell].append((item_id, code))
-                    dict_ids[cell].add(item_id)
+                    if self.dedup == 'set':
+                        self.cell_ids[cell].add(item_id)
+                    else:
+                        if self.dedup == 'bloom':
+                            self.bloom.add(self.get_bloom_key(cell, item_id))
+                        if cell in scanned_ids:
+                            scanned_ids[cell].add(item_id)
                     self.nb_indexed += 1
                 else:
                     if self.verbose > 0:
@@ -368,6 +1113,79 @@ class LOPQSearcher(LOPQSearcherBase):
                 #from cufacesearch.common.error import full_trace_error
                 #full_trace_error(err_msg)
 
+    def reset_dedup_state(self):
+        """
+        Rebuild the duplicate detection state from the index, e.g. after restoring it.
+        """
+        if self.dedup == 'set':
+            self.cell_ids = defaultdict(set)
+            for cell, items in self.index.iteritems():
+                self.cell_ids[cell] = set(iid for iid, _ in items)
+        elif self.dedup == 'bloom':
+            self.bloom = BloomFilter(self.bloom.capacity, self.bloom.error_rate)
+            for cell, items in self.index.iteritems():
+                for iid, _ in items:
+                    self.bloom.add(self.get_bloom_key(cell, iid))
+
+    def save_snapshot(self, path):
+        """
+        Save the index to a segment file (see `lopq.segment`), the codes being written
+        cell by cell so that the index is never copied in memory. Ids must be either all
+        integers or all strings, unicode ids being stored as utf-8.
+
+        :param str path:
+            the path of the snapshot file
+        """
+        V, M = self.model.V, self.model.M
+        cells = [cell for cell, items in self.index.iteritems() if items]
+
+        # First pass to get the size of each cell and the type of the ids
+        cell_counts = np.zeros(V * V, dtype=np.int64)
+        id_kinds = set()
+        id_width = 1
+        for cell in cells:
+            cell_counts[self.model.get_cell_id_for_coarse_codes(cell)] = len(self.index[cell])
+            ids = normalize_ids([iid for iid, _ in self.index[cell]])
+            id_kinds.add(ids.dtype.kind)
+            id_width = max(id_width, ids.dtype.itemsize)
+        if len(id_kinds) > 1:
+            raise ValueError('Cannot snapshot an index mixing integer and string ids')
+        id_dtype = np.dtype('S{}'.format(id_width)) if 'S' in id_kinds else np.dtype('<i8')
+
+        def iter_cells():
+            for cell in cells:
+                items = self.index[cell]
+                fine_codes = np.array([code[1] for _, code in items], dtype=get_fine_codes_dtype(self.model))
+                yield self.model.get_cell_id_for_coarse_codes(cell), [iid for iid, _ in items], fine_codes
+
+        write_segment_cells(path, V, M, get_fine_codes_dtype(self.model), id_dtype, cell_counts, iter_cells())
+
+    def load_snapshot(self, path):
+        """
+        Replace the index by a snapshot written by `save_snapshot`, reading the
+        snapshot file once sequentially.
+
+        :param str path:
+            the path of the snapshot file
+        """
+        segment = LOPQSegment(path)
+        if segment.V != self.model.V or segment.M != self.model.M:
+            raise ValueError('Snapshot {} of a model with V={} and M={} does not match the model'.format(
+                path, segment.V, segment.M))
+
+        index = defaultdict(list)
+        offsets = np.asarray(segment.offsets)
+        for cell_id in np.flatnonzero(np.diff(offsets)):
+            start, end = offsets[cell_id], offsets[cell_id + 1]
+            cell = self.model.get_coarse_codes_for_cell_id(int(cell_id))
+            ids = segment.ids[start:end].tolist()
+            fine_codes = segment.fine_codes[start:end].tolist()
+            index[cell] = [(iid, LOPQCode(cell, tuple(fine))) for iid, fine in zip(ids, fine_codes)]
+        del segment
+
+        self.index = index
+        self.nb_indexed = sum(len(items) for items in index.itervalues())
+        self.reset_dedup_state()
 
     def get_cell(self, cell):
         """
@@ -382,12 +1200,59 @@ class LOPQSearcher(LOPQSearcherBase):
         return self.index[cell]
 
 
+class EncodedIds(object):
+    """
+    Lazy sequence of the ids stored in a LOPQSearcherLMDB cell value,
+    ids are only decoded when accessed.
+    """
+
+    def __init__(self, ids_bytes, offsets, id_lambda):
+        self.ids_bytes = ids_bytes
+        self.offsets = offsets
+        self.id_lambda = id_lambda
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.id_lambda(self.get_bytes(i))
+
+    def get_bytes(self, i):
+        return self.ids_bytes[self.offsets[i]:self.offsets[i + 1]]
+
+
+class ChainedSequence(object):
+    """
+    Read-only concatenation of sequences, indexable by position.
+    """
+
+    def __init__(self, sequences):
+        self.sequences = sequences
+        self.starts = np.cumsum([0] + [len(seq) for seq in sequences])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        k = np.searchsorted(self.starts, i, side='right') - 1
+        return self.sequences[k][i - self.starts[k]]
+
+
 class LOPQSearcherLMDB(LOPQSearcherBase):
     def __init__(self, model, lmdb_path, id_lambda=int):
         """
         Create an LOPQSearcher instance that encapsulates retrieving and ranking
         with LOPQ. Requires an LOPQModel instance. This class uses an lmbd database
-        to implement the index.
+        to implement the index. The items of a cell are stored in chunks appended
+        to the cell, each chunk value holding the fine codes and the ids of a batch
+        of items. Duplicates are discarded against the ids stored in the chunks of the
+        cell, so no key is written per item.
+
+        Chunks are merged when the last chunks of a cell are not larger than the new
+        one, so a cell has a logarithmic number of chunks and adding items does not
+        rewrite whole cells.
+
+        An index written with one key per item is converted when opened.
 
         :param LOPQModel model:
             the model for indexing and ranking
@@ -399,9 +1264,13 @@ class LOPQSearcherLMDB(LOPQSearcherBase):
         """
         import lmdb
 
+        super(LOPQSearcherLMDB, self).__init__()
         self.model = model
         self.lmdb_path = lmdb_path
         self.id_lambda = id_lambda
+        self.fine_dtype = np.dtype(get_fine_codes_dtype(model)).newbyteorder('<')
+        # Big endian cell ids so that keys are sorted like cell ids
+        self.cell_key_dtype = np.dtype('>u2') if model.V * model.V <= 65536 else np.dtype('>u4')
 
         # TODO: pass memory size, index_db name as parameters?
         # Should we have another DB to list (permanently) the updates we have indexed?
@@ -413,34 +1282,518 @@ class LOPQSearcherLMDB(LOPQSearcherBase):
         #self.env = lmdb.open(self.lmdb_path, map_size=1024*1000000*2, writemap=False, map_async=True, max_dbs=1)
         # self.env = lmdb.open(self.lmdb_path, map_size=1024 * 1000000 * 32,
         #                      writemap=True, map_async=True, max_dbs=1)
-        self.env = lmdb.open(self.lmdb_path, map_size=1024 * 1000000 * 32, max_dbs=1)
-        self.index_db = self.env.open_db("index")
+        self.env = lmdb.open(self.lmdb_path, map_size=1024 * 1000000 * 32, max_dbs=3)
+        self.cells_db = self.env.open_db("cells")
+        self.meta_db = self.env.open_db("meta")
+
+        try:
+            legacy_db = self.env.open_db("index", create=False)
+        except lmdb.NotFoundError:
+            legacy_db = None
+        if legacy_db is not None:
+            self.migrate_legacy_index(legacy_db)
+
+        self.get_nb_indexed()
 
     def get_nb_indexed(self):
-        with self.env.begin(self.index_db, write=False) as txn:
-            self.nb_indexed = txn.stat()['entries']
+        with self.env.begin(db=self.meta_db, write=False) as txn:
+            nb_indexed = txn.get(b'nb_indexed')
+        self.nb_indexed = int(nb_indexed) if nb_indexed else 0
         return self.nb_indexed
 
-
     def encode_cell(self, cell):
-        # TODO: type should be adapted to number of coarse clusters
-        return array.array("H", cell).tostring()
+        cell_id = self.model.get_cell_id_for_coarse_codes(cell)
+        return np.array(cell_id, dtype=self.cell_key_dtype).tobytes()
 
     def decode_cell(self, cell_bytes):
-        # TODO: type should be adapted to number of coarse clusters
-        a = array.array("H")
-        a.fromstring(cell_bytes)
-        return tuple(a.tolist())
+        cell_id = int(np.frombuffer(cell_bytes[:self.cell_key_dtype.itemsize], dtype=self.cell_key_dtype)[0])
+        return self.model.get_coarse_codes_for_cell_id(cell_id)
+
+    def encode_chunk_key(self, cell_key, seq):
+        """
+        Build the key of the chunk `seq` of a cell, chunks of a cell being sorted by sequence number.
+        """
+        return cell_key + np.array(seq, dtype='>u4').tobytes()
+
+    def decode_chunk_seq(self, chunk_key):
+        return int(np.frombuffer(chunk_key[self.cell_key_dtype.itemsize:], dtype='>u4')[0])
 
-    def encode_fine_codes(self, fine):
-        # TODO: type should be adapted to number of fine clusters
-        return array.array("B", fine).tostring()
+    def encode_cell_value(self, fine_codes, ids_bytes):
+        """
+        Encode the items of a chunk as: the number of items N as uint32, the NxM fine codes,
+        N+1 uint32 offsets of the ids in the ids block, and the ids block.
 
-    def decode_fine_codes(self, fine_bytes):
-        # TODO: type should be adapted to number of fine clusters
-        a = array.array("B")
-        a.fromstring(fine_bytes)
-        return tuple(a.tolist())
+        :param ndarray fine_codes:
+            the NxM fine codes of the items
+        :param list ids_bytes:
+            the string representation of the item ids
+
+        :returns bytes:
+            the encoded chunk
+        """
+        offsets = np.zeros(len(ids_bytes) + 1, dtype='<u4')
+        np.cumsum([len(b) for b in ids_bytes], out=offsets[1:])
+        n = np.array(len(ids_bytes), dtype='<u4')
+        fine_codes = np.ascontiguousarray(fine_codes, dtype=self.fine_dtype)
+        return n.tobytes() + fine_codes.tobytes() + offsets.tobytes() + b''.join(ids_bytes)
+
+    def decode_cell_value(self, value):
+        """
+        Decode a chunk value, see `encode_cell_value`.
+
+        :returns EncodedIds ids:
+            the lazily decoded ids of the items
+        :returns ndarray fine_codes:
+            the NxM fine codes of the items
+        """
+        buf = np.frombuffer(value, dtype=np.uint8)
+        n = int(buf[:4].view('<u4')[0])
+        fine_end = 4 + n * self.model.M * self.fine_dtype.itemsize
+        offsets_end = fine_end + 4 * (n + 1)
+        fine_codes = buf[4:fine_end].view(self.fine_dtype).reshape(n, self.model.M)
+        offsets = buf[fine_end:offsets_end].view('<u4')
+        return EncodedIds(value[offsets_end:], offsets, self.id_lambda), fine_codes
+
+    def get_chunk_size(self, value):
+        return int(np.frombuffer(value[:4], dtype='<u4')[0])
+
+    def add_codes(self, codes, ids=None):
+        """
+        Add LOPQ codes into the search index. Items of a cell that already has
+        an item with the same id are discarded.
+
+        :param iterable codes:
+            an iterable of LOPQ code tuples
+        :param iterable ids:
+            an optional iterable of ids for each code;
+            defaults to the index of the code tuple if not provided
+        """
+        # If a list of ids is not provided, assume it is the index of the data
+        if ids is None:
+            ids = count(self.get_nb_indexed())
+
+        # Group new items per cell key
+        new_fine = defaultdict(list)
+        new_ids = defaultdict(list)
+        for item_id, code in zip(ids, codes):
+            key = self.encode_cell(code[0])
+            new_fine[key].append(code[1])
+            new_ids[key].append(bytes(item_id))
+        self.add_cell_items(new_fine, new_ids)
+
+    def add_codes_arrays(self, coarse_codes, fine_codes, ids):
+        """
+        Add LOPQ codes given as arrays into the search index, grouping items per cell
+        with array operations. Items of a cell that already has an item with the same
+        id are discarded.
+
+        :param ndarray coarse_codes:
+            a N x 2 array of coarse codes
+        :param ndarray fine_codes:
+            a N x M array of fine codes
+        :param ndarray ids:
+            a length N array of ids
+        """
+        coarse_codes = np.asarray(coarse_codes, dtype=np.int64).reshape(-1, 2)
+        fine_codes = np.asarray(fine_codes, dtype=self.fine_dtype).reshape(-1, self.model.M)
+        ids = ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+        new_fine = dict()
+        new_ids = dict()
+        cell_ids = self.model.get_cell_id_for_coarse_codes(coarse_codes.T)
+        for cell_id, inds in group_by_cell(cell_ids):
+            key = np.array(cell_id, dtype=self.cell_key_dtype).tobytes()
+            new_fine[key] = fine_codes[inds]
+            new_ids[key] = [bytes(ids[i]) for i in inds]
+        self.add_cell_items(new_fine, new_ids)
+
+    def add_cell_items(self, new_fine, new_ids):
+        """
+        Add new items to their cells in a single write transaction, as a new chunk
+        of each cell.
+
+        :param dict new_fine:
+            the fine codes of the new items of each cell key, as a list or an array
+        :param dict new_ids:
+            the string representation of the ids of the new items of each cell key
+        """
+        with self.env.begin(write=True) as txn:
+            cursor = txn.cursor(db=self.cells_db)
+            nb_added = 0
+            for key in sorted(new_ids):
+                # Discard duplicates of items already in the cell or earlier in the batch
+                seen = self.get_cell_id_set(cursor, key)
+                keep = []
+                for i, item_id in enumerate(new_ids[key]):
+                    if item_id in seen:
+                        if self.verbose > 0:
+                            print 'Discarding duplicate sample: {}'.format(item_id)
+                        continue
+                    seen.add(item_id)
+                    keep.append(i)
+                if not keep:
+                    continue
+
+                fine_codes = np.array(new_fine[key], dtype=self.fine_dtype).reshape(-1, self.model.M)[keep]
+                ids_bytes = [new_ids[key][i] for i in keep]
+                self.append_cell_chunk(txn, cursor, key, fine_codes, ids_bytes)
+                nb_added += len(keep)
+            cursor.close()
+
+            nb_indexed = txn.get(b'nb_indexed', db=self.meta_db)
+            self.nb_indexed = (int(nb_indexed) if nb_indexed else 0) + nb_added
+            txn.put(b'nb_indexed', bytes(self.nb_indexed), db=self.meta_db)
+
+    def get_cell_id_set(self, cursor, cell_key):
+        """
+        Get the set of the string representation of the ids stored in the chunks of a cell.
+        """
+        ids = set()
+        if cursor.set_range(cell_key):
+            for key, value in cursor:
+                if key[:len(cell_key)] != cell_key:
+                    break
+                chunk_ids, _ = self.decode_cell_value(value)
+                ids.update(chunk_ids.get_bytes(i) for i in xrange(len(chunk_ids)))
+        return ids
+
+    def append_cell_chunk(self, txn, cursor, cell_key, fine_codes, ids_bytes):
+        """
+        Append the items of a cell as a new chunk, merged with the last chunks of the cell
+        that are not larger, so that a cell of N items has at most about log2(N) chunks.
+        """
+        merged = []
+        seq = 0
+        # Position the cursor on the last chunk of the cell, if any
+        if cursor.set_range(self.encode_chunk_key(cell_key, 0xffffffff)):
+            found = cursor.prev()
+        else:
+            found = cursor.last()
+        size = len(ids_bytes)
+        while found and cursor.key()[:len(cell_key)] == cell_key:
+            chunk_size = self.get_chunk_size(cursor.value())
+            if chunk_size > size:
+                seq = self.decode_chunk_seq(cursor.key()) + 1
+                break
+            merged.insert(0, (cursor.key(), self.decode_cell_value(cursor.value())))
+            size += chunk_size
+            found = cursor.prev()
+
+        if merged:
+            seq = self.decode_chunk_seq(merged[0][0])
+            for chunk_key, _ in merged[1:]:
+                txn.delete(chunk_key, db=self.cells_db)
+            fine_codes = np.concatenate([chunk_fine for _, (_, chunk_fine) in merged] + [fine_codes])
+            ids_bytes = [chunk_ids.get_bytes(i) for _, (chunk_ids, _) in merged
+                         for i in xrange(len(chunk_ids))] + list(ids_bytes)
+        chunk_key = self.encode_chunk_key(cell_key, seq)
+        # New cells after the last key are appended without B-tree searches
+        append = not cursor.last() or chunk_key > cursor.key()
+        txn.put(chunk_key, self.encode_cell_value(fine_codes, ids_bytes), db=self.cells_db, append=append)
+
+    def migrate_legacy_index(self, legacy_db, batch_size=100000):
+        """
+        Convert an index written with the previous layout, i.e. one key per item made of
+        the cell as two native 'H' followed by the item id, and the fine codes as 'B' value,
+        then drop it.
+        """
+        print 'Converting LMDB index {} to chunked cells'.format(self.lmdb_path)
+        codes = []
+        ids = []
+        with self.env.begin(db=legacy_db) as txn:
+            for key, value in txn.cursor():
+                cell = array.array("H")
+                cell.fromstring(key[:4])
+                fine = array.array("B")
+                fine.fromstring(value)
+                codes.append((tuple(cell.tolist()), tuple(fine.tolist())))
+                ids.append(key[4:])
+                if len(codes) >= batch_size:
+                    self.add_codes(codes, ids)
+                    codes, ids = [], []
+        if codes:
+            self.add_codes(codes, ids)
+        with self.env.begin(write=True) as txn:
+            txn.drop(legacy_db, delete=True)
+
+    def get_cell_codes(self, cell, cell_cache=None):
+        """
+        Retrieve the codes of a cell bucket, through `cell_cache` if provided.
+
+        :param tuple cell:
+            a cell tuple
+        :param dict cell_cache:
+            optional dict of already fetched cells, shared between queries of a batch
+
+        :returns EncodedIds ids:
+            the lazily decoded ids of the items
+        :returns ndarray fine_codes:
+            the NxM fine codes of the items
+        """
+        if cell_cache is not None and cell in cell_cache:
+            return cell_cache[cell]
+
+        cell_key = self.encode_cell(cell)
+        chunks = []
+        with self.env.begin(db=self.cells_db) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(cell_key):
+                for key, value in cursor:
+                    if key[:len(cell_key)] != cell_key:
+                        break
+                    chunks.append(self.decode_cell_value(value))
+        if not chunks:
+            cell_codes = EncodedIds(b'', [0], self.id_lambda), np.zeros((0, self.model.M), dtype=self.fine_dtype)
+        elif len(chunks) == 1:
+            cell_codes = chunks[0]
+        else:
+            # Concatenate the ids blocks of the chunks, shifting their offsets
+            offsets = [np.zeros(1, dtype=np.int64)]
+            start = 0
+            for chunk_ids, _ in chunks:
+                offsets.append(chunk_ids.offsets[1:].astype(np.int64) + start)
+                start += int(chunk_ids.offsets[-1])
+            ids = EncodedIds(b''.join(chunk_ids.ids_bytes for chunk_ids, _ in chunks), np.concatenate(offsets),
+                             self.id_lambda)
+            cell_codes = ids, np.concatenate([chunk_fine for _, chunk_fine in chunks])
+
+        if cell_cache is not None:
+            cell_cache[cell] = cell_codes
+        return cell_codes
+
+    def build_retrieved_items(self, cell_items, coarse_codes, fine_codes):
+        """
+        Build a lazy sequence of retrieved index items from the ids of the visited cells.
+        """
+        return RetrievedItems(ChainedSequence(cell_items), None, coarse_codes, fine_codes)
+
+    def get_cell(self, cell):
+        """
+        Retrieve a cell bucket from the index.
+
+        :param tuple cell:
+            a cell tuple
+
+        :returns list:
+            the list of index items in this cell bucket
+        """
+        ids, fine_codes = self.get_cell_codes(cell)
+        cell = tuple(cell)
+        return [(ids[i], (cell, tuple(fine_codes[i].tolist()))) for i in xrange(len(ids))]
+
+
+class CellBuffer(object):
+    """
+    Growable contiguous storage of the items of one cell: a N x M matrix of fine codes
+    and an int32 array of row ids in the searcher id table. Appends are amortized by
+    growing the capacity by a quarter, which bounds the unused capacity.
+
+    The size and arrays are published together as one tuple: an append writes past the
+    published size, or to new arrays, and then replaces the tuple, so a search reading a
+    cell while another thread appends to it always gets fine codes and rows of the same
+    items. Only one thread may append at a time.
+    """
+
+    def __init__(self, M, dtype=np.uint8, capacity=4):
+        self.state = (0, np.empty((capacity, M), dtype=dtype), np.empty(capacity, dtype=np.int32))
+
+    def append(self, fine, rows):
+        size, fine_buf, rows_buf = self.state
+        n = len(rows)
+        if size + n > len(rows_buf):
+            capacity = max(size + n, grow_capacity(len(rows_buf)))
+            new_fine = np.empty((capacity, fine_buf.shape[1]), dtype=fine_buf.dtype)
+            new_fine[:size] = fine_buf[:size]
+            new_rows = np.empty(capacity, dtype=np.int32)
+            new_rows[:size] = rows_buf[:size]
+            fine_buf, rows_buf = new_fine, new_rows
+        fine_buf[size:size + n] = fine
+        rows_buf[size:size + n] = rows
+        self.state = (size + n, fine_buf, rows_buf)
+
+    def get_codes(self):
+        """
+        Get the rows and fine codes of the items of the cell, as views of the same snapshot.
+        """
+        size, fine, rows = self.state
+        return rows[:size], fine[:size]
+
+    def nbytes(self):
+        _, fine, rows = self.state
+        return fine.nbytes + rows.nbytes
+
+
+class ItemIdColumn(object):
+    """
+    Growable array of the item ids of a columnar index, the row of an item being its
+    position in the array. Ids are stored as int64 or fixed width byte strings, see
+    `normalize_ids`. Duplicates are detected with an int32 permutation of the rows
+    sorted by id, rows added since the last sort having their own small permutation
+    merged into it once large enough, so no Python object or copy of the ids is kept
+    per item.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.capacity = capacity
+        self.ids = None
+        # Rows [0, sorted_size) in increasing order of id, then rows [sorted_size, size)
+        # in increasing order of id relative to sorted_size
+        self.sorted_rows = np.zeros(0, dtype=np.int32)
+        self.sorted_size = 0
+        self.delta_rows = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, rows):
+        return self.ids[rows]
+
+    def normalize(self, ids):
+        ids = normalize_ids(ids)
+        if self.ids is not None and ids.dtype.kind != self.ids.dtype.kind:
+            raise ValueError('Cannot mix item ids of types {} and {}'.format(self.ids.dtype, ids.dtype))
+        return ids
+
+    def contains(self, ids):
+        """
+        Check which of the normalized `ids` are already in the column.
+        """
+        found = np.zeros(len(ids), dtype=bool)
+        if self.ids is None:
+            return found
+        for column, sorter in [(self.ids[:self.sorted_size], self.sorted_rows),
+                               (self.ids[self.sorted_size:self.size], self.delta_rows)]:
+            if len(column):
+                pos = np.minimum(np.searchsorted(column, ids, sorter=sorter), len(column) - 1)
+                found |= column[sorter[pos]] == ids
+        return found
+
+    def append(self, ids):
+        """
+        Append normalized `ids`, that must not be in the column yet.
+
+        :returns ndarray rows:
+            the rows of the ids
+        """
+        if self.ids is None:
+            self.ids = np.empty(max(self.capacity, len(ids)), dtype=ids.dtype)
+        if ids.dtype.itemsize > self.ids.dtype.itemsize:
+            # Wider byte strings, all ids are widened
+            self.ids = self.ids.astype(ids.dtype)
+        if self.size + len(ids) > len(self.ids):
+            ids_column = np.empty(max(self.size + len(ids), grow_capacity(len(self.ids))), dtype=self.ids.dtype)
+            ids_column[:self.size] = self.ids[:self.size]
+            self.ids = ids_column
+        self.ids[self.size:self.size + len(ids)] = ids
+        rows = np.arange(self.size, self.size + len(ids), dtype=np.int32)
+        self.size += len(ids)
+
+        if self.size - self.sorted_size > max(1024, self.sorted_size // 8):
+            self.sorted_rows = np.argsort(self.ids[:self.size], kind='mergesort').astype(np.int32)
+            self.sorted_size = self.size
+            self.delta_rows = np.zeros(0, dtype=np.int32)
+        else:
+            self.delta_rows = np.argsort(self.ids[self.sorted_size:self.size], kind='mergesort').astype(np.int32)
+        return rows
+
+    def nbytes(self):
+        if self.ids is None:
+            return 0
+        return self.ids.nbytes + self.sorted_rows.nbytes + self.delta_rows.nbytes
+
+
+class DenseItemIds(object):
+    """
+    Item ids of a columnar index that are already dense non negative integers, e.g.
+    allocated by an id table, used directly as rows. Only a bitmap of the ids added
+    so far is kept, to detect duplicates.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.present = np.zeros((capacity + 7) // 8, dtype=np.uint8)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, rows):
+        return rows
+
+    def normalize(self, ids):
+        ids = np.asarray(ids)
+        if len(ids) and (ids.dtype.kind not in 'iu' or ids.min() < 0 or ids.max() > np.iinfo(np.int32).max):
+            raise ValueError('Dense item ids must be integers in [0, 2**31)')
+        return ids.astype(np.int32)
+
+    def contains(self, ids):
+        found = np.zeros(len(ids), dtype=bool)
+        inside = (ids >> 3) < len(self.present)
+        found[inside] = ((self.present[ids[inside] >> 3] >> (ids[inside] & 7)) & 1) == 1
+        return found
+
+    def append(self, ids):
+        if len(ids) and (ids.max() >> 3) >= len(self.present):
+            present = np.zeros(max((ids.max() >> 3) + 1, grow_capacity(len(self.present))), dtype=np.uint8)
+            present[:len(self.present)] = self.present
+            self.present = present
+        np.bitwise_or.at(self.present, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+        self.size += len(ids)
+        return ids
+
+    def nbytes(self):
+        return self.present.nbytes
+
+
+class RetrievedItems(object):
+    """
+    Lazy sequence of (id, code) index items over retrieved code arrays, so that
+    Python tuples are only built for the results actually returned. Item ids are
+    looked up in `ids` through `rows`, or directly by position if `rows` is None.
+    """
+
+    def __init__(self, ids, rows, coarse_codes, fine_codes):
+        self.ids = ids
+        self.rows = rows
+        self.coarse_codes = coarse_codes
+        self.fine_codes = fine_codes
+
+    def __len__(self):
+        return len(self.coarse_codes)
+
+    def __getitem__(self, i):
+        code = (tuple(self.coarse_codes[i]), tuple(self.fine_codes[i]))
+        item_id = self.ids[i] if self.rows is None else self.ids[self.rows[i]]
+        if isinstance(item_id, np.generic):
+            item_id = item_id.item()
+        return item_id, code
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class LOPQSearcherColumnar(LOPQSearcherBase):
+
+    def __init__(self, model, dense_ids=False):
+        """
+        Create an LOPQSearcher instance that encapsulates retrieving and ranking
+        with LOPQ. Requires an LOPQModel instance. This class stores the codes of
+        each cell in contiguous arrays, i.e. a fine codes matrix and an int32 array
+        of row ids, with one global array of item ids. This costs about M bytes
+        plus 4 bytes per item on top of the item ids themselves.
+
+        :param LOPQModel model:
+            the model for indexing and ranking
+        :param bool dense_ids:
+            whether item ids are dense non negative integers, e.g. allocated by an id
+            table, used directly as rows so that no item id is stored
+        """
+        super(LOPQSearcherColumnar, self).__init__()
+        self.model = model
+        self.fine_dtype = get_fine_codes_dtype(model)
+        self.cells = dict()
+        # Global id table, mapping row ids to item ids
+        self.ids = DenseItemIds() if dense_ids else ItemIdColumn()
 
     def add_codes(self, codes, ids=None):
         """
@@ -453,21 +1806,88 @@ class LOPQSearcherLMDB(LOPQSearcherBase):
             defaults to the index of the code tuple if not provided
         """
         # If a list of ids is not provided, assume it is the index of the data
-        # TODO: If this method is called multiple times, we should add the current number of indexed data...
         if ids is None:
-            ids = count()
+            ids = count(self.nb_indexed)
 
-        with self.env.begin(db=self.index_db, write=True) as txn:
-            for item_id, code in zip(ids, codes):
-                key_prefix = self.encode_cell(code[0])
-                key_suffix = bytes(item_id)
-                key = key_prefix + key_suffix
-                val = self.encode_fine_codes(code[1])
-                txn.put(key, val)
-                # the nb_indexed will not be correct if there are duplicates...
-                #self.nb_indexed += 1
-        self.env.sync()
-        self.nb_indexed = self.env.stat()['entries']
+        # Codes are checked before any id is registered
+        valid_ids = []
+        coarse_codes = []
+        fine_codes = []
+        for item_id, code in zip(ids, codes):
+            try:
+                coarse = tuple(code[0])
+                fine = tuple(code[1])
+                if len(coarse) != 2 or len(fine) != self.model.M:
+                    raise ValueError('expected 2 coarse and {} fine codes'.format(self.model.M))
+            except Exception as inst:
+                err_msg = 'Could not push code {}. ({}: {})'.format(code, type(inst), inst)
+                print err_msg
+                continue
+            valid_ids.append(item_id)
+            coarse_codes.append(coarse)
+            fine_codes.append(fine)
+
+        if valid_ids:
+            self.add_codes_arrays(coarse_codes, fine_codes, valid_ids)
+
+    def add_codes_arrays(self, coarse_codes, fine_codes, ids):
+        """
+        Add LOPQ codes given as arrays into the search index, grouping items per cell
+        with array operations.
+
+        :param ndarray coarse_codes:
+            a N x 2 array of coarse codes
+        :param ndarray fine_codes:
+            a N x M array of fine codes
+        :param ndarray ids:
+            a length N array of ids
+        """
+        coarse_codes = np.asarray(coarse_codes, dtype=np.int64).reshape(-1, 2)
+        fine_codes = np.asarray(fine_codes, dtype=self.fine_dtype).reshape(-1, self.model.M)
+        ids = self.ids.normalize(ids)
+        if not len(ids) == len(coarse_codes) == len(fine_codes):
+            raise ValueError('Got {} ids for {} coarse and {} fine codes'.format(len(ids), len(coarse_codes),
+                                                                                len(fine_codes)))
+
+        # Discard duplicates, within the batch and with the indexed items
+        _, first = np.unique(ids, return_index=True)
+        keep = np.zeros(len(ids), dtype=bool)
+        keep[first] = True
+        keep &= ~self.ids.contains(ids)
+        if self.verbose > 0:
+            for item_id in ids[~keep].tolist():
+                print 'Discarding duplicate sample: {}'.format(item_id)
+        if not keep.any():
+            return
+        rows = self.ids.append(ids[keep])
+        coarse_codes = coarse_codes[keep]
+        fine_codes = fine_codes[keep]
+
+        for _, inds in group_by_cell(self.model.get_cell_id_for_coarse_codes(coarse_codes.T)):
+            cell = tuple(coarse_codes[inds[0]].tolist())
+            if cell not in self.cells:
+                self.cells[cell] = CellBuffer(self.model.M, self.fine_dtype)
+            self.cells[cell].append(fine_codes[inds], rows[inds])
+            self.nb_indexed += len(inds)
+
+    def get_cell_codes(self, cell, cell_cache=None):
+        """
+        Retrieve the codes of a cell bucket as zero-copy array views.
+
+        :param tuple cell:
+            a cell tuple
+        :param dict cell_cache:
+            unused, cells are already held in memory
+
+        :returns ndarray rows:
+            the row ids of the items in the global id table
+        :returns ndarray fine_codes:
+            the NxM matrix of fine codes of the items
+        """
+        buf = self.cells.get(tuple(cell))
+        if buf is None:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, self.model.M), dtype=self.fine_dtype)
+        return buf.get_codes()
 
     def get_cell(self, cell):
         """
@@ -479,21 +1899,281 @@ class LOPQSearcherLMDB(LOPQSearcherBase):
         :returns list:
             the list of index items in this cell bucket
         """
-        prefix = self.encode_cell(cell)
+        rows, fine_codes = self.get_cell_codes(cell)
+        cell = tuple(cell)
+        return [(item_id, (cell, tuple(f))) for item_id, f in zip(self.ids[rows].tolist(), fine_codes)]
 
-        items = []
-        with self.env.begin(db=self.index_db) as txn:
-            cursor = txn.cursor()
-            cursor.set_range(prefix)
-            for key, value in cursor:
-                if not key.startswith(prefix):
-                    break
-                else:
-                    item_id = self.id_lambda(key[4:])
-                    cell = self.decode_cell(key[:4])
-                    fine = self.decode_fine_codes(value)
-                    code = (cell, fine)
-                    items.append((item_id, code))
-            cursor.close()
+    def build_retrieved_items(self, cell_items, coarse_codes, fine_codes):
+        """
+        Build a lazy sequence of retrieved index items from the row ids of the visited cells.
+        """
+        if cell_items:
+            rows = np.concatenate(cell_items)
+        else:
+            rows = np.zeros(0, dtype=np.int32)
+        return RetrievedItems(self.ids, rows, coarse_codes, fine_codes)
+
+    def get_index_nbytes(self):
+        """
+        Get the number of bytes used by the code arrays of the index, excluding item ids.
+        """
+        # A copy of the cells, that the refresh thread can add to meanwhile
+        return sum(buf.nbytes() for buf in self.cells.values())
+
+    def get_ids_nbytes(self):
+        """
+        Get the number of bytes used by the item ids of the index.
+        """
+        return self.ids.nbytes()
+
+
+class LOPQSearcherMmap(LOPQSearcherBase):
+
+    def __init__(self, model, segments_path, max_delta_segments=8, background_merge=True):
+        """
+        Create an LOPQSearcher instance that encapsulates retrieving and ranking
+        with LOPQ. Requires an LOPQModel instance. This class stores codes in immutable
+        segment files (see `lopq.segment`) opened with read-only memory maps, so an existing
+        index is served right away and its pages are shared by all processes opening it.
+        Added codes are written to new delta segments, that are merged together once
+        there are more than `max_delta_segments` of them.
+
+        :param LOPQModel model:
+            the model for indexing and ranking
+        :param str segments_path:
+            the directory of the segment files, created if it does not exist
+        :param int max_delta_segments:
+            the number of delta segments above which segments are merged
+        :param bool background_merge:
+            whether merges run in a background thread or in the `add_codes` call
+        """
+        super(LOPQSearcherMmap, self).__init__()
+        self.model = model
+        self.fine_dtype = get_fine_codes_dtype(model)
+        self.segments_path = segments_path
+        self.max_delta_segments = max_delta_segments
+        self.background_merge = background_merge
+        # The list of segments is replaced and never modified in place,
+        # so that concurrent searches always see a consistent index
+        self.segments = []
+        self.write_lock = threading.Lock()
+        self.merge_lock = threading.Lock()
+        self.merge_thread = None
+
+        if not os.path.isdir(segments_path):
+            os.makedirs(segments_path)
+        self.reload_segments()
+
+    def _open_segments(self, names):
+        opened = dict((os.path.basename(seg.path), seg) for seg in self.segments)
+        segments = []
+        for name in names:
+            if name in opened:
+                segments.append(opened[name])
+            else:
+                segments.append(LOPQSegment(os.path.join(self.segments_path, name)))
+        self.segments = segments
+        self.nb_indexed = sum(len(seg) for seg in segments)
+
+    def reload_segments(self):
+        """
+        Open the segments listed in the manifest, e.g. to see codes added by another
+        process sharing the same segments directory. Already opened segments are reused.
+        """
+        with locked_segments_dir(self.segments_path):
+            self._open_segments(read_manifest(self.segments_path)['segments'])
+
+    def add_codes(self, codes, ids=None):
+        """
+        Add LOPQ codes into the search index, as a new delta segment.
+
+        Items whose id is already indexed, or repeated in the added codes, are discarded,
+        keeping the oldest item.
+
+        :param iterable codes:
+            an iterable of LOPQ code tuples
+        :param iterable ids:
+            an optional iterable of ids for each code;
+            defaults to the index of the code tuple if not provided
+        """
+        # If a list of ids is not provided, assume it is the index of the data
+        if ids is None:
+            ids = count(self.nb_indexed)
+
+        cell_ids = []
+        fine_codes = []
+        item_ids = []
+        for item_id, code in zip(ids, codes):
+            try:
+                cell_ids.append(self.model.get_cell_id_for_coarse_codes(code[0]))
+                fine_codes.append(code[1])
+                item_ids.append(item_id)
+            except Exception as inst:
+                err_msg = 'Could not push code {}. ({}: {})'.format(code, type(inst), inst)
+                print err_msg
+
+        if not item_ids:
+            return
+        fine_codes = np.array(fine_codes, dtype=self.fine_dtype).reshape(-1, self.model.M)
+        self.add_segment(cell_ids, fine_codes, item_ids)
 
-        return items
+    def add_codes_arrays(self, coarse_codes, fine_codes, ids):
+        """
+        Add LOPQ codes given as arrays into the search index, as a new delta segment.
+        Items whose id is already indexed are discarded, as in `add_codes`.
+
+        :param ndarray coarse_codes:
+            a N x 2 array of coarse codes
+        :param ndarray fine_codes:
+            a N x M array of fine codes
+        :param ndarray ids:
+            a length N array of ids
+        """
+        if not len(ids):
+            return
+        coarse_codes = np.asarray(coarse_codes, dtype=np.int64).reshape(-1, 2)
+        fine_codes = np.asarray(fine_codes, dtype=self.fine_dtype).reshape(-1, self.model.M)
+        self.add_segment(self.model.get_cell_id_for_coarse_codes(coarse_codes.T), fine_codes, ids)
+
+    def add_segment(self, cell_ids, fine_codes, item_ids):
+        """
+        Write items to a new delta segment and add it to the manifest, discarding the
+        items whose id is already in a live segment or repeated in `item_ids`.
+        """
+        item_ids = normalize_ids(item_ids)
+        _, first = np.unique(item_ids, return_index=True)
+        keep = np.zeros(len(item_ids), dtype=bool)
+        keep[first] = True
+
+        with self.write_lock:
+            with locked_segments_dir(self.segments_path):
+                manifest = read_manifest(self.segments_path)
+                # Check ids against the segments added by other processes too
+                self._open_segments(manifest['segments'])
+                for seg in self.segments:
+                    keep &= ~seg.contains(item_ids)
+                if not keep.any():
+                    return
+                cell_ids = np.asarray(cell_ids, dtype=np.int64)[keep]
+                fine_codes, item_ids = fine_codes[keep], item_ids[keep]
+                name = get_segment_name(manifest['next_segment'])
+                write_segment(os.path.join(self.segments_path, name), self.model.V, cell_ids, fine_codes, item_ids)
+                manifest['segments'].append(name)
+                manifest['next_segment'] += 1
+                write_manifest(self.segments_path, manifest)
+                self._open_segments(manifest['segments'])
+
+        self.merge_if_needed()
+
+    def merge_if_needed(self):
+        """
+        Merge segments if there are more than `max_delta_segments` delta segments
+        and no merge is already running.
+        """
+        if len(self.segments) - 1 <= self.max_delta_segments:
+            return
+        if self.merge_thread is not None and self.merge_thread.is_alive():
+            return
+        if self.background_merge:
+            self.merge_thread = threading.Thread(target=self.merge_segments)
+            self.merge_thread.daemon = True
+            self.merge_thread.start()
+        else:
+            self.merge_segments()
+
+    def merge_segments(self):
+        """
+        Merge all current segments into a single segment, discarding items whose id
+        is already in an older segment. Searches use the previous segments until the
+        merged segment is published, and segments added during the merge are kept.
+        """
+        with self.merge_lock:
+            # Reserve the name of the merged segment
+            with locked_segments_dir(self.segments_path):
+                manifest = read_manifest(self.segments_path)
+                self._open_segments(manifest['segments'])
+                segments = self.segments
+                if len(segments) < 2:
+                    return
+                name = get_segment_name(manifest['next_segment'])
+                manifest['next_segment'] += 1
+                write_manifest(self.segments_path, manifest)
+
+            # Keep the first occurrence of each id, in storage order
+            ids = np.concatenate([seg.ids for seg in segments])
+            _, first = np.unique(ids, return_index=True)
+            keep = np.sort(first)
+            cell_ids = np.concatenate([seg.get_cell_ids() for seg in segments])[keep]
+            fine_codes = np.concatenate([seg.fine_codes for seg in segments])[keep]
+            write_segment(os.path.join(self.segments_path, name), self.model.V, cell_ids, fine_codes, ids[keep])
+
+            merged_names = [os.path.basename(seg.path) for seg in segments]
+            with self.write_lock:
+                with locked_segments_dir(self.segments_path):
+                    manifest = read_manifest(self.segments_path)
+                    if manifest['segments'][:len(merged_names)] != merged_names:
+                        # These segments were merged by another process meanwhile
+                        os.remove(os.path.join(self.segments_path, name))
+                        self._open_segments(manifest['segments'])
+                        return
+                    manifest['segments'] = [name] + manifest['segments'][len(merged_names):]
+                    write_manifest(self.segments_path, manifest)
+                    self._open_segments(manifest['segments'])
+
+            # Segments still mapped by searches or other processes stay readable after removal
+            for merged_name in merged_names:
+                try:
+                    os.remove(os.path.join(self.segments_path, merged_name))
+                except OSError:
+                    pass
+
+    def get_cell_codes(self, cell, cell_cache=None):
+        """
+        Retrieve the codes of a cell bucket. These are zero-copy slices of the
+        segment maps when the cell only has items in one segment.
+
+        :param tuple cell:
+            a cell tuple
+        :param dict cell_cache:
+            unused, cells are served from the page cache
+
+        :returns ndarray ids:
+            the ids of the items of the cell
+        :returns ndarray fine_codes:
+            the NxM matrix of fine codes of the items
+        """
+        cell_id = self.model.get_cell_id_for_coarse_codes(cell)
+        parts = [seg.get_cell(cell_id) for seg in self.segments]
+        parts = [part for part in parts if len(part[0])]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.model.M), dtype=self.fine_dtype)
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+    def get_cell(self, cell):
+        """
+        Retrieve a cell bucket from the index.
+
+        :param tuple cell:
+            a cell tuple
+
+        :returns list:
+            the list of index items in this cell bucket
+        """
+        ids, fine_codes = self.get_cell_codes(cell)
+        cell = tuple(cell)
+        return [(i, (cell, tuple(f))) for i, f in zip(ids.tolist(), fine_codes)]
+
+    def build_retrieved_items(self, cell_items, coarse_codes, fine_codes):
+        """
+        Build a lazy sequence of retrieved index items from the ids of the visited cells.
+        """
+        ids = np.concatenate(cell_items) if cell_items else np.zeros(0, dtype=np.int64)
+        return RetrievedItems(ids, None, coarse_codes, fine_codes)
+
+    def get_index_nbytes(self):
+        """
+        Get the number of bytes of the segment files of the index.
+        """
+        return sum(seg.nbytes() for seg in self.segments)
@@ -0,0 +1,307 @@
+# Immutable memory-mapped segment files storing the LOPQ codes of an index.
+#
+# A segment file is made of, in order:
+#   - a fixed size header (see SEGMENT_HEADER_DTYPE), padded to SEGMENT_HEADER_SIZE bytes
+#   - a cell offset table of V*V+1 int64, items of cell `c` being in [offsets[c], offsets[c+1]),
+#     where `c` is the cell id given by `get_cell_id_for_coarse_codes`
+#   - the contiguous N x M block of fine codes, sorted by cell id
+#   - the N ids of the items in the same order, aligned to 8 bytes
+#
+# Segments are never modified once written, new codes are written to new (delta) segments
+# and segments are merged by writing a new segment. The list of live segments of an index
+# is kept in a manifest file that is atomically replaced.
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+
+SEGMENT_MAGIC = 'LOPQSEG1'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER_SIZE = 64
+SEGMENT_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('V', '<u4'), ('M', '<u4'),
+                                 ('fine_dtype', 'S8'), ('id_dtype', 'S8'), ('n_items', '<u8')])
+
+MANIFEST_FILENAME = 'MANIFEST'
+LOCK_FILENAME = 'LOCK'
+
+
+def get_segment_name(seq):
+    """
+    Get the file name of the segment with sequence number `seq`.
+    """
+    return 'segment_{:08d}.lopq'.format(seq)
+
+
+def get_segment_layout(V, n_items, M, fine_dtype, id_dtype):
+    """
+    Compute the byte offsets of the blocks of a segment file.
+
+    :returns int offsets_start:
+        the byte offset of the cell offset table
+    :returns int fine_start:
+        the byte offset of the fine codes block
+    :returns int ids_start:
+        the byte offset of the ids block
+    :returns int end:
+        the total size of the segment file
+    """
+    offsets_start = SEGMENT_HEADER_SIZE
+    fine_start = offsets_start + 8 * (V * V + 1)
+    fine_end = fine_start + n_items * M * np.dtype(fine_dtype).itemsize
+    ids_start = fine_end + (-fine_end % 8)
+    end = ids_start + n_items * np.dtype(id_dtype).itemsize
+    return offsets_start, fine_start, ids_start, end
+
+
+def normalize_ids(ids):
+    """
+    Convert item ids to an array that can be stored in a segment, i.e. int64 for
+    integer ids and fixed width byte strings otherwise.
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind in 'iu':
+        return ids.astype('<i8')
+    if ids.dtype.kind == 'U':
+        ids = np.array([i.encode('utf-8') for i in ids.tolist()])
+    if ids.dtype.kind == 'S':
+        # An empty array of str would be of width 0, which is not a valid numpy type
+        return ids if ids.dtype.itemsize else ids.astype('S1')
+    raise ValueError('Unsupported segment id type: {}'.format(ids.dtype))
+
+
+def write_segment(path, V, cell_ids, fine_codes, ids):
+    """
+    Write codes to a new segment file. The file is first written to a temporary
+    file and then renamed, so a segment file is never seen partially written.
+
+    :param str path:
+        the path of the segment file
+    :param int V:
+        the number of coarse clusters per coarse split of the model
+    :param ndarray cell_ids:
+        a length N array of cell ids, as given by `get_cell_id_for_coarse_codes`
+    :param ndarray fine_codes:
+        a N x M array of fine codes, stored with its dtype
+    :param ndarray ids:
+        a length N array of item ids, either integers or strings
+    """
+    cell_ids = np.asarray(cell_ids, dtype=np.int64)
+    fine_codes = np.asarray(fine_codes)
+    ids = normalize_ids(ids)
+    n_items, M = fine_codes.shape
+
+    # Stable sort keeps the insertion order of the items of a cell
+    order = np.argsort(cell_ids, kind='mergesort')
+    offsets = np.zeros(V * V + 1, dtype='<i8')
+    np.cumsum(np.bincount(cell_ids, minlength=V * V), out=offsets[1:])
+
+    header = np.zeros(1, dtype=SEGMENT_HEADER_DTYPE)
+    header['magic'] = SEGMENT_MAGIC
+    header['version'] = SEGMENT_VERSION
+    header['V'] = V
+    header['M'] = M
+    header['fine_dtype'] = fine_codes.dtype.str
+    header['id_dtype'] = ids.dtype.str
+    header['n_items'] = n_items
+
+    _, fine_start, ids_start, _ = get_segment_layout(V, n_items, M, fine_codes.dtype, ids.dtype)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(b'\0' * (SEGMENT_HEADER_SIZE - SEGMENT_HEADER_DTYPE.itemsize))
+        f.write(offsets.tobytes())
+        f.write(np.ascontiguousarray(fine_codes[order]).tobytes())
+        f.write(b'\0' * (ids_start - f.tell()))
+        f.write(ids[order].tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def write_segment_cells(path, V, M, fine_dtype, id_dtype, cell_counts, cells):
+    """
+    Write codes to a new segment file cell by cell, e.g. to snapshot an index without
+    holding a copy of all its codes in memory. The layout of the file is computed from
+    the number of items of each cell, and the codes of each cell are written at their
+    place. As `write_segment`, the file is first written to a temporary file and then renamed.
+
+    :param str path:
+        the path of the segment file
+    :param int V:
+        the number of coarse clusters per coarse split of the model
+    :param int M:
+        the number of fine codes of each item
+    :param dtype fine_dtype:
+        the type of the stored fine codes
+    :param dtype id_dtype:
+        the type of the stored ids, int64 or fixed width byte strings
+    :param ndarray cell_counts:
+        a length V*V array of the number of items of each cell
+    :param iterable cells:
+        an iterable of (cell id, ids, fine codes) tuples, giving all the items of
+        each non empty cell at once, cells being in any order
+    """
+    fine_dtype = np.dtype(fine_dtype)
+    id_dtype = np.dtype(id_dtype)
+    offsets = np.zeros(V * V + 1, dtype='<i8')
+    np.cumsum(cell_counts, out=offsets[1:])
+    n_items = int(offsets[-1])
+
+    header = np.zeros(1, dtype=SEGMENT_HEADER_DTYPE)
+    header['magic'] = SEGMENT_MAGIC
+    header['version'] = SEGMENT_VERSION
+    header['V'] = V
+    header['M'] = M
+    header['fine_dtype'] = fine_dtype.str
+    header['id_dtype'] = id_dtype.str
+    header['n_items'] = n_items
+
+    _, fine_start, ids_start, end = get_segment_layout(V, n_items, M, fine_dtype, id_dtype)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(b'\0' * (SEGMENT_HEADER_SIZE - SEGMENT_HEADER_DTYPE.itemsize))
+        f.write(offsets.tobytes())
+        f.truncate(end)
+        for cell_id, ids, fine_codes in cells:
+            start = offsets[cell_id]
+            if len(ids) != offsets[cell_id + 1] - start or len(fine_codes) != len(ids):
+                raise ValueError('Cell {} does not have {} items'.format(cell_id, offsets[cell_id + 1] - start))
+            f.seek(fine_start + start * M * fine_dtype.itemsize)
+            f.write(np.ascontiguousarray(fine_codes, dtype=fine_dtype).tobytes())
+            f.seek(ids_start + start * id_dtype.itemsize)
+            f.write(normalize_ids(ids).astype(id_dtype).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class LOPQSegment(object):
+
+    def __init__(self, path):
+        """
+        Open a segment file with read-only memory maps. Cells are served as zero-copy
+        slices of the maps, so the page cache is shared by all processes opening the
+        same segment.
+
+        :param str path:
+            the path of the segment file
+        """
+        self.path = path
+        header = np.fromfile(path, dtype=SEGMENT_HEADER_DTYPE, count=1)
+        if len(header) != 1 or header['magic'][0] != SEGMENT_MAGIC:
+            raise ValueError('Not a LOPQ segment file: {}'.format(path))
+        if header['version'][0] != SEGMENT_VERSION:
+            raise ValueError('Unsupported LOPQ segment version {} in {}'.format(header['version'][0], path))
+
+        self.V = int(header['V'][0])
+        self.M = int(header['M'][0])
+        self.n_items = int(header['n_items'][0])
+        fine_dtype = np.dtype(header['fine_dtype'][0])
+        id_dtype = np.dtype(header['id_dtype'][0])
+        offsets_start, fine_start, ids_start, end = get_segment_layout(self.V, self.n_items, self.M,
+                                                                       fine_dtype, id_dtype)
+        if os.path.getsize(path) < end:
+            raise ValueError('Truncated LOPQ segment file: {}'.format(path))
+
+        self.offsets = np.memmap(path, dtype='<i8', mode='r', offset=offsets_start, shape=(self.V * self.V + 1,))
+        if self.n_items:
+            self.fine_codes = np.memmap(path, dtype=fine_dtype, mode='r', offset=fine_start,
+                                        shape=(self.n_items, self.M))
+            self.ids = np.memmap(path, dtype=id_dtype, mode='r', offset=ids_start, shape=(self.n_items,))
+        else:
+            # Empty maps are not allowed
+            self.fine_codes = np.zeros((0, self.M), dtype=fine_dtype)
+            self.ids = np.zeros(0, dtype=id_dtype)
+        # Rows sorted by id, built on the first `contains` call
+        self.sorted_rows = None
+
+    def __len__(self):
+        return self.n_items
+
+    def get_cell(self, cell_id):
+        """
+        Get the ids and fine codes of the items of a cell as zero-copy slices.
+
+        :param int cell_id:
+            the cell id, as given by `get_cell_id_for_coarse_codes`
+
+        :returns ndarray ids:
+            the ids of the items of the cell
+        :returns ndarray fine_codes:
+            the NxM fine codes of the items of the cell
+        """
+        start, end = self.offsets[cell_id], self.offsets[cell_id + 1]
+        return self.ids[start:end], self.fine_codes[start:end]
+
+    def contains(self, ids):
+        """
+        Check which of the `ids` are items of the segment. The rows of the segment sorted
+        by id are computed on the first call and kept in memory, 4 bytes per item.
+
+        :param ndarray ids:
+            an array of item ids, normalized with `normalize_ids`
+
+        :returns ndarray:
+            a boolean array, true for the ids that are in the segment
+        """
+        if not self.n_items or ids.dtype.kind != self.ids.dtype.kind:
+            return np.zeros(len(ids), dtype=bool)
+        if self.sorted_rows is None:
+            self.sorted_rows = np.argsort(self.ids, kind='mergesort').astype(np.int32)
+        pos = np.minimum(np.searchsorted(self.ids, ids, sorter=self.sorted_rows), self.n_items - 1)
+        return self.ids[self.sorted_rows[pos]] == ids
+
+    def get_cell_ids(self):
+        """
+        Get the cell id of every item of the segment, in storage order.
+        """
+        return np.repeat(np.arange(self.V * self.V, dtype=np.int64), np.diff(self.offsets))
+
+    def nbytes(self):
+        return os.path.getsize(self.path)
+
+
+@contextmanager
+def locked_segments_dir(segments_path):
+    """
+    Hold an exclusive lock on a segments directory, so that processes sharing the
+    directory do not update its manifest concurrently.
+    """
+    with open(os.path.join(segments_path, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_manifest(segments_path):
+    """
+    Read the manifest of a segments directory.
+
+    :returns dict:
+        a dict with the list of live segment file names in 'segments', oldest first,
+        and the sequence number of the next segment in 'next_segment'
+    """
+    manifest_path = os.path.join(segments_path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {'segments': [], 'next_segment': 0}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(segments_path, manifest):
+    """
+    Atomically replace the manifest of a segments directory.
+    """
+    manifest_path = os.path.join(segments_path, MANIFEST_FILENAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, manifest_path)
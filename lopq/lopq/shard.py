@@ -0,0 +1,366 @@
+# Sharded LOPQ index served by local worker processes.
+#
+# Items are partitioned by id hash or by coarse cell across N worker processes, each holding
+# its own searcher backend. The parent process talks to the workers over pipes: a request is
+# a (method, args) pair called on the worker searcher and the reply is a (success, result)
+# pair, the result being the formatted traceback of the error on failure. Searches are
+# broadcast to all shards and the per-shard top results are merged.
+import os
+import math
+import threading
+import traceback
+import zlib
+import numpy as np
+from . import search
+from .search import LOPQSearcherBase, SearchResult, top_k_order
+from .utils import start_worker, stop_worker
+
+SHARD_PARTITIONS = ['id', 'cell']
+# Shard searchers whose index is stored on disk, that a forked process can reopen
+PERSISTENT_SHARD_SEARCHERS = ['LOPQSearcherLMDB', 'LOPQSearcherMmap']
+
+
+def build_shard_searcher(model, searcher_name, searcher_kwargs, shard):
+    """
+    Create the searcher of a shard. String arguments are formatted with the shard
+    number, e.g. lmdb_path='/data/lmdb_index_shard{shard}'.
+    """
+    kwargs = dict((k, v.format(shard=shard) if isinstance(v, basestring) else v)
+                  for k, v in searcher_kwargs.iteritems())
+    return getattr(search, searcher_name)(model, **kwargs)
+
+
+def shard_worker(conn, model, searcher_name, searcher_kwargs, shard):
+    """
+    Main loop of a shard worker process, serving requests until a None request
+    or until the parent closes its end of the pipe.
+    """
+    try:
+        searcher = build_shard_searcher(model, searcher_name, searcher_kwargs, shard)
+        conn.send((True, None))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+        return
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        method, args = request
+        try:
+            reply = (True, getattr(searcher, method)(*args))
+        except Exception:
+            reply = (False, traceback.format_exc())
+        try:
+            conn.send(reply)
+        except IOError:
+            # The parent closed the searcher
+            break
+
+
+class LOPQSearcherSharded(LOPQSearcherBase):
+
+    def __init__(self, model, num_shards=4, partition='id', shard_searcher='LOPQSearcherColumnar',
+                 shard_kwargs=None):
+        """
+        Create an LOPQSearcher instance that encapsulates retrieving and ranking
+        with LOPQ. Requires an LOPQModel instance. This class partitions the index
+        across local worker processes, each one holding a searcher of class `shard_searcher`.
+
+        The pipes to the shard workers are not shared with forked processes, e.g.
+        gunicorn workers forked after the searcher was created with --preload: a forked
+        process starts its own shard workers on first use, reopening the indexes of
+        persistent shard searchers, see `PERSISTENT_SHARD_SEARCHERS`. The shards of an
+        in-memory index can only be used by the process that created the searcher.
+
+        :param LOPQModel model:
+            the model for indexing and ranking
+        :param int num_shards:
+            the number of shards, i.e. of worker processes
+        :param str partition:
+            'id' to assign items to shards by hash of their id, 'cell' to assign
+            whole coarse cells to shards
+        :param str shard_searcher:
+            the name of the searcher class of the shards in `lopq.search`
+        :param dict shard_kwargs:
+            extra arguments of the shard searchers, string values being formatted
+            with the shard number, e.g. {'lmdb_path': '/data/lmdb_index_shard{shard}'}
+        """
+        if partition not in SHARD_PARTITIONS:
+            raise ValueError('Unknown shard partition {}, should be one of {}'.format(partition, SHARD_PARTITIONS))
+
+        super(LOPQSearcherSharded, self).__init__()
+        self.model = model
+        self.num_shards = num_shards
+        self.partition = partition
+        self.shard_searcher = shard_searcher
+        self.shard_kwargs = shard_kwargs or {}
+        self.lock = threading.Lock()
+
+        self.pid = None
+        self.conns = []
+        self.procs = []
+        self.start_shards()
+        self.get_nb_indexed()
+
+    def start_shards(self):
+        """
+        Start the shard worker processes of the current process.
+        """
+        self.pid = os.getpid()
+        self.conns = []
+        self.procs = []
+        try:
+            for shard in xrange(self.num_shards):
+                p, conn = start_worker(shard_worker, (self.model, self.shard_searcher, self.shard_kwargs, shard))
+                self.conns.append(conn)
+                self.procs.append(p)
+
+            # Wait for all shard searchers to be created
+            self._gather(range(self.num_shards))
+        except Exception:
+            self.stop_shards()
+            raise
+
+    def check_shards(self):
+        """
+        Start the shard workers of a forked process, which must not use the pipes of
+        the workers of its parent: concurrent processes would read each other's replies.
+        Called with `self.lock` held.
+        """
+        if self.pid == os.getpid():
+            return
+        if self.shard_searcher not in PERSISTENT_SHARD_SEARCHERS:
+            raise RuntimeError('The in-memory shards of this searcher are held by process {} and cannot be used '
+                               'by process {}'.format(self.pid, os.getpid()))
+        # Only close the copies of the pipes of the parent, its workers keep running
+        for conn in self.conns:
+            conn.close()
+        self.start_shards()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _gather(self, shards):
+        """
+        Receive the replies of the given shards, in order.
+        """
+        results = []
+        errors = []
+        for shard in shards:
+            try:
+                success, result = self.conns[shard].recv()
+            except (EOFError, IOError):
+                success, result = False, 'worker process died'
+            if success:
+                results.append(result)
+            else:
+                errors.append('shard {}: {}'.format(shard, result))
+        if errors:
+            raise RuntimeError('Error in shard searcher, {}'.format('\n'.join(errors)))
+        return results
+
+    def call_shards(self, method, shard_args):
+        """
+        Call a method of the searchers of several shards concurrently.
+
+        :param str method:
+            the name of the searcher method
+        :param dict shard_args:
+            the tuple of arguments of the call for each shard
+
+        :returns list:
+            the results of each shard, in the order of the shard numbers
+        """
+        shards = sorted(shard_args)
+        with self.lock:
+            self.check_shards()
+            for shard in shards:
+                self.conns[shard].send((method, shard_args[shard]))
+            return self._gather(shards)
+
+    def broadcast(self, method, args=()):
+        """
+        Call a method of the searchers of all shards with the same arguments.
+        """
+        return self.call_shards(method, dict((shard, args) for shard in xrange(self.num_shards)))
+
+    def get_shard(self, item_id, coarse_codes):
+        """
+        Get the shard of an item, given its id and coarse codes.
+        """
+        if self.partition == 'cell':
+            return int(self.model.get_cell_id_for_coarse_codes(coarse_codes)) % self.num_shards
+        key = item_id if isinstance(item_id, bytes) else unicode(item_id).encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % self.num_shards
+
+    def get_shard_quota(self, quota):
+        """
+        Get the quota of each shard for a query quota, so that the shards retrieve the
+        candidates a single index would retrieve.
+
+        With the 'cell' partition, the cells visited by a single index are spread over the
+        shards, and a shard has to visit all of its cells among them, so each shard gets the
+        whole quota. With the 'id' partition, a shard holds about 1/N of the items of every
+        cell, so each shard fills its share of the quota plus three standard deviations of
+        the number of its items in the visited cells.
+        """
+        if self.partition == 'cell' or self.num_shards == 1:
+            return quota
+        share = float(quota) / self.num_shards
+        return min(quota, int(math.ceil(share + 3 * math.sqrt(share))))
+
+    def get_nb_indexed(self):
+        self.nb_indexed = sum(self.broadcast('get_nb_indexed'))
+        return self.nb_indexed
+
+    def add_codes(self, codes, ids=None):
+        """
+        Add LOPQ codes into the search index, routing each item to its shard.
+
+        :param iterable codes:
+            an iterable of LOPQ code tuples
+        :param iterable ids:
+            an optional iterable of ids for each code;
+            defaults to the index of the code tuple if not provided
+        """
+        codes = list(codes)
+        ids = range(len(codes)) if ids is None else list(ids)
+
+        shard_codes = dict()
+        for item_id, code in zip(ids, codes):
+            shard = self.get_shard(item_id, tuple(code[0]))
+            shard_ids, shard_item_codes = shard_codes.setdefault(shard, ([], []))
+            shard_ids.append(item_id)
+            shard_item_codes.append(code)
+
+        self.call_shards('add_codes', dict((shard, (item_codes, shard_ids))
+                                           for shard, (shard_ids, item_codes) in shard_codes.iteritems()))
+        self.get_nb_indexed()
+
+    def add_codes_arrays(self, coarse_codes, fine_codes, ids):
+        """
+        Add LOPQ codes given as arrays into the search index, sending each shard the
+        arrays of its items.
+
+        :param ndarray coarse_codes:
+            a N x 2 array of coarse codes
+        :param ndarray fine_codes:
+            a N x M array of fine codes
+        :param ndarray ids:
+            a length N array of ids
+        """
+        coarse_codes = np.asarray(coarse_codes).reshape(-1, 2)
+        fine_codes = np.asarray(fine_codes).reshape(len(coarse_codes), -1)
+        ids = np.asarray(ids)
+        if self.partition == 'cell':
+            cell_ids = self.model.get_cell_id_for_coarse_codes(coarse_codes.T.astype(np.int64))
+            shards = cell_ids % self.num_shards
+        else:
+            shards = np.array([self.get_shard(item_id, None) for item_id in ids.tolist()], dtype=np.int64)
+
+        shard_args = dict()
+        for shard in np.unique(shards).tolist():
+            inds = np.flatnonzero(shards == shard)
+            shard_args[shard] = (coarse_codes[inds], fine_codes[inds], ids[inds])
+        self.call_shards('add_codes_arrays', shard_args)
+        self.get_nb_indexed()
+
+    def merge_results(self, shard_results, limit, with_dists=False):
+        """
+        Merge the results of the shards for one query, given as lists of results with
+        distances, into the limit overall best results.
+        """
+        results = [res for results in shard_results for res in results]
+        dists = np.array([res.dist for res in results])
+        merged = []
+        for i in top_k_order(dists, limit):
+            if with_dists:
+                merged.append(results[i])
+            else:
+                merged.append(SearchResult(results[i].id, results[i].code))
+        return merged
+
+    def search_projected(self, x, quota=10, limit=None, with_dists=False, sorted_coarse=None, cell_cache=None,
+                         cell_cutoff=False):
+        """
+        Search with a query vector that is already in the model space, i.e. PCA projected
+        for LOPQModelPCA. The query is sent to all shards, each one filling its quota, see
+        `get_shard_quota`, and their best results are merged. The number of cells visited is
+        the total over all shards. See `LOPQSearcherBase.search` for the parameters and returned values.
+        """
+        if limit is None:
+            limit = quota
+
+        replies = self.broadcast('search_projected', (x, self.get_shard_quota(quota), limit, True, sorted_coarse,
+                                                      None, cell_cutoff))
+        results = self.merge_results([results for results, _ in replies], limit, with_dists)
+        return results, sum(visited for _, visited in replies)
+
+    def search_projected_batch(self, X, quota=10, limit=None, with_dists=False, cell_cutoff=False):
+        """
+        Search a batch of query vectors that are already in the model space with a single
+        request per shard. See `LOPQSearcherBase.search_batch` for the parameters and
+        returned values.
+        """
+        if limit is None:
+            limit = quota
+
+        replies = self.broadcast('search_projected_batch', (X, self.get_shard_quota(quota), limit, True,
+                                                            cell_cutoff))
+        all_results = []
+        all_visited = []
+        for i in xrange(len(X)):
+            all_results.append(self.merge_results([results[i] for results, _ in replies], limit, with_dists))
+            all_visited.append(sum(visited[i] for _, visited in replies))
+
+        return all_results, all_visited
+
+    def reload_segments(self):
+        """
+        Reopen the segments of the shards of a `LOPQSearcherMmap` index, e.g. to see codes added
+        by another process sharing the same shard directories. Does nothing for other shard
+        searchers.
+        """
+        if hasattr(getattr(search, self.shard_searcher), 'reload_segments'):
+            self.broadcast('reload_segments')
+            self.get_nb_indexed()
+
+    def get_cell(self, cell):
+        """
+        Retrieve a cell bucket from the index, gathering the items of all shards holding it.
+
+        :param tuple cell:
+            a cell tuple
+
+        :returns list:
+            the list of index items in this cell bucket
+        """
+        if self.partition == 'cell':
+            shard = self.get_shard(None, cell)
+            return self.call_shards('get_cell', {shard: (cell,)})[0]
+        return [item for items in self.broadcast('get_cell', (cell,)) for item in items]
+
+    def close(self):
+        """
+        Stop the shard worker processes.
+        """
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            self.stop_shards()
+
+    def stop_shards(self):
+        """
+        Stop the shard worker processes of the current process, with `self.lock` held.
+        """
+        for conn, p in zip(self.conns, self.procs):
+            stop_worker(p, conn)
+        self.conns = []
+        self.procs = []
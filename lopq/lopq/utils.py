@@ -1,8 +1,17 @@
 # Copyright 2015, Yahoo Inc.
 # Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+import os
+import sys
+import math
+import struct
+import hashlib
+import threading
 import numpy as np
 import multiprocessing
-from itertools import chain
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 
 def iterate_splits(x, splits):
@@ -22,6 +31,38 @@ def iterate_splits(x, splits):
         yield x[start:start + split_size], split
 
 
+def iterate_clusters(assignments):
+    """
+    A helper to iterate the rows assigned to each cluster.
+
+    :param ndarray assignments:
+        a length N array of cluster assignments
+    :returns (int, np.array):
+        cluster id, row indices pairs for each non empty cluster
+    """
+    order = np.argsort(assignments, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(assignments[order])) + 1
+    for rows in np.split(order, bounds):
+        if len(rows):
+            yield assignments[rows[0]], rows
+
+
+def iterate_chunks(data, chunk_size=10000):
+    """
+    A helper to iterate consecutive chunks of rows of an array, e.g. a memmap,
+    as used by the streaming training functions.
+
+    :param ndarray data:
+        a NxD array
+    :param int chunk_size:
+        the number of rows per chunk
+    :returns np.array:
+        chunks of at most chunk_size rows
+    """
+    for start in xrange(0, len(data), chunk_size):
+        yield np.asarray(data[start:start + chunk_size])
+
+
 def concat_new_first(arrs):
     """
     Helper to concatenate a list of ndarrays along a new first dimension.
@@ -61,124 +102,481 @@ def predict_cluster(x, centroids):
     # return ocid
 
 
-def load_xvecs(filename, base_type='f', max_num=None):
+def get_cluster_dtype(num_clusters):
+    """
+    Get the smallest unsigned integer type able to store cluster ids
+    in [0, num_clusters), as used by `predict_cluster`.
+    """
+    if num_clusters <= 256:
+        return np.uint8
+    elif num_clusters <= 65536:
+        return np.uint16
+    else:
+        return np.uint32
+
+
+def predict_clusters(X, centroids):
+    """
+    Given a matrix of N vectors of dimension D and a matrix of centroids of dimension VxD,
+    return the id of the closest cluster of each vector. Squared distances are computed
+    in matrix form, i.e. ||c||^2 - 2 x.c (||x||^2 does not change the assignment).
+
+    :params np.array X:
+        the NxD data to assign
+    :params np.array centroids:
+        a matrix of cluster centroids
+    :returns np.array:
+        the length N array of cluster assignments
+    """
+    dists = (centroids ** 2).sum(axis=1) - 2 * np.dot(X, centroids.T)
+    return dists.argmin(axis=1).astype(get_cluster_dtype(centroids.shape[0]))
+
+
+def predict_subquantizer_clusters(X, subquantizers):
+    """
+    Assign the subvectors of a matrix of vectors to the clusters of their
+    subquantizer, for all subquantizers at once.
+
+    :params np.array X:
+        the NxD data to assign, made of len(subquantizers) subvectors
+    :params list subquantizers:
+        a list of SxD/len(subquantizers) matrices of subquantizer centroids
+    :returns np.array:
+        the N x len(subquantizers) array of cluster assignments
+    """
+    centroids = np.asarray(subquantizers)
+    num_sub, S, _ = centroids.shape
+    subvectors = X.reshape(X.shape[0], num_sub, -1).transpose(1, 0, 2)
+
+    dists = (centroids ** 2).sum(axis=2)[:, np.newaxis, :] - 2 * np.matmul(subvectors, centroids.transpose(0, 2, 1))
+    return dists.argmin(axis=2).T.astype(get_cluster_dtype(S))
+
+
+# Component type of the vectors of each xvecs format, the dimension of each vector
+# being stored as a little-endian int32 before its components
+XVECS_TYPES = {
+    'f': np.dtype('<f4'),
+    'i': np.dtype('<i4'),
+    'b': np.dtype('u1')
+}
+
+# Type of the arrays returned by `load_xvecs`
+XVECS_LOAD_TYPES = {
+    'f': np.float64,
+    'i': np.int64,
+    'b': np.float64
+}
+
+
+def get_xvecs_dtype(D, base_type='f'):
+    """
+    Get the structured type of one row of a xvecs file of vectors of dimension D.
+    """
+    return np.dtype([('dim', '<i4'), ('vec', XVECS_TYPES[base_type], (D,))])
+
+
+def mmap_xvecs(filename, base_type='f'):
+    """
+    Memory-map a binary xvecs file (fvecs, ivecs or bvecs) as described at
+    http://corpus-texmex.irisa.fr/. The file is viewed as a structured array
+    of rows and the dimension column is stripped without copying the data.
+
+    :param str filename:
+        the path of the file
+    :param str base_type:
+        'f' for fvecs, 'i' for ivecs and 'b' for bvecs
+
+    :returns ndarray:
+        a read-only N x D view of the file, with the component type of the format
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return np.zeros((0, 0), dtype=XVECS_TYPES[base_type])
+
+    D = int(np.fromfile(filename, dtype='<i4', count=1)[0])
+    row_dtype = get_xvecs_dtype(D, base_type)
+    if size % row_dtype.itemsize != 0:
+        raise ValueError('Size of {} is not a multiple of the size of vectors of dimension {}'.format(filename, D))
+
+    rows = np.memmap(filename, dtype=row_dtype, mode='r', shape=(size / row_dtype.itemsize,))
+    return rows['vec']
+
+
+def load_xvecs(filename, base_type='f', max_num=None, start=0):
     """
     A helper to read in sift1m binary dataset. This parses the
     binary format described at http://corpus-texmex.irisa.fr/.
 
+    :param str filename:
+        the path of the file
+    :param str base_type:
+        'f' for fvecs, 'i' for ivecs and 'b' for bvecs
+    :param int max_num:
+        the maximum number of vectors to read, all by default
+    :param int start:
+        the index of the first vector to read
+
     :returns ndarray:
         a N x D array, where N is the number of observations
         and D is the number of features
     """
-    import os
-    import struct
-
-    format_code, format_size, py_type = {
-        'f': ('f', 4, float),
-        'i': ('I', 4, int),
-        'b': ('B', 1, float)
-    }[base_type]
-
-    size = os.path.getsize(filename)
+    A = mmap_xvecs(filename, base_type)
+    stop = None if max_num is None else start + max_num
+    return np.squeeze(A[start:stop].astype(XVECS_LOAD_TYPES[base_type]))
 
-    f = open(filename, 'rb')
-    D = np.uint32(struct.unpack('I', f.read(4))[0])
-    N = size / (4 + D * format_size)
 
-    if max_num is None:
-        max_num = N
-
-    f.seek(0)
-    A = np.zeros((max_num, D), dtype=py_type)
-    for i in xrange(max_num):
-        for j in xrange(D + 1):
-            if j == 0:
-                np.uint32(struct.unpack(format_code, f.read(4)))
-            else:
-                A[i, j - 1] = py_type(struct.unpack(format_code, f.read(format_size))[0])
-    f.close()
-    return np.squeeze(A)
+def iter_xvecs(filename, base_type='f', chunk_size=10000):
+    """
+    Iterate over the vectors of a binary xvecs file by chunks, without loading
+    the whole file in memory. A function returning this iterator can be given
+    as `get_chunks` to the streaming training of `lopq.model`.
+
+    :param str filename:
+        the path of the file
+    :param str base_type:
+        'f' for fvecs, 'i' for ivecs and 'b' for bvecs
+    :param int chunk_size:
+        the number of vectors per chunk
+
+    :returns generator:
+        a generator of chunk_size x D arrays
+    """
+    A = mmap_xvecs(filename, base_type)
+    for chunk in iterate_chunks(A, chunk_size):
+        yield chunk.astype(XVECS_LOAD_TYPES[base_type])
 
 
 def save_xvecs(data, filename, base_type='f'):
     """
     A helper to save an ndarray in the binary format as is expected in
-    load_xvecs above.
+    load_xvecs above. The rows are written through a memory map of the file.
+
+    :param ndarray data:
+        a N x D array of vectors, or a length N array of scalars saved as
+        vectors of dimension 1
+    :param str filename:
+        the path of the file
+    :param str base_type:
+        'f' for fvecs, 'i' for ivecs and 'b' for bvecs
     """
-    import struct
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    N, D = data.shape
 
-    format_code, format_size, py_type = {
-        'f': ('f', 4, float),
-        'i': ('I', 4, int),
-        'b': ('B', 1, float)
-    }[base_type]
+    if N == 0:
+        # Empty maps are not allowed
+        open(filename, 'wb').close()
+        return
 
-    f = open(filename, 'wb')
-    for d in data:
+    rows = np.memmap(filename, dtype=get_xvecs_dtype(D, base_type), mode='w+', shape=(N,))
+    rows['dim'] = D
+    rows['vec'] = data
+    rows.flush()
+    del rows
 
-        if hasattr(d, "__len__"):
-            D = len(d)
 
-            f.write(struct.pack('<I', D))
-            for x in d:
-                f.write(struct.pack(format_code, x))
-        else:
-            D = 1
-            f.write(struct.pack('<I', D))
-            f.write(struct.pack(format_code, d))
+def get_shm_dir():
+    """
+    Get a directory for files shared between processes, in memory if possible.
+    """
+    import tempfile
 
-    f.flush()
-    f.close()
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
 
 
-def parmap(f, X, nprocs=multiprocessing.cpu_count()):
+def get_mp_context():
     """
-    Parallel map implementation adapted from http://stackoverflow.com/questions/3288595/multiprocessing-using-pool-map-on-a-function-defined-in-a-class
+    Get the multiprocessing context used to start worker processes of offline jobs.
+    Workers are spawned where supported, Python 2 only supports forking: workers
+    started from a process that may run threads should use `start_worker` instead.
     """
+    try:
+        return multiprocessing.get_context('spawn')
+    except AttributeError:
+        return multiprocessing
 
-    def func_wrap(f, q_in, q_out):
-        while True:
-            i, x = q_in.get()
-            if i is None:
-                break
-            q_out.put((i, f(x)))
 
-    q_in = multiprocessing.Queue(1)
-    q_out = multiprocessing.Queue()
+class WorkerConnection(object):
+    """
+    Connection to a worker process started by `start_worker`, or to its parent, over a
+    pair of pipes. Objects are sent pickled, as with `multiprocessing.Pipe` connections.
+    """
 
-    proc = [multiprocessing.Process(target=func_wrap, args=(f, q_in, q_out)) for _ in range(nprocs)]
-    for p in proc:
-        p.daemon = True
-        p.start()
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
 
-    sent = [q_in.put((i, x)) for i, x in enumerate(X)]
-    [q_in.put((None, None)) for _ in range(nprocs)]
-    res = [q_out.get() for _ in range(len(sent))]
+    def send(self, obj):
+        pickle.dump(obj, self.writer, protocol=2)
+        self.writer.flush()
 
-    [p.join() for p in proc]
-    [p.terminate() for p in proc]
+    def recv(self):
+        return pickle.load(self.reader)
 
-    return [x for i, x in sorted(res)]
+    def close(self):
+        for f in [self.writer, self.reader]:
+            try:
+                f.close()
+            except IOError:
+                pass
 
 
-def get_chunk_ranges(N, num_procs):
+def start_worker(target, args=()):
     """
-    A helper that given a number N representing the size of an iterable and the num_procs over which to
-    divide the data return a list of (start_index, end_index) pairs that divide the data as evenly as possible
-    into num_procs buckets.
+    Start a worker process calling `target(conn, *args)` in a fresh Python interpreter,
+    `conn` being a `WorkerConnection` to the parent. Unlike a forked process, the worker
+    does not inherit the threads and locks of the parent, so workers can be started from
+    any thread of e.g. a gunicorn worker refreshing its index in the background. The
+    worker gets an EOF on its connection, and should exit, when the parent dies.
+
+    :param function target:
+        a module level function, pickled by reference
+    :param tuple args:
+        the extra arguments of `target`, pickled
+
+    :returns Popen proc:
+        the worker process
+    :returns WorkerConnection conn:
+        the connection to the worker
     """
-    per_thread = N / num_procs
-    allocation = [per_thread] * num_procs
-    allocation[0] += N - num_procs * per_thread
-    data_ranges = [0] + reduce(lambda acc, num: acc + [num + (acc[-1] if len(acc) else 0)], allocation, [])
-    data_ranges = [(data_ranges[i], data_ranges[i + 1]) for i in range(len(data_ranges) - 1)]
-    return data_ranges
+    import subprocess
+
+    # The worker imports lopq from where the parent did
+    env = dict(os.environ)
+    lopq_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([lopq_root] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    proc = subprocess.Popen([sys.executable, '-m', 'lopq.worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            close_fds=True, env=env)
+    conn = WorkerConnection(proc.stdout, proc.stdin)
+    try:
+        conn.send(list(sys.path))
+        conn.send((target, args))
+    except IOError:
+        stop_worker(proc, conn)
+        raise RuntimeError('Could not start worker process')
+    return proc, conn
+
+
+def stop_worker(proc, conn, timeout=10):
+    """
+    Stop a worker process started by `start_worker`, sending it a None request and
+    terminating it if it did not exit after `timeout` seconds.
+    """
+    import time
+
+    try:
+        conn.send(None)
+    except IOError:
+        pass
+    conn.close()
+    end = time.time() + timeout
+    while proc.poll() is None and time.time() < end:
+        time.sleep(0.01)
+    if proc.poll() is None:
+        proc.terminate()
+        proc.wait()
+
+
+def split_codes(coarse_codes, fine_codes):
+    """
+    Convert arrays of coarse and fine codes, as returned by `predict_batch`,
+    to a list of LOPQCode tuples.
+    """
+    from .model import LOPQCode
+
+    return [LOPQCode(tuple(c), tuple(f)) for c, f in zip(coarse_codes.tolist(), fine_codes.tolist())]
+
+
+def encoder_worker(conn, model_path):
+    """
+    Main loop of an `EncoderPool` worker process. The model is loaded once, then each
+    task is a range of rows of a shared feature file to encode, until a None task.
+    """
+    with open(model_path, 'rb') as f:
+        model = pickle.load(f)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        job_id, chunk, path, start, end = task
+        try:
+            X = np.asarray(np.load(path, mmap_mode='r')[start:end])
+            coarse_codes, fine_codes = model.predict_batch(X)
+            reply = (job_id, chunk, coarse_codes, fine_codes, None)
+        except Exception as inst:
+            reply = (job_id, chunk, None, None, '{}: {}'.format(type(inst), inst))
+        try:
+            conn.send(reply)
+        except IOError:
+            # The pool was closed
+            break
+
+
+class EncoderPool(object):
+
+    def __init__(self, model, num_procs=4, chunk_size=1024, shm_dir=None):
+        """
+        Create a pool of persistent worker processes computing LOPQ codes. The model is
+        loaded once by each worker, features are passed through a memory-mapped file
+        (in /dev/shm when available) and only the compact codes are sent back.
+
+        Workers are started with `start_worker` as fresh interpreters, so a pool can be
+        created lazily by a process running threads. A pool must be used by the process
+        that created it, see `is_usable`.
+
+        :param LOPQModel model:
+            a model instance to use to compute codes
+        :param int num_procs:
+            the number of worker processes
+        :param int chunk_size:
+            the number of rows encoded per task
+        :param str shm_dir:
+            the directory of the shared files, defaults to `get_shm_dir()`
+        """
+        import tempfile
+
+        self.pid = os.getpid()
+        self.chunk_size = chunk_size
+        self.shm_dir = shm_dir if shm_dir is not None else get_shm_dir()
+        self.num_coarse_splits = model.num_coarse_splits
+        self.M = model.M
+        self.coarse_dtype = get_cluster_dtype(model.V)
+        self.fine_dtype = get_cluster_dtype(model.subquantizer_clusters)
+        self.lock = threading.Lock()
+        self.job_id = 0
+
+        fd, self.model_path = tempfile.mkstemp(prefix='lopq_model_', suffix='.pkl', dir=self.shm_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(model, f, protocol=2)
+
+        self.procs = []
+        self.conns = []
+        try:
+            for _ in range(num_procs):
+                proc, conn = start_worker(encoder_worker, (self.model_path,))
+                self.procs.append(proc)
+                self.conns.append(conn)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_usable(self):
+        """
+        Check that the pool was created by the current process and that its workers are alive.
+        """
+        return self.pid == os.getpid() and all(p.poll() is None for p in self.procs)
+
+    def iter_predict_batch(self, X):
+        """
+        Compute the codes of a batch of datapoints with the pool workers,
+        yielding the codes of each chunk of rows in order.
+
+        :param ndarray X:
+            a NxD array of points to code
+
+        :returns generator:
+            (coarse_codes, fine_codes) pairs of arrays for consecutive chunks of rows
+        """
+        import tempfile
+
+        if len(X) == 0:
+            return
+        X = np.reshape(X, (len(X), -1))
+        N = X.shape[0]
+
+        with self.lock:
+            self.job_id += 1
+            job_id = self.job_id
+
+            fd, path = tempfile.mkstemp(prefix='lopq_feats_', suffix='.npy', dir=self.shm_dir)
+            os.close(fd)
+            try:
+                shared = np.lib.format.open_memmap(path, mode='w+', dtype=X.dtype, shape=X.shape)
+                shared[:] = X
+                shared.flush()
+                del shared
+
+                # Chunk i is encoded by worker i % num_procs, each worker replying in order. At most
+                # two chunks per worker are in flight, so that pipes never fill up both ways
+                starts = range(0, N, self.chunk_size)
+                num_procs = len(self.conns)
+                nb_sent = 0
+                for chunk in xrange(len(starts)):
+                    while nb_sent < len(starts) and nb_sent < chunk + 2 * num_procs:
+                        start = starts[nb_sent]
+                        self.send_task(nb_sent % num_procs, (job_id, nb_sent, path, start,
+                                                             min(start + self.chunk_size, N)))
+                        nb_sent += 1
+                    while True:
+                        try:
+                            res_job_id, res_chunk, coarse_codes, fine_codes, error = \
+                                self.conns[chunk % num_procs].recv()
+                        except (EOFError, IOError):
+                            raise RuntimeError('An encoder worker process died')
+                        # Skip leftovers of a previous job that was aborted
+                        if res_job_id == job_id:
+                            break
+                    if error is not None:
+                        raise RuntimeError('Could not compute codes: {}'.format(error))
+                    yield coarse_codes, fine_codes
+            finally:
+                os.remove(path)
+
+    def send_task(self, worker, task):
+        try:
+            self.conns[worker].send(task)
+        except IOError:
+            raise RuntimeError('An encoder worker process died')
+
+    def predict_batch(self, X):
+        """
+        Compute the codes of a batch of datapoints with the pool workers.
+
+        :param ndarray X:
+            a NxD array of points to code
+
+        :returns ndarray:
+            a Nx2 array of coarse codes
+        :returns ndarray:
+            a NxM array of fine codes
+        """
+        chunks = list(self.iter_predict_batch(X))
+        if not chunks:
+            return np.zeros((0, self.num_coarse_splits), dtype=self.coarse_dtype), \
+                np.zeros((0, self.M), dtype=self.fine_dtype)
+        return np.concatenate([c for c, _ in chunks]), np.concatenate([f for _, f in chunks])
+
+    def close(self):
+        """
+        Stop the worker processes and remove the shared model file.
+        """
+        if self.pid != os.getpid():
+            return
+        for proc, conn in zip(self.procs, self.conns):
+            stop_worker(proc, conn)
+        self.procs = []
+        self.conns = []
+        if os.path.exists(self.model_path):
+            os.remove(self.model_path)
 
 
 def compute_codes_parallel(data, model, num_procs=4):
     """
     A helper function that parallelizes the computation of LOPQ codes in 
-    a configurable number of processes.
+    a configurable number of processes, with a temporary `EncoderPool`.
 
     :param ndarray data:
         an ndarray of data points
@@ -190,14 +588,13 @@ def compute_codes_parallel(data, model, num_procs=4):
     :returns iterable:
         an iterable of computed codes in the input order
     """
-    def compute_partition(data):
-        return [model.predict(d) for d in data]
+    if num_procs <= 1:
+        return compute_codes_notparallel(data, model)
 
-    N = len(data)
-    partitions = [data[a:b] for a, b in get_chunk_ranges(N, num_procs)]
-    codes = parmap(compute_partition, partitions, num_procs)
+    with EncoderPool(model, num_procs) as pool:
+        coarse_codes, fine_codes = pool.predict_batch(data)
 
-    return chain(*codes)
+    return split_codes(coarse_codes, fine_codes)
 
 
 def compute_codes_notparallel(data, model):
@@ -212,10 +609,60 @@ def compute_codes_notparallel(data, model):
     :returns iterable:
         an iterable of computed codes in the input order
     """
-    def compute_partition(data):
-        return [model.predict(d) for d in data]
-
-    return compute_partition(data)
+    if len(data) == 0:
+        return []
+    data = np.reshape(data, (len(data), -1))
+    coarse_codes, fine_codes = model.predict_batch(data)
+    return split_codes(coarse_codes, fine_codes)
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        A compact set membership filter, that can return false positives but no false
+        negatives. It uses about 1.44 * log2(1 / error_rate) bits per key, e.g. 1.8 bytes
+        per key for an error rate of 0.1%.
+
+        :param int capacity:
+            the number of keys the filter is sized for
+        :param float error_rate:
+            the false positive rate once `capacity` keys have been added
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, key):
+        """
+        Get the bit positions of a key, by double hashing of its md5 digest.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, bytes):
+            key = repr(key)
+        h1, h2 = struct.unpack_from('<II', hashlib.md5(key).digest())
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self.get_positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.get_positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def nbytes(self):
+        return len(self.bits)
 
 # Modifications by Svebor Karaman
 
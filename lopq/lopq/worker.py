@@ -0,0 +1,31 @@
+# Entry point of the worker processes started by `lopq.utils.start_worker`, run as
+# `python -m lopq.worker` in a fresh interpreter.
+#
+# The worker reads the sys.path of its parent, then the (target, args) pair it runs,
+# from its stdin, and calls target(conn, *args), `conn` being a `WorkerConnection`
+# over its stdin and stdout. Anything printed by the target goes to stderr.
+import os
+import sys
+
+
+def main():
+    reader = os.fdopen(os.dup(0), 'rb')
+    writer = os.fdopen(os.dup(1), 'wb')
+    # Keep the protocol pipes out of reach of prints
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(2, 1)
+
+    from .utils import WorkerConnection
+    conn = WorkerConnection(reader, writer)
+    try:
+        sys.path[:] = conn.recv()
+        target, args = conn.recv()
+    except EOFError:
+        return
+    target(conn, *args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Micro-benchmark of the vectorized multi-sequence traversal against the heap based reference.
+import argparse
+import time
+import numpy as np
+from lopq.search import multisequence, multisequence_heap, multisequence_batches
+
+
+def time_traversal(traversal, queries, centroids, num_cells):
+    """
+    Traverse the first num_cells cells for each query and return the list of cells
+    visited per query along with the mean traversal time in seconds.
+    """
+    all_cells = []
+    start = time.time()
+    for x in queries:
+        cells = []
+        for _, cell in traversal(x, centroids):
+            cells.append(tuple(int(c) for c in cell))
+            if len(cells) >= num_cells:
+                break
+        all_cells.append(cells)
+    return all_cells, (time.time() - start) / len(queries)
+
+
+def time_batches(queries, centroids, num_cells):
+    """
+    Retrieve the first num_cells cells for each query as arrays with `multisequence_batches`
+    and return the list of cells per query along with the mean traversal time in seconds.
+    """
+    all_cells = []
+    start = time.time()
+    for x in queries:
+        cells = list(multisequence_batches(x, centroids, batch_size=num_cells, max_cells=num_cells))[0][1]
+        all_cells.append(cells)
+    elapsed = (time.time() - start) / len(queries)
+    return [[tuple(int(c) for c in cell) for cell in cells] for cells in all_cells], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark multi-sequence traversal implementations.')
+    parser.add_argument('--D', type=int, default=256, help='dimension of the (PCA projected) data')
+    parser.add_argument('--V', type=int, default=256, help='number of clusters per coarse split')
+    parser.add_argument('--num_queries', type=int, default=100, help='number of random queries')
+    parser.add_argument('--num_cells', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='numbers of cells to traverse')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(args.seed)
+    centroids = [rs.randn(args.V, args.D / 2), rs.randn(args.V, args.D / 2)]
+    queries = rs.randn(args.num_queries, args.D)
+
+    for num_cells in args.num_cells:
+        ref_cells, ref_time = time_traversal(multisequence_heap, queries, centroids, num_cells)
+        vec_cells, vec_time = time_traversal(multisequence, queries, centroids, num_cells)
+        top_cells, top_time = time_batches(queries, centroids, num_cells)
+        if ref_cells != vec_cells or ref_cells != top_cells:
+            raise AssertionError('Cell orders differ for %d cells' % num_cells)
+        print '%6d cells: heap %8.3fms, vectorized %8.3fms (%.1fx), top-K %8.3fms (%.1fx) per query' % \
+            (num_cells, 1000 * ref_time, 1000 * vec_time, ref_time / vec_time, 1000 * top_time, ref_time / top_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# Recall/latency benchmark of LOPQ models and searcher backends.
+#
+# Trains a model for each (V, M, PCA dimension) configuration, indexes the data with each
+# searcher backend and sweeps search quota and limit. Results are written as JSON so they
+# can be compared across commits. Runs offline on a synthetic Gaussian mixture by default,
+# or on fvecs files, e.g.:
+#
+#   python benchmark_recall.py --V 8 16 --quota 100 1000 --output results.json
+#   python benchmark_recall.py --data base.fvecs --queries query.fvecs --ground_truth gt.ivecs
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from lopq.model import LOPQModel, LOPQModelPCA
+from lopq.search import LOPQSearcher, LOPQSearcherLMDB, LOPQSearcherColumnar, LOPQSearcherMmap
+from lopq.eval import compute_nearest_neighbors, get_recall_stats
+from lopq.utils import load_xvecs, mmap_xvecs
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+SEARCHERS = ['LOPQSearcher', 'LOPQSearcherLMDB', 'LOPQSearcherColumnar', 'LOPQSearcherMmap']
+RECALL_THRESHOLDS = [1, 10, 100]
+
+
+def generate_gaussian_mixture(N, num_queries, D, num_clusters, cluster_std, seed):
+    """
+    Generate data and queries drawn from the same mixture of isotropic Gaussians.
+    """
+    rs = np.random.RandomState(seed)
+    centers = rs.randn(num_clusters, D) * 10
+
+    def sample(n):
+        labels = rs.randint(num_clusters, size=n)
+        return centers[labels] + rs.randn(n, D) * cluster_std
+
+    return sample(N), sample(num_queries)
+
+
+def train_model(data, V, M, subq, pca_dims, seed):
+    """
+    Train a LOPQModel, or a LOPQModelPCA if pca_dims is non zero. Training output
+    is redirected to stderr to keep stdout for the JSON results.
+    """
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        if pca_dims:
+            model = LOPQModelPCA(V=V, M=M, subquantizer_clusters=subq)
+            model.fit(data, pca_dims=pca_dims, n_init=1, random_state=seed)
+        else:
+            model = LOPQModel(V=V, M=M, subquantizer_clusters=subq)
+            model.fit(data, n_init=1, random_state=seed)
+    finally:
+        sys.stdout = stdout
+    return model
+
+
+def build_searcher(name, model, work_dir):
+    """
+    Create an empty searcher of the given backend, storing files in work_dir if needed.
+    """
+    if name == 'LOPQSearcher':
+        return LOPQSearcher(model)
+    elif name == 'LOPQSearcherLMDB':
+        return LOPQSearcherLMDB(model, os.path.join(work_dir, 'lmdb'))
+    elif name == 'LOPQSearcherColumnar':
+        return LOPQSearcherColumnar(model)
+    elif name == 'LOPQSearcherMmap':
+        return LOPQSearcherMmap(model, os.path.join(work_dir, 'segments'), background_merge=False)
+    raise ValueError('Unknown searcher {}'.format(name))
+
+
+def get_index_nbytes(searcher):
+    """
+    Get the size of the index of a searcher: the size of its arrays or files when
+    the backend reports it, of the used LMDB pages, or of the pickled index otherwise.
+    """
+    if hasattr(searcher, 'get_index_nbytes'):
+        return searcher.get_index_nbytes()
+    if isinstance(searcher, LOPQSearcherLMDB):
+        return (searcher.env.info()['last_pgno'] + 1) * searcher.env.stat()['psize']
+    return len(pickle.dumps(dict(searcher.index), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(stats):
+    """
+    Aggregate the per query statistics of `get_recall_stats`.
+    """
+    latencies_ms = 1000 * stats['latencies']
+    return {
+        'recall': dict(('recall@{}'.format(t), float(r)) for t, r in zip(RECALL_THRESHOLDS, stats['recall'])),
+        'latency_ms': {
+            'mean': float(latencies_ms.mean()),
+            'p50': float(np.percentile(latencies_ms, 50)),
+            'p95': float(np.percentile(latencies_ms, 95)),
+            'p99': float(np.percentile(latencies_ms, 99))
+        },
+        'cells_visited': float(stats['visited'].mean()),
+        'candidates_scored': float(stats['candidates'].mean())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark recall and latency of LOPQ indexes.')
+    parser.add_argument('--data', help='fvecs file of vectors to index, a Gaussian mixture is generated if not set')
+    parser.add_argument('--queries', help='fvecs file of queries, required with --data')
+    parser.add_argument('--ground_truth', help='ivecs file of ranked true neighbors of the queries, computed if not set')
+    parser.add_argument('--train', help='fvecs file of training vectors, defaults to the indexed vectors')
+    parser.add_argument('--N', type=int, default=20000, help='number of synthetic vectors')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of synthetic queries')
+    parser.add_argument('--D', type=int, default=64, help='dimension of the synthetic vectors')
+    parser.add_argument('--num_clusters', type=int, default=64, help='number of synthetic mixture components')
+    parser.add_argument('--cluster_std', type=float, default=3.0, help='standard deviation of the mixture components')
+    parser.add_argument('--V', type=int, nargs='+', default=[16], help='numbers of clusters per coarse split')
+    parser.add_argument('--M', type=int, nargs='+', default=[8], help='numbers of fine codes')
+    parser.add_argument('--subq', type=int, default=256, help='number of clusters per subquantizer')
+    parser.add_argument('--pca_dims', type=int, nargs='+', default=[0],
+                        help='PCA dimensions of LOPQModelPCA models, 0 to train a LOPQModel')
+    parser.add_argument('--searchers', nargs='+', default=SEARCHERS, choices=SEARCHERS, help='searcher backends')
+    parser.add_argument('--quota', type=int, nargs='+', default=[100, 1000, 10000], help='search quotas')
+    parser.add_argument('--limit', type=int, nargs='+', default=[100], help='search limits, capped by the quota')
+    parser.add_argument('--cell_cutoff', action='store_true', help='stop visiting cells early')
+    parser.add_argument('--precompute_adc', action='store_true',
+                        help='precompute the query independent terms of the distances')
+    parser.add_argument('--num_procs', type=int, default=1, help='processes used to compute ground truth')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='JSON output file, stdout if not set')
+    args = parser.parse_args()
+
+    if args.data:
+        if not args.queries:
+            parser.error('--queries is required with --data')
+        data = mmap_xvecs(args.data)
+        queries = load_xvecs(args.queries)
+        dataset = {'data': args.data, 'queries': args.queries}
+    else:
+        data, queries = generate_gaussian_mixture(args.N, args.num_queries, args.D, args.num_clusters,
+                                                  args.cluster_std, args.seed)
+        dataset = {'synthetic': 'gaussian_mixture', 'N': args.N, 'num_queries': args.num_queries, 'D': args.D,
+                   'num_clusters': args.num_clusters, 'cluster_std': args.cluster_std, 'seed': args.seed}
+    train = load_xvecs(args.train) if args.train else data
+
+    if args.ground_truth:
+        nns = load_xvecs(args.ground_truth, 'i')
+    else:
+        start = time.time()
+        nns, _ = compute_nearest_neighbors(queries, data, k=1, num_procs=args.num_procs)
+        print >> sys.stderr, 'Computed ground truth in %.1fs' % (time.time() - start)
+
+    output = {'commit': get_git_commit(), 'dataset': dataset, 'cell_cutoff': args.cell_cutoff,
+              'precompute_adc': args.precompute_adc, 'runs': []}
+    for V in args.V:
+        for M in args.M:
+            for pca_dims in args.pca_dims:
+                model_params = {'V': V, 'M': M, 'subq': args.subq, 'pca_dims': pca_dims}
+                start = time.time()
+                model = train_model(np.asarray(train), V, M, args.subq, pca_dims, args.seed)
+                train_time = time.time() - start
+                if args.precompute_adc:
+                    model.precompute_adc_terms()
+                print >> sys.stderr, 'Trained model %s in %.1fs' % (model_params, train_time)
+
+                for name in args.searchers:
+                    work_dir = tempfile.mkdtemp(prefix='lopq_benchmark_')
+                    try:
+                        searcher = build_searcher(name, model, work_dir)
+                        start = time.time()
+                        searcher.add_data(data)
+                        if isinstance(searcher, LOPQSearcherMmap):
+                            searcher.merge_segments()
+                        index_time = time.time() - start
+                        index_nbytes = get_index_nbytes(searcher)
+
+                        for quota in args.quota:
+                            for limit in sorted(set(min(limit, quota) for limit in args.limit)):
+                                stats = get_recall_stats(searcher, queries, nns, RECALL_THRESHOLDS, quota, limit,
+                                                         args.cell_cutoff)
+                                run = {'model': model_params, 'searcher': name, 'quota': quota, 'limit': limit,
+                                       'train_time_s': train_time, 'index_time_s': index_time,
+                                       'index_bytes_per_item': float(index_nbytes) / len(data)}
+                                run.update(summarize(stats))
+                                output['runs'].append(run)
+                                print >> sys.stderr, '%s V=%d M=%d pca=%d quota=%d limit=%d: %s, p50 %.2fms' % \
+                                    (name, V, M, pca_dims, quota, limit, run['recall'], run['latency_ms']['p50'])
+                        del searcher
+                    finally:
+                        shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
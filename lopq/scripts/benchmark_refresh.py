@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Refresh cost benchmark of the duplicate detection modes of LOPQSearcher.
+#
+# Adds a sequence of updates of random codes to an index and times each update as the
+# index grows, a fraction of each update being items of earlier updates that must be
+# discarded as duplicates. Codes are drawn directly, no model is trained. Results are
+# written as JSON, e.g.:
+#
+#   python benchmark_refresh.py --num_updates 50 --update_size 20000 --output refresh.json
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from lopq.search import LOPQSearcher, DEDUP_MODES
+from benchmark_recall import get_git_commit
+
+
+def generate_update(rs, update, update_size, V, M, subq, duplicate_rate):
+    """
+    Generate the ids and codes of an update, the ids of duplicates being drawn
+    from earlier updates with the same codes.
+    """
+    ids = []
+    codes = []
+    for i in xrange(update_size):
+        if update and rs.rand() < duplicate_rate:
+            item = (rs.randint(update), rs.randint(update_size))
+        else:
+            item = (update, i)
+        # Codes are a function of the item so that duplicates fall in the same cell
+        item_rs = np.random.RandomState(item[0] * update_size + item[1])
+        ids.append('{}_{}'.format(*item))
+        codes.append((tuple(item_rs.randint(V, size=2).tolist()), tuple(item_rs.randint(subq, size=M).tolist())))
+    return ids, codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the refresh cost of LOPQSearcher as the index grows.')
+    parser.add_argument('--num_updates', type=int, default=50, help='number of updates')
+    parser.add_argument('--update_size', type=int, default=20000, help='number of items per update')
+    parser.add_argument('--duplicate_rate', type=float, default=0.05, help='fraction of items of earlier updates')
+    parser.add_argument('--V', type=int, default=16, help='number of clusters per coarse split')
+    parser.add_argument('--M', type=int, default=8, help='number of fine codes')
+    parser.add_argument('--subq', type=int, default=256, help='number of clusters per subquantizer')
+    parser.add_argument('--dedup', nargs='+', default=DEDUP_MODES, choices=DEDUP_MODES, help='dedup modes')
+    parser.add_argument('--bloom_capacity', type=int, default=10000000, help='capacity of the Bloom filter')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='JSON output file, stdout if not set')
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(args.seed)
+    updates = [generate_update(rs, update, args.update_size, args.V, args.M, args.subq, args.duplicate_rate)
+               for update in xrange(args.num_updates)]
+
+    output = {'commit': get_git_commit(), 'params': vars(args), 'runs': []}
+    for dedup in args.dedup:
+        searcher = LOPQSearcher(None, dedup=dedup, bloom_capacity=args.bloom_capacity)
+        steps = []
+        for update, (ids, codes) in enumerate(updates):
+            nb_before = searcher.nb_indexed
+            start = time.time()
+            searcher.add_codes(codes, ids)
+            add_time = time.time() - start
+            steps.append({'update': update, 'index_size': nb_before, 'added': searcher.nb_indexed - nb_before,
+                          'add_time_ms': 1000 * add_time})
+        times = np.array([step['add_time_ms'] for step in steps])
+        # Ratio of the cost of the last and first quarters of the updates, about 1 when flat
+        quarter = max(1, len(times) / 4)
+        run = {'dedup': dedup, 'nb_indexed': searcher.nb_indexed, 'steps': steps,
+               'growth_ratio': float(times[-quarter:].mean() / times[:quarter].mean())}
+        if searcher.bloom is not None:
+            run['bloom_bytes'] = searcher.bloom.nbytes()
+        output['runs'].append(run)
+        print >> sys.stderr, '%s: %d items indexed, first update %.1fms, last update %.1fms, growth ratio %.2f' % \
+            (dedup, searcher.nb_indexed, times[0], times[-1], run['growth_ratio'])
+        del searcher
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
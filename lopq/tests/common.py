@@ -0,0 +1,106 @@
+# Small models and data shared by the tests, fitted once per test run.
+import numpy as np
+from lopq.model import LOPQModel, LOPQModelPCA
+from lopq.search import LOPQSearcher
+
+_models = {}
+
+
+def get_data(n_clusters=8, n_per_cluster=250, dim=16, seed=0):
+    """
+    Get clustered random data, so that coarse cells are unevenly filled.
+    """
+    rs = np.random.RandomState(seed)
+    return np.concatenate([rs.randn(n_per_cluster, dim) + rs.randn(1, dim) * 3 for _ in xrange(n_clusters)])
+
+
+def get_model(pca=False):
+    """
+    Get a small model fitted on `get_data`, with V=4, M=4 and 16 subquantizer clusters.
+    """
+    if pca not in _models:
+        data = get_data()
+        if pca:
+            model = LOPQModelPCA(V=4, M=4, subquantizer_clusters=16)
+            model.fit(data, pca_dims=8, n_init=1, random_state=0)
+        else:
+            model = LOPQModel(V=4, M=4, subquantizer_clusters=16)
+            model.fit(data, n_init=1, random_state=0)
+        _models[pca] = model
+    return _models[pca]
+
+
+def predict_batch(model, data):
+    """
+    Get the coarse and fine codes of data as arrays, also for empty data.
+    """
+    if not len(data):
+        return np.zeros((0, 2), dtype=np.int64), np.zeros((0, model.M), dtype=np.int64)
+    return model.predict_batch(data)
+
+
+def get_codes(model, data):
+    """
+    Get the codes of data as a list of (coarse, fine) tuples.
+    """
+    return [model.predict(x) for x in data]
+
+
+def get_queries():
+    """
+    Get queries drawn like `get_data`, but not in the data.
+    """
+    return get_data(n_per_cluster=3, seed=1)
+
+
+def build_searcher(searcher):
+    """
+    Index the codes of `get_data` in `searcher`, with the row numbers as item ids.
+    """
+    data = get_data()
+    searcher.add_codes(get_codes(searcher.model, data), range(len(data)))
+    return searcher
+
+
+def search_all(searcher, quota):
+    """
+    Search all `get_queries` with distances.
+    """
+    return [searcher.search(x, quota=quota, with_dists=True) for x in get_queries()]
+
+
+def check_same_results(results, expected):
+    """
+    Check that results of `search_all` have the same items, codes, distances and visited counts.
+    """
+    for (res, visited), (exp, exp_visited) in zip(results, expected):
+        assert [r.id for r in res] == [r.id for r in exp]
+        assert [tuple(r.code[0]) for r in res] == [tuple(r.code[0]) for r in exp]
+        assert [tuple(r.code[1]) for r in res] == [tuple(r.code[1]) for r in exp]
+        np.testing.assert_allclose([r.dist for r in res], [r.dist for r in exp], rtol=1e-10)
+        assert visited == exp_visited
+
+
+def check_same_result_sets(results, expected):
+    """
+    Check that results of `search_all` have the same items, whatever the order of items at
+    the same distance.
+    """
+    for (res, _), (exp, _) in zip(results, expected):
+        assert sorted((r.dist, r.id) for r in res) == sorted((r.dist, r.id) for r in exp)
+
+
+def check_backend(build, quotas=(10, 100, 600), check=check_same_results):
+    """
+    Check that a searcher returned by `build` indexes and retrieves like `LOPQSearcher`.
+    """
+    reference = build_searcher(LOPQSearcher(get_model()))
+    searcher = build()
+    try:
+        build_searcher(searcher)
+        assert searcher.get_nb_indexed() == reference.get_nb_indexed()
+        for quota in quotas:
+            check(search_all(searcher, quota), search_all(reference, quota))
+    finally:
+        if hasattr(searcher, 'close'):
+            searcher.close()
@@ -0,0 +1,67 @@
+import numpy as np
+
+from lopq.search import LOPQSearcher, LOPQSearcherColumnar, adc_distances
+from .common import get_data, get_model, get_codes, get_queries, build_searcher, search_all
+
+
+def test_adc_distances():
+    rs = np.random.RandomState(0)
+    table = rs.rand(8, 256)
+    fine_codes = rs.randint(0, 256, size=(1000, 8)).astype(np.uint8)
+    expected = [sum(table[m, code[m]] for m in xrange(8)) for code in fine_codes]
+    # Same summation order, so the same floats
+    assert adc_distances(table, fine_codes).tolist() == expected
+
+
+def test_compute_distances():
+    model = get_model()
+    searcher = LOPQSearcher(model)
+    codes = get_codes(model, get_data()[::10])
+    items = list(enumerate(codes))
+    for x in get_queries()[:5]:
+        for dist, (_, code) in searcher.compute_distances(x, items):
+            subquantizer_dists = model.get_subquantizer_distances(x, code.coarse)
+            expected = sum(d[c] for d, c in zip(subquantizer_dists, code.fine))
+            np.testing.assert_allclose(dist, expected, rtol=1e-12)
+
+
+def check_precomputed_adc(pca):
+    model = get_model(pca)
+    data = get_data()[::25]
+    if pca:
+        data = model.apply_PCA(data)
+    # PCA projected data is float32
+    tol = 1e-5 if pca else 1e-7
+    model.precompute_adc_terms()
+    try:
+        for x in data:
+            for coarse in [(0, 0), (1, 3), (3, 2)]:
+                expected = np.array(model.get_subquantizer_distances(x, coarse))
+                np.testing.assert_allclose(model.get_subquantizer_distances_precomputed(x, coarse), expected,
+                                           rtol=tol, atol=tol)
+                for split in [0, 1]:
+                    expected = np.array(model.get_subquantizer_distances(x, coarse, coarse_split=split))
+                    np.testing.assert_allclose(model.get_subquantizer_distances_precomputed(x, coarse, split),
+                                               expected, rtol=tol, atol=tol)
+    finally:
+        model.adc_terms = None
+
+
+def test_precomputed_adc():
+    yield check_precomputed_adc, False
+    yield check_precomputed_adc, True
+
+
+def test_search_precomputed_adc():
+    model = get_model()
+    searcher = build_searcher(LOPQSearcherColumnar(model))
+    expected = search_all(searcher, 100)
+    model.precompute_adc_terms()
+    try:
+        results = search_all(searcher, 100)
+    finally:
+        model.adc_terms = None
+    for (res, _), (exp, _) in zip(results, expected):
+        # Distances are equal up to float rounding, which can only swap near ties
+        assert set(r.id for r in res) == set(r.id for r in exp)
+        np.testing.assert_allclose(sorted(r.dist for r in res), sorted(r.dist for r in exp), rtol=1e-7)
@@ -0,0 +1,56 @@
+import numpy as np
+from nose.tools import assert_raises
+
+from lopq.codes import CodesBatch, dump_codes, load_codes, is_codes_data
+from .common import get_data, get_model, predict_batch
+
+
+def get_batch(ids):
+    model = get_model()
+    coarse_codes, fine_codes = predict_batch(model, get_data()[:len(ids)])
+    return CodesBatch(ids, coarse_codes, fine_codes)
+
+
+def check_round_trip(batch, compression):
+    data = dump_codes(batch, compression=compression)
+    assert is_codes_data(data)
+    loaded = load_codes(data)
+    assert len(loaded) == len(batch)
+    # Empty batches are written with string ids, see normalize_batch_ids
+    assert loaded.ids.tolist() == batch.ids.tolist()
+    np.testing.assert_array_equal(loaded.coarse_codes, batch.coarse_codes)
+    np.testing.assert_array_equal(loaded.fine_codes, batch.fine_codes)
+    assert loaded.coarse_codes.dtype == batch.coarse_codes.dtype
+    assert loaded.fine_codes.dtype == batch.fine_codes.dtype
+
+
+def test_round_trip():
+    int_ids = np.arange(100, 300)
+    str_ids = np.array(['{:040x}_1_2_3_{}'.format(i, i % 7) for i in xrange(150)])
+    for compression in ['', 'zlib']:
+        yield check_round_trip, get_batch(int_ids), compression
+        yield check_round_trip, get_batch(str_ids), compression
+        yield check_round_trip, get_batch(np.arange(0)), compression
+
+
+def test_from_dict():
+    batch = get_batch(np.array(['a', 'b', 'c']))
+    codes_dict = dict((iid, ((int(c[0]), int(c[1])), tuple(f.tolist())))
+                      for iid, c, f in zip(batch.ids, batch.coarse_codes, batch.fine_codes))
+    loaded = load_codes(dump_codes(CodesBatch.from_dict(codes_dict)))
+    assert loaded.to_dict() == codes_dict
+
+
+def test_invalid_data():
+    data = dump_codes(get_batch(np.arange(10)))
+    assert not is_codes_data({'a': 1})
+    assert_raises(ValueError, load_codes, 'not codes data')
+    assert_raises(ValueError, load_codes, data[:-1])
+    assert_raises(ValueError, dump_codes, get_batch(np.arange(10)), 'lzma')
+
+
+def test_unique():
+    batch = get_batch(np.array([3, 1, 3, 2, 1]))
+    unique = batch.unique()
+    np.testing.assert_array_equal(unique.ids, [3, 1, 2])
+    np.testing.assert_array_equal(unique.fine_codes, batch.fine_codes[[0, 1, 3]])
@@ -0,0 +1,100 @@
+import sys
+import threading
+import numpy as np
+
+from lopq.search import LOPQSearcherColumnar, CellBuffer, ItemIdColumn
+from .common import get_data, get_model, get_queries, check_backend, predict_batch
+
+
+def test_columnar():
+    model = get_model()
+    yield check_backend, lambda: LOPQSearcherColumnar(model)
+    yield check_backend, lambda: LOPQSearcherColumnar(model, dense_ids=True)
+
+
+def test_item_id_column():
+    rs = np.random.RandomState(0)
+    column = ItemIdColumn(capacity=16)
+    ids = rs.permutation(10000) * 7
+    expected = set()
+    for batch in np.array_split(ids, 37):
+        batch = column.normalize(batch)
+        assert not column.contains(batch).any()
+        rows = column.append(batch)
+        np.testing.assert_array_equal(column[rows], batch)
+        expected.update(batch.tolist())
+        queries = rs.randint(0, 7 * 10000, size=200)
+        np.testing.assert_array_equal(column.contains(queries), [q in expected for q in queries])
+    assert len(column) == len(ids)
+
+
+def test_item_id_column_strings():
+    column = ItemIdColumn()
+    column.append(column.normalize(['a', 'bb']))
+    column.append(column.normalize(['longer_id']))
+    np.testing.assert_array_equal(column.contains(column.normalize(['a', 'bb', 'longer_id', 'b'])),
+                                  [True, True, True, False])
+    try:
+        column.normalize([1, 2])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_cell_buffer_snapshot():
+    buf = CellBuffer(4, capacity=4)
+    buf.append(np.ones((3, 4)), np.arange(3))
+    rows, fine_codes = buf.get_codes()
+    # Appends, in place or to new arrays, do not change a snapshot
+    buf.append(2 * np.ones((1, 4)), [3])
+    buf.append(3 * np.ones((10, 4)), np.arange(4, 14))
+    np.testing.assert_array_equal(rows, np.arange(3))
+    np.testing.assert_array_equal(fine_codes, np.ones((3, 4)))
+    rows, fine_codes = buf.get_codes()
+    np.testing.assert_array_equal(rows, np.arange(14))
+    np.testing.assert_array_equal(fine_codes[:, 0], [1] * 3 + [2] + [3] * 10)
+
+
+def check_concurrent_search(dense_ids):
+    # Search while another thread appends, every result must have the codes of its item
+    model = get_model()
+    data = np.concatenate([get_data(seed=seed) for seed in xrange(4)])
+    coarse_codes, fine_codes = predict_batch(model, data)
+    searcher = LOPQSearcherColumnar(model, dense_ids=dense_ids)
+    errors = []
+
+    def add_codes():
+        try:
+            for start in xrange(0, len(data), 16):
+                inds = np.arange(start, min(start + 16, len(data)))
+                searcher.add_codes_arrays(coarse_codes[inds], fine_codes[inds], inds)
+        except Exception as inst:
+            errors.append(inst)
+
+    # Switch threads as often as possible
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    thread = threading.Thread(target=add_codes)
+    thread.start()
+    try:
+        queries = get_queries()
+        nb_searches = 0
+        while thread.is_alive() or not nb_searches:
+            x = queries[nb_searches % len(queries)]
+            for cell in [tuple(c) for c in coarse_codes[:50:7].tolist()]:
+                rows, cell_fine_codes = searcher.get_cell_codes(cell)
+                assert len(rows) == len(cell_fine_codes)
+            results, _ = searcher.search(x, quota=500)
+            for r in results:
+                assert tuple(r.code[0]) == tuple(coarse_codes[r.id]) and tuple(r.code[1]) == tuple(fine_codes[r.id])
+            nb_searches += 1
+    finally:
+        thread.join()
+        sys.setcheckinterval(check_interval)
+    assert not errors
+    assert searcher.get_nb_indexed() == len(data)
+
+
+def test_concurrent_search():
+    yield check_concurrent_search, False
+    yield check_concurrent_search, True
@@ -0,0 +1,50 @@
+from lopq.search import LOPQSearcher
+from lopq.utils import BloomFilter
+from .common import get_data, get_model, build_searcher, check_backend
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(10000, error_rate=0.01)
+    keys = ['key{}'.format(i) for i in xrange(10000)]
+    for key in keys:
+        bloom.add(key)
+    # No false negatives
+    assert all(key in bloom for key in keys)
+    assert bloom.count == len(keys)
+
+    false_positives = sum(1 for i in xrange(10000) if 'other{}'.format(i) in bloom)
+    assert false_positives < 200
+
+
+def test_bloom_filter_keys():
+    bloom = BloomFilter(100)
+    bloom.add(u'unicode\xe9')
+    bloom.add(42)
+    bloom.add(('cell', 3))
+    assert u'unicode\xe9' in bloom
+    assert u'unicode\xe9'.encode('utf-8') in bloom
+    assert 42 in bloom
+    assert ('cell', 3) in bloom
+
+
+def get_searchers():
+    model = get_model()
+    return [LOPQSearcher(model), LOPQSearcher(model, dedup='bloom', bloom_capacity=10000),
+            LOPQSearcher(model, dedup='scan')]
+
+
+def test_dedup_backends():
+    for searcher in get_searchers():
+        yield check_backend, lambda searcher=searcher: searcher
+
+
+def check_duplicates(searcher):
+    # Duplicates are discarded across add_codes calls
+    build_searcher(searcher)
+    build_searcher(searcher)
+    assert searcher.get_nb_indexed() == len(get_data())
+
+
+def test_duplicates():
+    for searcher in get_searchers():
+        yield check_duplicates, searcher
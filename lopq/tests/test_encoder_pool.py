@@ -0,0 +1,61 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from lopq.utils import EncoderPool, compute_codes_parallel, start_worker, stop_worker
+from .common import get_data, get_model
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def sleeping_worker(conn, seconds):
+    # Ignores the stop request, to be terminated by `stop_worker`
+    time.sleep(seconds)
+
+
+def check_encoder_pool(pca):
+    model = get_model(pca)
+    data = get_data()[::3]
+    with EncoderPool(model, num_procs=3, chunk_size=50, shm_dir=tmp_dir) as pool:
+        assert pool.is_usable()
+        for X in [data, data[:1], data[:0]]:
+            coarse_codes, fine_codes = pool.predict_batch(X)
+            assert coarse_codes.shape == (len(X), 2) and fine_codes.shape == (len(X), model.M)
+            for x, coarse, fine in zip(X, coarse_codes, fine_codes):
+                code = model.predict(x)
+                assert tuple(coarse) == tuple(code.coarse)
+                assert tuple(fine) == tuple(code.fine)
+    assert [tuple(code) for code in compute_codes_parallel(data, model, num_procs=2)] == \
+        [tuple(model.predict(x)) for x in data]
+
+
+def test_encoder_pool():
+    yield check_encoder_pool, False
+    yield check_encoder_pool, True
+
+
+def test_encoder_pool_close():
+    pool = EncoderPool(get_model(), num_procs=2, shm_dir=tmp_dir)
+    pool.predict_batch(get_data()[:10])
+    procs = list(pool.procs)
+    pool.close()
+    assert all(proc.poll() is not None for proc in procs)
+    assert pool.procs == [] and pool.conns == []
+    # The shared model and feature files are removed
+    assert os.listdir(tmp_dir) == []
+
+
+def test_stop_worker():
+    proc, conn = start_worker(sleeping_worker, (60,))
+    stop_worker(proc, conn, timeout=0.5)
+    # Terminated by a signal
+    assert proc.poll() < 0
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from lopq.eval import compute_all_neighbors, compute_block_neighbors, compute_ground_truth, \
+    compute_nearest_neighbors, update_top_k
+from lopq.utils import load_xvecs, save_xvecs
+from .common import get_data, get_queries
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def brute_force_neighbors(queries, data, k):
+    dists = cdist(queries, data, 'sqeuclidean')
+    nns = np.argsort(dists, axis=1, kind='mergesort')[:, :k]
+    return nns, dists[np.arange(len(queries))[:, np.newaxis], nns]
+
+
+def check_same_neighbors(nns, dists, expected_nns, expected_dists):
+    np.testing.assert_array_equal(nns, expected_nns)
+    np.testing.assert_allclose(dists, expected_dists, rtol=1e-9, atol=1e-9)
+
+
+def test_update_top_k():
+    rs = np.random.RandomState(0)
+    dists = rs.rand(6, 50)
+    for k in [1, 5, 50]:
+        for block in [1, 7, 50]:
+            top_dists = np.zeros((6, 0))
+            top_indices = np.zeros((6, 0), dtype=np.int64)
+            for start in xrange(0, 50, block):
+                indices = np.arange(start, min(start + block, 50))
+                top_dists, top_indices = update_top_k(top_dists, top_indices, dists[:, indices], indices, k)
+                assert top_dists.shape == (6, min(k, indices[-1] + 1))
+            order = np.argsort(top_dists, axis=1)
+            rows = np.arange(6)[:, np.newaxis]
+            expected = np.argsort(dists, axis=1)[:, :k]
+            np.testing.assert_array_equal(top_indices[rows, order], expected)
+            np.testing.assert_array_equal(top_dists[rows, order], dists[rows, expected])
+
+
+def test_compute_block_neighbors():
+    data = get_data()
+    queries = get_queries()
+    for k in [1, 10, 100]:
+        expected = brute_force_neighbors(queries, data, k)
+        for data_chunk_size in [7, 100, len(data)]:
+            check_same_neighbors(*(compute_block_neighbors(queries, data, k, data_chunk_size) + expected))
+
+
+def test_compute_nearest_neighbors():
+    data = get_data()
+    queries = get_queries()
+    path = os.path.join(tmp_dir, 'data.fvecs')
+    save_xvecs(data, path)
+    # Components are stored as float32 in the file
+    file_data = data.astype(np.float32).astype(np.float64)
+    for k in [1, 10, 3 * len(data)]:
+        expected = brute_force_neighbors(queries, data, k)
+        file_expected = brute_force_neighbors(queries, file_data, k)
+        for query_chunk_size, data_chunk_size in [(5, 64), (1024, 65536)]:
+            for num_procs in [1, 3]:
+                kwargs = dict(k=k, query_chunk_size=query_chunk_size, data_chunk_size=data_chunk_size,
+                              num_procs=num_procs)
+                check_same_neighbors(*(compute_nearest_neighbors(queries, data, **kwargs) + expected))
+                check_same_neighbors(*(compute_nearest_neighbors(queries, path, **kwargs) + file_expected))
+
+
+def test_compute_nearest_neighbors_no_queries():
+    nns, dists = compute_nearest_neighbors(get_queries()[:0], get_data(), k=5)
+    assert nns.shape == (0, 5) and dists.shape == (0, 5)
+
+
+def test_compute_ground_truth():
+    data = get_data()
+    queries = get_queries()
+    path = os.path.join(tmp_dir, 'groundtruth.ivecs')
+    nns = compute_ground_truth(queries, data, path, k=10, data_chunk_size=100, num_procs=2)
+    expected, _ = brute_force_neighbors(queries, data, 10)
+    np.testing.assert_array_equal(nns, expected)
+    np.testing.assert_array_equal(load_xvecs(path, 'i'), expected)
+
+
+def test_compute_all_neighbors():
+    data = get_data()[::4]
+    queries = get_queries()
+    dists = cdist(queries, data)
+    np.testing.assert_array_equal(compute_all_neighbors(queries, data), dists.argmin(axis=1))
+    np.testing.assert_array_equal(compute_all_neighbors(queries, data, just_nn=False),
+                                  np.argsort(dists, axis=1, kind='mergesort'))
+    # Each point is its own nearest neighbor
+    np.testing.assert_array_equal(compute_all_neighbors(data), np.arange(len(data)))
@@ -0,0 +1,35 @@
+import shutil
+import tempfile
+
+from lopq.search import LOPQSearcherLMDB
+from .common import get_data, get_model, build_searcher, search_all, check_backend, check_same_results
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def test_lmdb():
+    model = get_model()
+    yield check_backend, lambda: LOPQSearcherLMDB(model, tempfile.mkdtemp(dir=tmp_dir))
+
+
+def test_lmdb_duplicates():
+    model = get_model()
+    path = tempfile.mkdtemp(dir=tmp_dir)
+    searcher = build_searcher(LOPQSearcherLMDB(model, path))
+    expected = search_all(searcher, 600)
+    build_searcher(searcher)
+    assert searcher.get_nb_indexed() == len(get_data())
+    check_same_results(search_all(searcher, 600), expected)
+    searcher.env.close()
+
+    # Ids are checked against the stored chunks when the index is reopened
+    searcher = build_searcher(LOPQSearcherLMDB(model, path))
+    assert searcher.get_nb_indexed() == len(get_data())
+    check_same_results(search_all(searcher, 600), expected)
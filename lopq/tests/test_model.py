@@ -0,0 +1,19 @@
+import numpy as np
+
+from .common import get_data, get_model
+
+
+def check_predict_batch(pca):
+    model = get_model(pca)
+    data = get_data()[::7]
+    coarse_codes, fine_codes = model.predict_batch(data)
+    for x, coarse, fine in zip(data, coarse_codes, fine_codes):
+        code = model.predict(x)
+        assert tuple(coarse) == tuple(code.coarse)
+        assert tuple(fine) == tuple(code.fine)
+
+
+def test_predict_batch():
+    yield check_predict_batch, False
+    yield check_predict_batch, True
+
@@ -0,0 +1,16 @@
+import numpy as np
+
+from lopq.search import multisequence, multisequence_heap
+from .common import get_model, get_queries
+
+
+def test_multisequence():
+    model = get_model()
+    for x in get_queries():
+        expected = list(multisequence_heap(x, model.Cs))
+        assert len(expected) == model.V ** 2
+        for batch_size in [1, 3, 16]:
+            cells = list(multisequence(x, model.Cs, batch_size=batch_size))
+            assert [cell for _, cell in cells] == [tuple(cell) for _, cell in expected]
+            np.testing.assert_allclose([d for d, _ in cells], [d for d, _ in expected], rtol=1e-12)
+
@@ -0,0 +1,20 @@
+from lopq.search import LOPQSearcher, LOPQSearcherColumnar
+from .common import get_model, get_queries, build_searcher, search_all, check_same_results
+
+
+def check_scan_threads(searcher):
+    expected = search_all(searcher, 600)
+    queries = get_queries()
+    batch_expected = searcher.search_batch(queries, quota=100, with_dists=True)
+    for num_threads, min_candidates in [(4, 10), (2, 1), (4, 10000)]:
+        searcher.set_scan_threads(num_threads, min_candidates_per_thread=min_candidates)
+        check_same_results(search_all(searcher, 600), expected)
+        check_same_results(zip(*searcher.search_batch(queries, quota=100, with_dists=True)), zip(*batch_expected))
+    searcher.set_scan_threads(1)
+    check_same_results(search_all(searcher, 600), expected)
+
+
+def test_scan_threads():
+    model = get_model()
+    yield check_scan_threads, build_searcher(LOPQSearcher(model))
+    yield check_scan_threads, build_searcher(LOPQSearcherColumnar(model))
@@ -0,0 +1,29 @@
+import numpy as np
+
+from lopq.search import LOPQSearcher, LOPQSearcherColumnar, get_sorted_coarse_distances, \
+    get_sorted_coarse_distances_batch
+from .common import get_model, get_queries, build_searcher, search_all, check_same_results
+
+
+def test_sorted_coarse_distances_batch():
+    model = get_model()
+    queries = get_queries()
+    for x, (inds, dists) in zip(queries, get_sorted_coarse_distances_batch(queries, model.Cs)):
+        exp_inds, exp_dists = get_sorted_coarse_distances(x, model.Cs)
+        for split in [0, 1]:
+            np.testing.assert_array_equal(inds[split], exp_inds[split])
+            np.testing.assert_allclose(dists[split], exp_dists[split], rtol=1e-9)
+
+
+def check_search_batch(searcher):
+    queries = get_queries()
+    for quota in [10, 100, 600]:
+        all_results, all_visited = searcher.search_batch(queries, quota=quota, with_dists=True)
+        check_same_results(zip(all_results, all_visited), search_all(searcher, quota))
+
+
+def test_search_batch():
+    for pca in [False, True]:
+        model = get_model(pca=pca)
+        yield check_search_batch, build_searcher(LOPQSearcher(model))
+        yield check_search_batch, build_searcher(LOPQSearcherColumnar(model))
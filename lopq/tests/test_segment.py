@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from nose.tools import assert_raises
+
+from lopq.search import LOPQSearcherMmap, get_fine_codes_dtype
+from lopq.segment import LOPQSegment, write_segment, normalize_ids
+from .common import get_data, get_model, predict_batch, build_searcher, search_all, check_backend
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def check_segment(ids):
+    model = get_model()
+    coarse_codes, fine_codes = predict_batch(model, get_data()[:len(ids)])
+    fine_codes = fine_codes.astype(get_fine_codes_dtype(model))
+    cell_ids = model.get_cell_id_for_coarse_codes(coarse_codes.T.astype(np.int64))
+    path = os.path.join(tmp_dir, 'segment')
+    write_segment(path, model.V, cell_ids, fine_codes, ids)
+
+    segment = LOPQSegment(path)
+    assert len(segment) == len(ids)
+    assert (segment.V, segment.M) == (model.V, model.M)
+    for cell_id in xrange(model.V * model.V):
+        # Items of a cell are kept in insertion order
+        inds = np.flatnonzero(cell_ids == cell_id)
+        cell_ids_, cell_fine_codes = segment.get_cell(cell_id)
+        np.testing.assert_array_equal(cell_ids_, np.asarray(ids)[inds])
+        np.testing.assert_array_equal(cell_fine_codes, fine_codes[inds])
+    np.testing.assert_array_equal(segment.get_cell_ids(), np.sort(cell_ids))
+    return segment
+
+
+def check_segment_contains(ids, missing):
+    segment = check_segment(ids)
+    queries = normalize_ids(np.concatenate((missing, ids[::3], missing)))
+    expected = np.concatenate((np.zeros(len(missing)), np.ones(len(ids[::3])), np.zeros(len(missing))))
+    np.testing.assert_array_equal(segment.contains(queries), expected.astype(bool))
+
+
+def test_segment():
+    yield check_segment, np.arange(1000, 3000)
+    yield check_segment, np.array(['id{}'.format(i) for i in xrange(500)])
+    yield check_segment, np.arange(0)
+
+
+def test_segment_contains():
+    yield check_segment_contains, np.arange(1000, 3000)[::-1], [0, 1 << 40, 10500]
+    yield check_segment_contains, np.array(['id{}'.format(i) for i in xrange(500)]), ['id', 'id5000', 'zz']
+    yield check_segment_contains, np.arange(0), [1, 2]
+
+
+def test_invalid_segment():
+    path = os.path.join(tmp_dir, 'invalid')
+    with open(path, 'wb') as f:
+        f.write('not a segment' * 10)
+    assert_raises(ValueError, LOPQSegment, path)
+
+
+def test_mmap():
+    model = get_model()
+    yield check_backend, lambda: LOPQSearcherMmap(model, tempfile.mkdtemp(dir=tmp_dir), background_merge=False)
+
+
+def test_mmap_duplicates():
+    model = get_model()
+    n = len(get_data())
+    searcher = build_searcher(LOPQSearcherMmap(model, tempfile.mkdtemp(dir=tmp_dir), background_merge=False))
+    build_searcher(searcher)
+    coarse_codes, fine_codes = predict_batch(model, get_data()[:10])
+    searcher.add_codes_arrays(coarse_codes, fine_codes, [n, n + 1] * 5)
+    assert searcher.get_nb_indexed() == n + 2
+    assert len(searcher.segments) == 2
+    for results, _ in search_all(searcher, 3 * n):
+        ids = [r.id for r in results]
+        assert len(ids) == len(set(ids))
@@ -0,0 +1,41 @@
+import numpy as np
+
+from lopq.search import LOPQSearcher
+from lopq.shard import LOPQSearcherSharded
+from .common import get_data, get_model, get_queries, build_searcher, check_backend, check_same_result_sets
+
+
+def test_sharded():
+    # Each shard retrieves all its items, so results are the same up to the order of ties
+    model = get_model()
+    quota = 3 * len(get_data())
+    for partition in ['id', 'cell']:
+        build = lambda partition=partition: LOPQSearcherSharded(model, num_shards=3, partition=partition)
+        yield check_backend, build, [quota], check_same_result_sets
+
+
+def check_sharded_recall(partition, quota, limit, min_recall):
+    # Items with the same codes are at the same distance, so results are compared by distance:
+    # the recall is the proportion of the results of the single index matched by a result of
+    # the sharded index at the same rank that is not farther
+    model = get_model()
+    reference = build_searcher(LOPQSearcher(model))
+    searcher = build_searcher(LOPQSearcherSharded(model, num_shards=3, partition=partition))
+    try:
+        expected = [reference.search(x, quota=quota, limit=limit, with_dists=True)[0] for x in get_queries()]
+        results = [searcher.search(x, quota=quota, limit=limit, with_dists=True)[0] for x in get_queries()]
+    finally:
+        searcher.close()
+    found = 0
+    for res, exp in zip(results, expected):
+        assert len(res) == len(exp)
+        found += np.sum(np.array(sorted(r.dist for r in res)) <= np.array(sorted(r.dist for r in exp)) + 1e-10)
+    recall = float(found) / sum(len(exp) for exp in expected)
+    assert recall >= min_recall, recall
+
+
+def test_sharded_recall():
+    # Shards with the 'cell' partition retrieve at least the candidates of the single index
+    for quota, limit in [(50, 10), (200, 50), (600, 100)]:
+        yield check_sharded_recall, 'id', quota, limit, 0.99
+        yield check_sharded_recall, 'cell', quota, limit, 1.0
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+
+from lopq.search import LOPQSearcher
+from .common import get_data, get_model, get_codes, search_all, check_same_results
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def check_snapshot(ids):
+    model = get_model()
+    codes = get_codes(model, get_data()[:len(ids)])
+    searcher = LOPQSearcher(model)
+    searcher.add_codes(codes, ids)
+    path = os.path.join(tmp_dir, 'snapshot')
+    searcher.save_snapshot(path)
+
+    restored = LOPQSearcher(model)
+    restored.load_snapshot(path)
+    assert restored.nb_indexed == searcher.nb_indexed
+    cells = set(cell for cell, items in searcher.index.iteritems() if items)
+    assert set(cell for cell, items in restored.index.iteritems() if items) == cells
+    for cell in cells:
+        assert restored.get_cell(cell) == searcher.get_cell(cell)
+    check_same_results(search_all(restored, 100), search_all(searcher, 100))
+
+    # Restored ids are known to duplicate detection
+    restored.add_codes(codes, ids)
+    assert restored.get_nb_indexed() == len(ids)
+
+
+def test_snapshot():
+    yield check_snapshot, range(1000)
+    yield check_snapshot, ['{:040x}_1_2_3_4'.format(i) for i in xrange(1000)]
+    yield check_snapshot, []
@@ -0,0 +1,80 @@
+import numpy as np
+from nose.tools import assert_raises
+
+from lopq.model import LOPQModel, LOPQModelPCA, StreamingKMeans, train_pca, train_pca_streaming, train_streaming
+from lopq.utils import iterate_chunks
+from .common import get_data
+
+
+def check_same_pca(params, expected):
+    np.testing.assert_allclose(params['mu'], expected['mu'], rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(params['A'], expected['A'], rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(params['E'], expected['E'], rtol=1e-10)
+    # Eigenvectors are defined up to their sign
+    signs = np.sign(np.sum(params['P'] * expected['P'], axis=0))
+    np.testing.assert_allclose(params['P'] * signs, expected['P'], rtol=1e-7, atol=1e-9)
+    assert params['c'] == expected['c']
+
+
+def test_train_pca_streaming():
+    data = get_data()
+    expected, expected_dims = train_pca(data, pca_dims=8)
+    for chunk_size in [len(data), 300, 7]:
+        params, pca_dims = train_pca_streaming(lambda: iterate_chunks(data, chunk_size), pca_dims=8)
+        assert pca_dims == expected_dims
+        assert params['P'].shape == (data.shape[1], 8)
+        check_same_pca(params, expected)
+
+
+def test_streaming_kmeans():
+    data = get_data()
+    kmeans = StreamingKMeans(8, random_state=0)
+    for chunk in iterate_chunks(data, 100):
+        kmeans.partial_fit(chunk)
+    kmeans.flush()
+    assert kmeans.cluster_centers_.shape == (8, data.shape[1])
+
+    # A stream shorter than the initialization size is fitted on flush
+    kmeans = StreamingKMeans(8, random_state=0)
+    kmeans.partial_fit(data[:5])
+    kmeans.partial_fit(data[5:12])
+    kmeans.flush()
+    assert kmeans.cluster_centers_.shape == (8, data.shape[1])
+
+    kmeans = StreamingKMeans(8, random_state=0)
+    kmeans.partial_fit(data[:5])
+    assert_raises(ValueError, kmeans.flush)
+
+
+def check_parameters(parameters, V, M, S, D):
+    Cs, Rs, mus, subquantizers = parameters
+    for split in [0, 1]:
+        assert Cs[split].shape == (V, D / 2)
+        assert np.asarray(Rs[split]).shape == (V, D / 2, D / 2)
+        assert np.asarray(mus[split]).shape == (V, D / 2)
+        assert len(subquantizers[split]) == M / 2
+        for sub in subquantizers[split]:
+            assert sub.shape == (S, D / M)
+
+
+def test_train_streaming():
+    data = get_data()
+    get_chunks = lambda: iterate_chunks(data, 500)
+    parameters = train_streaming(get_chunks, V=4, M=4, subquantizer_clusters=16, kmeans_coarse_iters=2,
+                                 kmeans_local_iters=2, subquantizer_sample_ratio=0.5, random_state=0)
+    check_parameters(parameters, 4, 4, 16, data.shape[1])
+
+    model = LOPQModel(V=4, M=4, subquantizer_clusters=16, parameters=parameters)
+    code = model.predict(data[0])
+    assert len(code.coarse) == 2 and len(code.fine) == 4
+
+
+def test_fit_streaming_pca():
+    data = get_data()
+    model = LOPQModelPCA(V=4, M=4, subquantizer_clusters=16)
+    model.fit_streaming(lambda: iterate_chunks(data, 500), pca_dims=8, kmeans_coarse_iters=2,
+                        kmeans_local_iters=2, random_state=0)
+    assert model.pca_P.shape == (data.shape[1], 8)
+    check_parameters((model.Cs, model.Rs, model.mus, model.subquantizers), 4, 4, 16, 8)
+    code = model.predict(data[0])
+    assert len(code.coarse) == 2 and len(code.fine) == 4
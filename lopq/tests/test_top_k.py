@@ -0,0 +1,24 @@
+import numpy as np
+
+from lopq.search import LOPQSearcher, top_k_order
+from .common import get_model, get_queries, build_searcher
+
+
+def test_top_k_order():
+    rs = np.random.RandomState(0)
+    # Few distinct values, so that ties at the k-th distance are frequent
+    dists = rs.randint(0, 20, size=500).astype(np.float64)
+    expected = np.argsort(dists, kind='mergesort')
+    for k in [0, 1, 7, 100, 499, 500, 1000]:
+        np.testing.assert_array_equal(top_k_order(dists, k), expected[:max(k, 0)])
+
+
+def test_cell_cutoff():
+    # The cutoff only stops visiting cells, results are a subset of the retrieved items
+    searcher = build_searcher(LOPQSearcher(get_model()))
+    for x in get_queries():
+        results, visited = searcher.search(x, quota=600, limit=10, with_dists=True, cell_cutoff=True)
+        full, full_visited = searcher.search(x, quota=600, with_dists=True)
+        assert len(results) == 10 and visited <= full_visited
+        dists = dict((r.id, r.dist) for r in full)
+        assert all(dists[r.id] == r.dist for r in results)
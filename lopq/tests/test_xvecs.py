@@ -0,0 +1,64 @@
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+from lopq.utils import load_xvecs, iter_xvecs, save_xvecs, mmap_xvecs
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def get_vectors(base_type, N=103, D=12):
+    rs = np.random.RandomState(0)
+    if base_type == 'f':
+        return rs.randn(N, D).astype(np.float32)
+    if base_type == 'i':
+        return rs.randint(-2 ** 31, 2 ** 31 - 1, size=(N, D))
+    return rs.randint(0, 256, size=(N, D))
+
+
+def check_xvecs(base_type, N):
+    data = get_vectors(base_type, N)
+    path = os.path.join(tmp_dir, 'vectors.{}vecs'.format(base_type))
+    save_xvecs(data, path, base_type)
+
+    # Each row is the dimension as int32 followed by its components
+    itemsize = {'f': 4, 'i': 4, 'b': 1}[base_type]
+    assert os.path.getsize(path) == N * (4 + itemsize * data.shape[1])
+    if N:
+        with open(path, 'rb') as f:
+            assert struct.unpack('<i', f.read(4))[0] == data.shape[1]
+
+    loaded = load_xvecs(path, base_type)
+    if N:
+        # Singleton dimensions are squeezed, as the struct based reader did
+        np.testing.assert_array_equal(loaded, np.squeeze(data))
+        np.testing.assert_array_equal(load_xvecs(path, base_type, max_num=10, start=5), data[5:15])
+    else:
+        assert loaded.size == 0
+    for chunk_size in [1, 10, N + 1]:
+        chunks = list(iter_xvecs(path, base_type, chunk_size))
+        assert [len(chunk) for chunk in chunks] == [min(chunk_size, N - start) for start in xrange(0, N, chunk_size)]
+        if N:
+            np.testing.assert_array_equal(np.concatenate(chunks), data)
+
+
+def test_xvecs():
+    for base_type in ['f', 'i', 'b']:
+        for N in [103, 1, 0]:
+            yield check_xvecs, base_type, N
+
+
+def test_scalars():
+    path = os.path.join(tmp_dir, 'scalars.ivecs')
+    save_xvecs(np.arange(10), path, 'i')
+    assert mmap_xvecs(path, 'i').shape == (10, 1)
+    np.testing.assert_array_equal(load_xvecs(path, 'i'), np.arange(10))
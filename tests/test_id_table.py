@@ -0,0 +1,64 @@
+import shutil
+import tempfile
+import numpy as np
+
+from cufacesearch.searcher.id_table import IdTable, pack_sample_id, unpack_sample_id, KIND_SHA1, KIND_SHA1_BBOX, \
+  KIND_RAW
+
+SHA1 = '0123456789abcdef0123456789abcdef01234567'
+SAMPLE_IDS = [SHA1, SHA1 + '_10_20_-30_40', SHA1.upper(), SHA1 + '_010_20_30_40', 'not_a_sha1', u'unicode_id',
+              SHA1 + '_1_2_3', '']
+
+
+def test_pack_sample_id():
+  for sample_id in SAMPLE_IDS:
+    assert unpack_sample_id(pack_sample_id(sample_id)) == str(sample_id)
+  assert ord(pack_sample_id(SHA1)[0]) == KIND_SHA1
+  assert ord(pack_sample_id(SHA1 + '_10_20_-30_40')[0]) == KIND_SHA1_BBOX
+  # Ids that would not be rebuilt exactly are stored as is
+  assert ord(pack_sample_id(SHA1.upper())[0]) == KIND_RAW
+  assert ord(pack_sample_id(SHA1 + '_010_20_30_40')[0]) == KIND_RAW
+
+
+def get_sample_ids(n):
+  return ['{:040x}_{}_{}_{}_{}'.format(i // 3, i, i + 1, i + 2, i + 3) if i % 5 else 'raw_{}'.format(i)
+          for i in xrange(n)]
+
+
+def test_get_or_add_ids():
+  table = IdTable()
+  sample_ids = get_sample_ids(1000)
+  int_ids = table.get_or_add_ids(sample_ids)
+  np.testing.assert_array_equal(int_ids, np.arange(1000))
+  # Known ids keep their integer id, a repeated new id gets a single one
+  int_ids = table.get_or_add_ids(sample_ids[500:] + ['new', SHA1, 'new'])
+  np.testing.assert_array_equal(int_ids, range(500, 1000) + [1000, 1001, 1000])
+  assert len(table) == 1002
+  assert table.resolve([0, 1, 5, 1001]) == [sample_ids[0], sample_ids[1], sample_ids[5], SHA1]
+  assert table.get_sha1s([1, 1001]) == [sample_ids[1].split('_')[0], SHA1]
+
+
+def test_state():
+  table = IdTable()
+  sample_ids = get_sample_ids(2000)
+  table.get_or_add_ids(sample_ids)
+  restored = IdTable()
+  restored.set_state(table.get_state())
+  assert restored.resolve(range(2000)) == sample_ids
+  np.testing.assert_array_equal(restored.get_or_add_ids(sample_ids[::-1] + ['new']), range(1999, -1, -1) + [2000])
+
+
+def test_lmdb_table():
+  lmdb_path = tempfile.mkdtemp()
+  try:
+    table = IdTable(lmdb_path)
+    other = IdTable(lmdb_path)
+    sample_ids = get_sample_ids(300)
+    table.get_or_add_ids(sample_ids[:200])
+    # Ids added by another process are found, new ones get the next integer ids
+    np.testing.assert_array_equal(other.get_or_add_ids(sample_ids[100:]), range(100, 300))
+    assert table.resolve([250]) == [sample_ids[250]]
+    reopened = IdTable(lmdb_path)
+    assert reopened.resolve(range(300)) == sample_ids
+  finally:
+    shutil.rmtree(lmdb_path)
@@ -0,0 +1,215 @@
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+import numpy as np
+
+from lopq.codes import CodesBatch, dump_codes
+from cufacesearch.searcher.searcher_lopqhbase import SearcherLOPQHBase, MAX_PENDING_UPDATE_AGE
+from cufacesearch.searcher.update_registry import UpdateRegistry
+
+NB_UPDATES = 24
+CODES_PER_UPDATE = 5
+
+
+def get_update_id(i):
+  return 'index_update_sbpycaffe_feat_full_image_2018-06-{:02d}_{}'.format(1 + i // 10, i % 10)
+
+
+def get_update_codes(update_id):
+  i = int(update_id.split('_')[-1]) + 10 * (int(update_id.split('_')[-2][-2:]) - 1)
+  # Samples are shared by consecutive updates, the first update of a sample is kept
+  ids = np.array(['sample_{}'.format(i + j) for j in range(CODES_PER_UPDATE)])
+  coarse_codes = np.tile([i % 4, (i + 1) % 4], (CODES_PER_UPDATE, 1))
+  fine_codes = np.tile([i % 16, 0, 1, 2], (CODES_PER_UPDATE, 1))
+  return CodesBatch(ids, coarse_codes, fine_codes)
+
+
+class StubStorer(object):
+  """Storer of precomputed codes, later updates loading faster so that fetches complete out of order
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.completed = []
+
+  def load(self, key, silent=False):
+    update_id = key.split('/')[-1]
+    time.sleep(0.002 * (NB_UPDATES - update_ids.index(update_id)))
+    with self.lock:
+      self.completed.append(update_id)
+    return dump_codes(get_update_codes(update_id))
+
+
+class StubIndexer(object):
+  """Indexer returning the columns of updates, processed updates having the processed column
+  """
+  table_updateinfos_name = 'updateinfos'
+
+  def __init__(self, processed):
+    self.processed = processed
+
+  def get_col_upproc(self):
+    return 'info:processed'
+
+  def get_col_listsha1s(self):
+    return 'info:list_sha1s'
+
+  def get_rows_by_batch(self, list_queries, table_name):
+    rows = []
+    for update_id in list_queries:
+      columns = {'info:list_sha1s': 'sha1'}
+      if update_id in self.processed:
+        columns['info:processed'] = 'True'
+      rows.append((update_id, columns))
+    return rows
+
+
+class RecordingSearcher(object):
+  """LOPQ searcher recording the ids added to the index, skipping already indexed ids as the index does
+  """
+
+  def __init__(self):
+    self.ids = []
+
+  def add_codes_arrays(self, coarse_codes, fine_codes, ids):
+    self.ids.extend(sample_id for sample_id in ids.tolist() if sample_id not in self.ids)
+
+  def get_nb_indexed(self):
+    return len(self.ids)
+
+
+class StubSearcherLOPQHBase(SearcherLOPQHBase):
+  """SearcherLOPQHBase over stubs, without configuration, model nor HBase
+  """
+
+  def __init__(self, load_threads=4, processed=(), update_registry=None):
+    self.pp = 'StubSearcherLOPQHBase'
+    self.verbose = 0
+    self.featurizer_type = 'sbpycaffe'
+    self.lopq_searcher = 'LOPQSearcher' if update_registry is None else 'LOPQSearcherLMDB'
+    self.searcher = RecordingSearcher()
+    self.storer = StubStorer()
+    self.indexer = StubIndexer(processed)
+    self.id_table = None
+    self.shared_control = None
+    self.update_registry = update_registry
+    self.indexed_updates = set()
+    self.last_indexed_update = None
+    self.refresh_status = {}
+    self.refresh_batch_size = 12
+    self.nb_unsaved_updates = 0
+    self.use_snapshot = False
+    self.index_write_lock = threading.Lock()
+    self.load_threads = load_threads
+    self.load_prefetch = 8
+    self.load_pool = None
+    self.load_pool_pid = None
+    self.pools_lock = threading.Lock()
+    self.pushed_updates = dict()
+    self.reconcile_date = None
+    self.reconcile_margin = 1
+    self.added_updates = []
+
+  def build_model_str(self):
+    return 'model'
+
+  def build_extr_str(self):
+    return 'sbpycaffe_feat_full_image'
+
+  def add_updates(self, updates):
+    self.added_updates.extend(update_id for update_id, _ in updates)
+    super(StubSearcherLOPQHBase, self).add_updates(updates)
+
+
+update_ids = [get_update_id(i) for i in range(NB_UPDATES)]
+
+
+def get_updates():
+  return [((update_id, {'info:list_sha1s': 'sha1', 'info:processed': 'True'}), datetime.now())
+          for update_id in update_ids]
+
+
+def test_iter_updates_codes():
+  for load_threads in [1, 4]:
+    searcher = StubSearcherLOPQHBase(load_threads)
+    results = list(searcher.iter_updates_codes(get_updates(), False, searcher.build_extr_str(), 'sbpycaffe', 4096))
+    assert [update_id for update_id, _, _, _ in results] == update_ids
+    for update_id, _, codes, _ in results:
+      assert codes.ids.tolist() == get_update_codes(update_id).ids.tolist()
+    if load_threads > 1:
+      # Fetches did complete out of order
+      assert searcher.storer.completed != update_ids
+
+
+def test_index_updates():
+  searcher = StubSearcherLOPQHBase(4)
+  searcher.index_updates(get_updates(), False, searcher.build_extr_str(), 'sbpycaffe', 4096)
+  # Updates are marked indexed and codes added in the updates order, the first update of a sample wins
+  assert searcher.added_updates == update_ids
+  expected_ids = []
+  for update_id in update_ids:
+    expected_ids.extend(sample_id for sample_id in get_update_codes(update_id).ids.tolist()
+                        if sample_id not in expected_ids)
+  assert searcher.searcher.ids == expected_ids
+  assert searcher.last_indexed_update == update_ids[-1]
+
+
+def add_updates(lmdb_path, updates):
+  UpdateRegistry(lmdb_path).add([(update_id, datetime.now()) for update_id in updates])
+
+
+def test_load_pushed_updates():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    registry = UpdateRegistry(tmp_dir)
+    searcher = StubSearcherLOPQHBase(4, processed=set(update_ids[:20]), update_registry=registry)
+    now = time.time()
+    for update_id in update_ids:
+      searcher.pushed_updates[update_id] = now
+    # The last update was pushed too long ago to stay pending
+    searcher.pushed_updates[update_ids[-1]] = now - MAX_PENDING_UPDATE_AGE - 1
+    # Updates indexed by another process sharing the index
+    process = multiprocessing.Process(target=add_updates, args=(tmp_dir, update_ids[:8]))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    searcher.load_pushed_updates()
+    # Updates already in the registry are skipped, processed updates are indexed
+    assert searcher.added_updates == update_ids[8:20]
+    assert all(update_id in registry for update_id in update_ids[:20])
+    assert 'sample_7' not in searcher.searcher.ids and 'sample_8' in searcher.searcher.ids
+    # Unprocessed updates stay pending, until they are too old
+    assert sorted(searcher.pushed_updates) == update_ids[20:-1]
+
+    # Pending updates now processed are indexed by the next call
+    searcher.indexer.processed = set(update_ids)
+    searcher.load_pushed_updates()
+    assert searcher.added_updates == update_ids[8:-1]
+    assert not searcher.pushed_updates
+    assert update_ids[-1] not in registry
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_update_reconcile_date():
+  searcher = StubSearcherLOPQHBase()
+  assert searcher.get_reconcile_date() == '1970-01-01'
+  # Without pending updates the watermark is the start of the refresh, minus the margin
+  searcher.update_reconcile_date(datetime(2018, 6, 10, 12))
+  assert searcher.get_reconcile_date() == '2018-06-09'
+  # Refreshes check updates since the oldest pending update
+  searcher.pushed_updates[update_ids[12]] = time.time()
+  searcher.pushed_updates[update_ids[23]] = time.time()
+  searcher.update_reconcile_date(datetime(2018, 6, 10, 12))
+  assert searcher.get_reconcile_date() == '2018-06-01'
+  # or since the oldest update seen unprocessed by the refresh
+  searcher.update_reconcile_date(datetime(2018, 6, 10, 12), oldest_unprocessed=update_ids[0])
+  assert searcher.get_reconcile_date() == '2018-05-31'
+  # The watermark is kept when update ids have no date
+  searcher.pushed_updates['update_without_date'] = time.time()
+  searcher.update_reconcile_date(datetime(2018, 6, 20))
+  assert searcher.get_reconcile_date() == '2018-05-31'
@@ -0,0 +1,75 @@
+import os
+import shutil
+import struct
+import tempfile
+import multiprocessing
+
+from cufacesearch.searcher.shared_control import SharedControl
+
+
+def setup_module():
+  global tmp_dir
+  tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+  shutil.rmtree(tmp_dir)
+
+
+def contend_refresh(control, results, release):
+  # Report whether the lock was taken, and hold it until the parent releases the contenders
+  results.put((os.getpid(), control.try_lock_refresh()))
+  release.wait()
+
+
+def publish_refresh(control_path, nb_indexed, last_refresh):
+  control = SharedControl(control_path)
+  if control.try_lock_refresh():
+    control.publish(nb_indexed, last_refresh)
+    control.unlock_refresh()
+
+
+def test_try_lock_refresh():
+  # The control block is created before forking, as with gunicorn --preload
+  control = SharedControl(os.path.join(tmp_dir, 'contention'))
+  results = multiprocessing.Queue()
+  release = multiprocessing.Event()
+  procs = [multiprocessing.Process(target=contend_refresh, args=(control, results, release)) for _ in range(6)]
+  for proc in procs:
+    proc.start()
+  try:
+    won = [results.get(timeout=30)[1] for _ in procs]
+  finally:
+    release.set()
+    for proc in procs:
+      proc.join()
+  assert sorted(won) == [False] * 5 + [True]
+
+  # The lock of a process is released when it exits
+  assert control.try_lock_refresh()
+  control.unlock_refresh()
+
+
+def test_publish():
+  path = os.path.join(tmp_dir, 'publish')
+  control = SharedControl(path)
+  assert control.read()[:3] == (0, 0, 0.)
+  generation = control.publish(10, 1000.)
+  assert generation == control.get_generation() == 2
+
+  # Another process publishes a new generation
+  proc = multiprocessing.Process(target=publish_refresh, args=(path, 25, 2000.))
+  proc.start()
+  proc.join()
+  generation, nb_indexed, last_refresh, pid = control.read()
+  assert (generation, nb_indexed, last_refresh, pid) == (4, 25, 2000., proc.pid)
+  assert SharedControl(path).read() == (4, 25, 2000., proc.pid)
+
+
+def test_publish_after_failed_write():
+  control = SharedControl(os.path.join(tmp_dir, 'failed'))
+  control.publish(10, 1000.)
+  # A refresher died while writing, leaving an odd generation
+  struct.pack_into('<Q', control.block, 0, 3)
+  assert control.publish(20, 2000.) == 6
+  assert control.read()[:3] == (6, 20, 2000.)
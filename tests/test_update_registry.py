@@ -0,0 +1,37 @@
+import shutil
+import tempfile
+from datetime import datetime
+
+from cufacesearch.searcher.update_registry import UpdateRegistry
+
+
+def test_registry():
+  registry = UpdateRegistry()
+  registry.add([('update_2', datetime(2020, 1, 2)), ('update_1', datetime(2020, 1, 1, 3, 4, 5, 6))])
+  assert 'update_1' in registry and 'update_3' not in registry
+  assert len(registry) == 2
+  assert registry.get_latest() == 'update_2'
+  assert registry.get_date('update_1') == datetime(2020, 1, 1, 3, 4, 5, 6)
+  assert registry.get_date('update_3') is None
+
+
+def test_lmdb_registry():
+  lmdb_path = tempfile.mkdtemp()
+  try:
+    registry = UpdateRegistry(lmdb_path)
+    other = UpdateRegistry(lmdb_path)
+    registry.add([('update_1', datetime(2020, 1, 1))])
+    other.sync()
+    assert other.get_date('update_1') == datetime(2020, 1, 1)
+    # Overwritten dates are seen, e.g. the future date marking skipped updates
+    registry.add([('update_1', datetime(9999, 1, 1))])
+    other.sync()
+    assert other.get_date('update_1') == datetime(9999, 1, 1)
+    # Dates saved as str(datetime), without microseconds
+    with registry.env.begin(db=registry.updates_db, write=True) as txn:
+      txn.put('update_2', str(datetime(2020, 2, 2)))
+    other.sync()
+    assert other.get_date('update_2') == datetime(2020, 2, 2)
+    assert other.get_latest() == 'update_2'
+  finally:
+    shutil.rmtree(lmdb_path)
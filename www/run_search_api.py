@@ -56,6 +56,8 @@ if __name__ == '__main__':
             time.sleep(60)
     api.global_start_time = datetime.now()
     api.input_type = api.global_searcher.input_type
+    # Refresh and consume pushed updates in the background from the start
+    api.global_searcher.start_refresh_scheduler()
 
     # Start API
     searchapi.add_resource(api.APIResponder, '/'+options.endpoint+'/<string:mode>')